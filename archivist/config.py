@@ -1,18 +1,37 @@
 from collections import defaultdict
+from contextlib import contextmanager
+from copy import deepcopy
+from glob import glob, has_magic
+from hashlib import sha1
 from inspect import getargspec
+from logging import getLogger
+import marshal
+import os
+from tempfile import mkstemp
 from voluptuous import (
-    Schema, Required, MultipleInvalid, Length, All, Any, Extra
+    Schema, Required, MultipleInvalid, Length, All, Any, Extra, Range
 )
 import yaml
-from archivist.plugins import Repo, Notifier, Source
+from archivist.limits import limits_schema, source_limits_schema
+from archivist.lock import lock_schema
+from archivist.plugins import Repo, Notifier, Source, cache_path
+from archivist.profiling import profile_schema
+from archivist.templates import (
+    template_schema, parameter_sets, substitute, parameterised_keys,
+    key_validators
+)
+from archivist.validation import Mismatch, validator_for
+
+logger = getLogger(__name__)
 
 
 class ConfigError(Exception):
 
-    def __init__(self, errors, config, path=None):
+    def __init__(self, errors, config, path=None, source=None):
         self.errors = errors
         self.config = config
         self.path = path
+        self.source = source
 
     def resolve_path(self, error):
         resolved = []
@@ -48,11 +67,15 @@ class ConfigError(Exception):
             yield message, config
 
     def handle_str(self, message):
+        if self.path is not None:
+            message = 'at {!r}, {}'.format(self.path, message)
         yield message, self.config
 
     def __str__(self):
         handler = getattr(self, 'handle_'+type(self.errors).__name__)
         output = []
+        if self.source is not None:
+            output.append('in {}:'.format(self.source))
         for message, config in handler(self.errors):
             output.append('{message}: \n{yaml}'.format(
                 message=message,
@@ -83,14 +106,171 @@ repo_schema = {Required('type'): str,
                Required('name'): str,
                Extra: object}
 
-schema = Schema({
+settings_schema = {
+    'concurrency': All(int, Range(min=1)),
+    'limits': limits_schema,
+    'lock': lock_schema,
+    'metrics': {Required('textfile'): str},
+    'profile': profile_schema,
+}
+
+schema = Schema(dict(settings_schema, **{
     Required('repos',
              default=[default_repo_config]): [repo_schema],
     Required('sources'): All([plugin_schema], Length(1)),
     Required('notifications',
              default=[default_notifications_config]): [plugin_schema],
+}))
+
+fragment_schema = Schema({
+    'include': [str],
+    'repos': [repo_schema],
+    'sources': [plugin_schema],
+    'notifications': [plugin_schema],
+    'templates': [template_schema],
 })
 
+# used for files that include fragments or have templates, either of which
+# may supply all the sources:
+including_schema = fragment_schema.extend(settings_schema)
+
+source_limits = Schema(source_limits_schema)
+
+#: The lists that are combined from all fragments.
+mergeable = 'repos', 'sources', 'notifications', 'templates'
+
+#: Top level keys that aren't lists of plugin configuration.
+not_plugins = 'include', 'templates'
+
+
+def fragment_cache_path():
+    """
+    The default path at which parsed fragments are cached between runs.
+    """
+    return cache_path('fragments.marshal')
+
+
+class FragmentCache(object):
+    """
+    Parsed and validated fragments, keyed by the real path of the file they
+    came from. An entry is used if the file's size and modification time
+    are unchanged or, failing that, if its content hashes the same.
+
+    If a path is supplied, the cache is read from there when first used
+    and :meth:`save` writes it back, so that only fragments that have
+    changed since the last run need validating again. A cache written by
+    a different version of archivist is ignored.
+    """
+
+    def __init__(self, path=None, version=None):
+        self.path = path
+        self.version = version
+        self.entries = None
+        self.used = set()
+        self.changed = False
+
+    def load(self):
+        self.entries = {}
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'rb') as source:
+                cache = marshal.load(source)
+        except (IOError, EOFError, ValueError, TypeError):
+            return
+        if isinstance(cache, dict) and cache.get('version') == self.version:
+            self.entries = cache['entries']
+
+    def get(self, path, stat, hash=None):
+        """
+        Return the cached data for the supplied path, or ``None`` if there
+        isn't any for its current content.
+        When no hash is supplied, only the size and modification time are
+        compared.
+        """
+        if self.entries is None:
+            self.load()
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        size, mtime, entry_hash, data = entry
+        if (size, mtime) == (stat.st_size, stat.st_mtime):
+            pass
+        elif hash is not None and hash == entry_hash:
+            self.set(path, stat, hash, data)
+        else:
+            return None
+        self.used.add(path)
+        return data
+
+    def set(self, path, stat, hash, data):
+        if self.entries is None:
+            self.load()
+        if self.path is not None:
+            try:
+                marshal.dumps(data)
+            except ValueError:
+                logger.warning('not caching %s as it contains values that '
+                               'cannot be stored', path)
+                return
+        self.entries[path] = (stat.st_size, stat.st_mtime, hash, data)
+        self.used.add(path)
+        self.changed = True
+
+    def save(self):
+        """
+        Store the entries used since the cache was loaded, ignoring any
+        problems doing so as the cache only saves time.
+        """
+        if self.path is None or self.entries is None:
+            return
+        if not self.changed and set(self.entries) == self.used:
+            return
+        entries = dict((path, entry) for path, entry in self.entries.items()
+                       if path in self.used)
+        directory = os.path.dirname(self.path)
+        temp_path = None
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temp_path = mkstemp(dir=directory, prefix='.fragments-')
+            with os.fdopen(fd, 'wb') as target:
+                marshal.dump(dict(version=self.version, entries=entries),
+                             target)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug('could not write fragment cache to %s: %s',
+                         self.path, e)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+class Merged(dict):
+    """
+    Configuration merged from included fragments, recording where each
+    entry in the lists that are combined came from.
+    """
+
+    def __init__(self, data):
+        super(Merged, self).__init__(data)
+        #: Maps ``(key, index)`` in the merged configuration to the path
+        #: of the fragment and the index within it of the entry.
+        self.origins = {}
+
+
+@contextmanager
+def error_source(source):
+    """
+    Attribute any :class:`ConfigError` raised within the block to the
+    supplied file, if there is one.
+    """
+    try:
+        yield
+    except ConfigError as e:
+        if source is not None and e.source is None:
+            e.source = source
+        raise
+
 
 class Config(object):
 
@@ -98,9 +278,26 @@ class Config(object):
         self.repos = {}
         self.sources = []
         self.notifications = []
+        self.limits = {}
+        self.lock = {}
+        self.metrics = {}
+        self.profile = {}
+        self.concurrency = 1
 
     @staticmethod
-    def check_schema(raw, schema=schema, path=None):
+    def check_schema(raw, schema=schema, path=None, validator=None):
+        """
+        Validate the supplied config using a validator compiled from the
+        schema, only falling back to the schema itself to find out what's
+        wrong when that fails.
+        """
+        if validator is None:
+            validator = validator_for(schema)
+        if validator is not None:
+            try:
+                return validator(raw)
+            except Mismatch:
+                pass
         try:
             return schema(raw)
         except MultipleInvalid as e:
@@ -116,7 +313,9 @@ class Config(object):
         - ``{'foo': ['bar', 'baz']}`` to
           ``{type: 'foo', 'name': None, 'value':['bar', 'baz']}``
         """
-        for values in data.values():
+        for key, values in data.items():
+            if key in not_plugins or not isinstance(values, list):
+                continue
             for index, value in enumerate(values):
                 if len(value) == 1:
                     key, value = value.items()[0]
@@ -165,17 +364,171 @@ class Config(object):
                 )
             seen[type_].add(name)
 
+    @staticmethod
+    def locate(data, key, index):
+        """
+        :return: The path of the fragment that the entry at the supplied
+                 index in the supplied list came from, or ``None`` if it
+                 came from the top level file, along with the path of the
+                 entry within that file.
+        """
+        origin = getattr(data, 'origins', {}).get((key, index))
+        if origin is None:
+            return None, [key, index]
+        source, index = origin
+        return source, [key, index]
+
     @classmethod
-    def parse(cls, source):
+    def locate_error(cls, e, data):
+        """
+        Point an error about a whole entry in one of the lists combined
+        from fragments at the fragment and entry it came from.
+        """
+        for key in mergeable:
+            for index, entry in enumerate(data.get(key, ())):
+                if entry is e.config:
+                    e.source, path = cls.locate(data, key, index)
+                    if e.source is not None:
+                        e.path = path
+                    return
+
+    @classmethod
+    def parse_fragment(cls, path, cache):
+        """
+        Parse and validate an included file, re-using the results from
+        any previous parsing of the same file with identical content.
+        """
+        real_path = os.path.realpath(path)
+        stat = os.stat(path)
+        data = cache.get(real_path, stat)
+        if data is None:
+            with open(path) as source:
+                content = source.read()
+            hash = sha1(content).hexdigest()
+            data = cache.get(real_path, stat, hash)
+            if data is None:
+                raw = yaml.load(content)
+                with error_source(path):
+                    data = cls.check_schema({} if raw is None else raw,
+                                            fragment_schema)
+                data = cls.normalise_plugin_config(data)
+                cache.set(real_path, stat, hash, data)
+        # the merged config may be changed by later checks:
+        return deepcopy(data)
+
+    @classmethod
+    def load_includes(cls, patterns, base, seen, cache):
+        """
+        Yield the path and data of each fragment matched by the supplied
+        patterns, including the fragments they include in turn.
+
+        Patterns are relative to the base directory and may be file names,
+        globs or directories, which include all the ``.yaml`` files in
+        them.
+        """
+        for pattern in patterns:
+            pattern = os.path.join(base, pattern)
+            if os.path.isdir(pattern):
+                paths = sorted(glob(os.path.join(pattern, '*.yaml')))
+            else:
+                paths = sorted(glob(pattern))
+                if not paths and not has_magic(pattern):
+                    raise ConfigError(
+                        'included file {!r} does not exist'.format(pattern),
+                        patterns
+                    )
+            for path in paths:
+                real_path = os.path.realpath(path)
+                if real_path in seen:
+                    raise ConfigError(
+                        '{!r} is included more than once'.format(path),
+                        patterns
+                    )
+                seen.add(real_path)
+                data = cls.parse_fragment(path, cache)
+                yield path, data
+                for included in cls.load_includes(data.get('include', ()),
+                                                  os.path.dirname(path),
+                                                  seen, cache):
+                    yield included
+
+    @classmethod
+    def merge_includes(cls, data, base, seen, cache):
+        """
+        Combine the plugins from all fragments included by the supplied data
+        with its own and apply the defaults that would apply to a config
+        without includes.
+        """
+        data = Merged(data)
+        for path, fragment in cls.load_includes(data.pop('include', ()),
+                                                base, seen, cache):
+            for key in mergeable:
+                if key not in fragment:
+                    continue
+                entries = data.setdefault(key, [])
+                for index, entry in enumerate(fragment[key]):
+                    data.origins[key, len(entries)] = path, index
+                    entries.append(entry)
+        if not data.get('repos'):
+            data['repos'] = [default_repo_config]
+        if not data.get('notifications'):
+            data['notifications'] = [default_notifications_config]
+        data.setdefault('sources', [])
+        if not (data['sources'] or data.get('templates')):
+            raise ConfigError('no sources configured', data)
+        return data
+
+    @classmethod
+    def expand_templates(cls, data):
+        """
+        Work out the parameters for each expansion of each template and
+        check the sources they expand into along with the other sources.
+        """
+        expanded = []
+        for template in data.get('templates', ()):
+            source = template['source']
+            source.setdefault('name', None)
+            template['parameters'] = parameter_sets(template)
+            for parameters in template['parameters']:
+                try:
+                    expanded.append(substitute(source, parameters))
+                except (KeyError, IndexError, ValueError) as e:
+                    raise ConfigError(
+                        'invalid template parameter: {}'.format(e), template
+                    )
+        cls.check_source_repos(dict(repos=data['repos'], sources=expanded))
+        for template in data.get('templates', ()):
+            # the default repo has been checked and is configured:
+            template['source'].setdefault('repo', default_repo_config['name'])
+        return expanded
+
+    @classmethod
+    def parse(cls, source, cache=None):
         """
         Read an open file into a valid, nested dict.
         Raises a :class:`ConfigError` if the data isn't valid.
+
+        :param cache: a :class:`FragmentCache` used for included files.
         """
+        if cache is None:
+            cache = FragmentCache()
         raw = yaml.load(source)
-        data = cls.check_schema(raw)
-        data = cls.normalise_plugin_config(data)
-        cls.check_source_repos(data)
-        cls.check_source_names(data)
+        if isinstance(raw, dict) and ('include' in raw or 'templates' in raw):
+            data = cls.check_schema(raw, including_schema)
+            data = cls.normalise_plugin_config(data)
+            path = os.path.abspath(getattr(source, 'name', 'config.yaml'))
+            data = cls.merge_includes(data, os.path.dirname(path),
+                                      set([os.path.realpath(path)]), cache)
+        else:
+            data = cls.check_schema(raw)
+            data = cls.normalise_plugin_config(data)
+        try:
+            cls.check_source_repos(data)
+            expanded = cls.expand_templates(data)
+            cls.check_source_names(dict(sources=data['sources']+expanded))
+        except ConfigError as e:
+            cls.locate_error(e, data)
+            raise
         return data
 
     @staticmethod
@@ -203,6 +556,13 @@ class Config(object):
         Raises a :class:`ConfigError` if the plugins can't be found.
         """
         config = Config()
+        config.limits = config_data.get('limits', {})
+        config.lock = config_data.get('lock', {})
+        config.metrics = config_data.get('metrics', {})
+        config.profile = config_data.get('profile', {})
+        config.concurrency = config_data.get('concurrency', 1)
+        repo_configs = {}
+        repo_sources = {}
         for plugin_type_p, plugin_abc in (
                 ('repos', Repo),
                 ('sources', Source),
@@ -214,33 +574,128 @@ class Config(object):
                     config_data[plugin_type_p]
             ):
 
-                config_path = [plugin_type_p, plugin_index]
+                source, config_path = cls.locate(config_data, plugin_type_p,
+                                                 plugin_index)
 
                 plugin_name = plugin_config['type']
 
-                plugin_class = cls.load_plugin(plugins,
-                                               plugin_type, plugin_name,
-                                               plugin_config, plugin_abc)
-                plugin_config = cls.check_schema(plugin_config,
-                                                 plugin_class.schema,
-                                                 config_path)
+                with error_source(source):
+                    plugin_class = cls.load_plugin(plugins,
+                                                   plugin_type, plugin_name,
+                                                   plugin_config, plugin_abc)
+
+                    limits = None
+                    if plugin_type_p == 'sources':
+                        plugin_config, limits = cls.split_limits(
+                            plugin_config, config_path
+                        )
+
+                    plugin_config = cls.check_schema(plugin_config,
+                                                     plugin_class.schema,
+                                                     config_path,
+                                                     plugin_class.validator())
 
                 plugin = plugin_class(**plugin_config)
+                if plugin_type_p == 'sources':
+                    plugin.config = plugin_config
+                if limits is not None:
+                    plugin.limits = limits
                 store = getattr(config, plugin_type_p)
                 if plugin_type_p == 'repos':
                     store[plugin_config['name']] = plugin
+                    repo_configs[plugin_config['name']] = plugin_config
+                    repo_sources[plugin_config['name']] = source
                 else:
                     store.append(plugin)
 
+        for index, template in enumerate(config_data.get('templates', ())):
+            source, config_path = cls.locate(config_data, 'templates', index)
+            with error_source(source):
+                config.sources.extend(cls.realise_template(
+                    template, plugins, config_path + ['source']
+                ))
+
+        for name, repo in sorted(config.repos.items()):
+            problem = repo.check_sources([s for s in config.sources
+                                          if s.repo == name])
+            if problem is not None:
+                raise ConfigError(problem, repo_configs[name],
+                                  source=repo_sources[name])
+
         return config
 
     @classmethod
-    def load(cls, source, plugins):
+    def split_limits(cls, plugin_config, config_path):
+        """
+        Separate and check any limits in a source's config.
+        """
+        limits = None
+        if 'limits' in plugin_config:
+            plugin_config = dict(plugin_config)
+            limits = cls.check_schema(plugin_config.pop('limits'),
+                                      source_limits,
+                                      config_path + ['limits'])
+        return plugin_config, limits
+
+    @classmethod
+    def realise_template(cls, template, plugins, config_path):
+        """
+        Return a list of the sources a template expands into.
+
+        The first expansion is checked against the plugin's schema in full.
+        After that, only the values of keys that contain parameters are
+        checked, so the cost of an expansion doesn't depend on the size of
+        the plugin's schema.
+        """
+        source = template['source']
+        plugin_class = cls.load_plugin(plugins, 'source', source['type'],
+                                       source, Source)
+        keys = parameterised_keys(source)
+        validated = validators = None
+        sources = []
+        for parameters in template['parameters']:
+            plugin_config, limits = cls.split_limits(
+                substitute(source, parameters), config_path
+            )
+            if validators is None:
+                plugin_config = validated = cls.check_schema(
+                    plugin_config, plugin_class.schema, config_path,
+                    plugin_class.validator()
+                )
+                validators = key_validators(plugin_class.schema, keys)
+            else:
+                raw = plugin_config
+                plugin_config = deepcopy(validated)
+                for key in keys:
+                    if key not in raw:
+                        continue
+                    try:
+                        plugin_config[key] = validators[key](raw[key])
+                    except MultipleInvalid as e:
+                        for error in e.errors:
+                            error.path = [key] + error.path
+                        raise ConfigError(e.errors, raw, config_path)
+            plugin = plugin_class(**plugin_config)
+            plugin.config = plugin_config
+            if limits is not None:
+                plugin.limits = limits
+            sources.append(plugin)
+        return sources
+
+    @classmethod
+    def load(cls, source, plugins, cache=None):
         """
         Create a :class:`Config` from a source file object and a
         :class:`Plugins` registry.
+
+        :param cache: an optional :class:`FragmentCache` for included files,
+                      which is saved once the whole config is valid.
         """
-        return cls.realise(cls.parse(source), plugins)
+        if cache is None:
+            cache = FragmentCache()
+        config = cls.realise(cls.parse(source, cache), plugins)
+        cache.save()
+        return config
 
     def repo_for(self, source):
         return self.repos[source.repo]
@@ -1,12 +1,135 @@
+from errno import ENXIO, EINVAL, EEXIST
+from hashlib import sha1
 import os
+from stat import S_ISLNK
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen, PIPE
+from threading import BoundedSemaphore, Thread, Timer
 
 from voluptuous import Invalid
 
+from archivist.limits import LimitExceeded
+
 
 def ensure_dir_exists(directory):
     if not os.path.exists(directory):
-        os.makedirs(directory)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            # another thread or process may have just created it
+            if e.errno != EEXIST or not os.path.isdir(directory):
+                raise
+
+
+# Linux values, for Pythons that don't provide them:
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+chunk_size = 1024 * 1024
+
+
+def copy_range(source_fd, target_fd, start, end=None):
+    """
+    Copy bytes from ``start`` up to ``end``, or the end of the file if
+    ``end`` is ``None``, from one file descriptor to the same position
+    in another.
+    """
+    os.lseek(source_fd, start, os.SEEK_SET)
+    os.lseek(target_fd, start, os.SEEK_SET)
+    while end is None or start < end:
+        size = chunk_size if end is None else min(chunk_size, end - start)
+        data = os.read(source_fd, size)
+        if not data:
+            break
+        os.write(target_fd, data)
+        start += len(data)
+
+
+def data_ranges(fd, size):
+    """
+    Yield ``(start, end)`` for each region of the file that contains data,
+    skipping holes. If the filesystem can't report holes, the whole file is
+    treated as data.
+    """
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == ENXIO:
+                # only a hole left
+                return
+            if e.errno == EINVAL and offset == 0:
+                yield 0, size
+                return
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield start, end
+        offset = end
+
+
+def copy_file(source_path, target_path, stat=None):
+    """
+    Copy the contents of one file to another in chunks.
+    If the source file is sparse, the holes are kept in the copy.
+    """
+    if stat is None:
+        stat = os.stat(source_path)
+    source_fd = os.open(source_path, os.O_RDONLY)
+    try:
+        target_fd = os.open(target_path,
+                            os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        try:
+            if stat.st_blocks * 512 < stat.st_size:
+                for start, end in data_ranges(source_fd, stat.st_size):
+                    copy_range(source_fd, target_fd, start, end)
+                os.ftruncate(target_fd, stat.st_size)
+            else:
+                copy_range(source_fd, target_fd, 0)
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+
+
+def mtime_matches(path, mtime):
+    """
+    Check whether the file at the supplied path exists and has the supplied
+    modification time, to within the microsecond precision that
+    :func:`os.utime` can set.
+    """
+    try:
+        return abs(os.stat(path).st_mtime - mtime) < 0.000001
+    except OSError:
+        return False
+
+
+def blob_hash(content):
+    """
+    Return the hash that git gives the supplied content.
+    """
+    return sha1('blob %d\0%s' % (len(content), content)).hexdigest()
+
+
+def content_hash(path, stat=None):
+    """
+    Return the hash that git gives the content at the supplied path,
+    which is the target of the link for symlinks.
+    This means files can be compared with committed versions without
+    reading anything out of the repo.
+    """
+    if stat is None:
+        stat = os.lstat(path)
+    if S_ISLNK(stat.st_mode):
+        return blob_hash(os.readlink(path))
+    hash = sha1('blob %d\0' % stat.st_size)
+    with open(path, 'rb') as source:
+        while True:
+            data = source.read(chunk_size)
+            if not data:
+                break
+            hash.update(data)
+    return hash.hexdigest()
 
 
 class CalledProcessError(Exception):
@@ -31,15 +154,129 @@ class CalledProcessError(Exception):
             "{stderr}\n".format(**self.__dict__))
 
 
-def run(command, cwd=None, shell=False):
-    process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd, shell=shell)
-    out, err = process.communicate()
+#: The most external commands that will be run at once, across all threads.
+max_commands = 8
+
+command_slots = BoundedSemaphore(max_commands)
+
+
+class Killer(object):
+    """
+    Kill a process if it is still running after the supplied timeout.
+    """
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.killed = False
+        self.timer = None
+        if timeout is not None:
+            self.timer = Timer(timeout, self.kill)
+            self.timer.start()
+
+    def kill(self):
+        self.killed = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+def check_timeout(command, timeout):
+    if timeout is not None and timeout <= 0:
+        raise LimitExceeded('no time left to run {!r}'.format(command))
+
+
+def run(command, cwd=None, shell=False, timeout=None):
+    check_timeout(command, timeout)
+    with command_slots:
+        process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd,
+                        shell=shell)
+        killer = Killer(process, timeout)
+        try:
+            out, err = process.communicate()
+        finally:
+            killer.cancel()
+    if killer.killed:
+        raise LimitExceeded('{!r} took longer than {}s'.format(
+            command, timeout
+        ))
     if err or process.returncode:
         raise CalledProcessError(command, process.returncode,
                                  out, err)
     return out
 
 
+def run_all(commands, cwd=None, timeout=None):
+    """
+    Run several independent commands at once, as :func:`run` would.
+
+    :return: A list of the output of each command, in the order the
+             commands were supplied. If any fail, the error from the first
+             of those is raised once all the commands have finished.
+    """
+    if len(commands) < 2:
+        return [run(command, cwd, timeout=timeout) for command in commands]
+    pool = ThreadPool(min(len(commands), max_commands))
+    try:
+        results = [pool.apply_async(run, (command, cwd, False, timeout))
+                   for command in commands]
+        errors = []
+        outputs = []
+        for result in results:
+            try:
+                outputs.append(result.get())
+            except (CalledProcessError, LimitExceeded, OSError) as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return outputs
+    finally:
+        pool.close()
+        pool.join()
+
+
+def iter_lines(command, cwd=None, timeout=None):
+    """
+    Run a command, yielding each line of its output as soon as it is
+    written so that large outputs don't have to be held in memory.
+    Errors are reported as :func:`run` would, once the output is
+    exhausted; the :attr:`~CalledProcessError.stdout` of any
+    :class:`CalledProcessError` will be empty.
+    """
+    check_timeout(command, timeout)
+    with command_slots:
+        process = Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd)
+        killer = Killer(process, timeout)
+        # stderr is read in the background so the command can't block
+        # writing to it while we're reading its output:
+        errors = []
+        reader = Thread(target=lambda: errors.append(process.stderr.read()))
+        reader.start()
+        try:
+            for line in iter(process.stdout.readline, b''):
+                yield line
+            process.stdout.close()
+            reader.join()
+            process.wait()
+        finally:
+            killer.cancel()
+            if process.returncode is None:
+                killer.kill()
+                process.wait()
+            reader.join()
+    if killer.killed:
+        raise LimitExceeded('{!r} took longer than {}s'.format(
+            command, timeout
+        ))
+    err = errors[0] if errors else b''
+    if err or process.returncode:
+        raise CalledProcessError(command, process.returncode, b'', err)
+
+
 def absolute_path(value):
     if not os.path.exists(value):
         raise Invalid('%r does not exist' % value)
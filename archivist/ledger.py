@@ -0,0 +1,171 @@
+import sqlite3
+
+#: The name of the file, within a repo's path, that holds its ledger.
+ledger_name = '.archivist-ledger.sqlite'
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sources (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    duration REAL NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    changes INTEGER NOT NULL,
+    skipped INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'ok'
+);
+"""
+
+#: Changes made to ledgers created before the status of each source was
+#: recorded, as ``(column, statements)``.
+migrations = [
+    ('status', """
+ALTER TABLE sources ADD COLUMN status TEXT NOT NULL DEFAULT 'ok';
+UPDATE sources SET status = 'skipped' WHERE skipped = 1;
+"""),
+]
+
+indexes = """
+-- history queries for one source only read that source's most recent
+-- completed rows:
+DROP INDEX IF EXISTS sources_by_run;
+CREATE INDEX IF NOT EXISTS sources_by_status
+    ON sources (type, name, status, run);
+"""
+
+#: The columns recorded for each source in each run.
+source_columns = 'type', 'name', 'duration', 'files', 'bytes', 'changes', \
+                 'skipped', 'status'
+
+#: The status of a source that was processed to completion.
+status_ok = 'ok'
+#: The status of a source that was skipped as unchanged.
+status_skipped = 'skipped'
+#: The status of a source that was stopped by one of its limits.
+status_aborted = 'aborted'
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle-1] + values[middle]) / 2.0
+
+
+class Trend(object):
+    """
+    How the most recent run of a source compares with the runs before it.
+    """
+
+    def __init__(self, type, name, history, threshold):
+        #: The type of the source.
+        self.type = type
+        #: The name of the source, or an empty string if it has none.
+        self.name = name
+        #: The number of runs the baseline was taken from.
+        self.runs = len(history) - 1
+        latest = history[0] if history else None
+        #: The duration of the most recent run, if any.
+        self.duration = latest['duration'] if latest else None
+        #: The files examined by the most recent run, if any.
+        self.files = latest['files'] if latest else None
+        #: The bytes copied by the most recent run, if any.
+        self.bytes = latest['bytes'] if latest else None
+        #: The median duration of the runs before the most recent one.
+        self.baseline = None
+        if self.runs > 0:
+            self.baseline = median(row['duration'] for row in history[1:])
+        #: ``True`` if the most recent run took more than the threshold
+        #: times the baseline.
+        self.regressed = bool(self.baseline and
+                              self.duration > self.baseline * threshold)
+
+    def __str__(self):
+        label = '{} source {!r}'.format(self.type, self.name or None)
+        if self.duration is None:
+            return label + ': no runs recorded'
+        text = '{}: {:.2f}s, {} files, {:.1f} MB'.format(
+            label, self.duration, self.files, self.bytes / 1e6
+        )
+        if self.baseline is not None:
+            text += ', typically {:.2f}s over {} runs'.format(
+                self.baseline, self.runs
+            )
+        if self.regressed:
+            text += ', REGRESSED'
+        return text
+
+
+class Ledger(object):
+    """
+    An append-only record of runs and the sources processed in them, kept
+    in an SQLite database at the supplied path.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(schema)
+        columns = set(row['name'] for row in self.connection.execute(
+            'PRAGMA table_info(sources)'
+        ))
+        for column, statements in migrations:
+            if column not in columns:
+                self.connection.executescript(statements)
+        self.connection.executescript(indexes)
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, started, duration, sources):
+        """
+        Record a run.
+
+        :param sources: a sequence of dicts with a value for each of
+                        :data:`source_columns`.
+        :return: The id of the run.
+        """
+        with self.connection:
+            cursor = self.connection.execute(
+                'INSERT INTO runs (started, duration) VALUES (?, ?)',
+                (started, duration)
+            )
+            run = cursor.lastrowid
+            self.connection.executemany(
+                'INSERT INTO sources (run, {}) VALUES (?, {})'.format(
+                    ', '.join(source_columns),
+                    ', '.join('?' for _ in source_columns)
+                ),
+                [(run, ) + tuple(source[column] for column in source_columns)
+                 for source in sources]
+            )
+        return run
+
+    def history(self, type, name, runs):
+        """
+        :return: A list of rows for the most recent runs of the supplied
+                 source in which it was processed to completion, newest
+                 first.
+        """
+        return self.connection.execute(
+            'SELECT * FROM sources WHERE type = ? AND name = ? '
+            'AND status = ? ORDER BY run DESC LIMIT ?',
+            (type, name, status_ok, runs)
+        ).fetchall()
+
+    def trend(self, type, name, runs=10, threshold=2.0):
+        """
+        Compare the most recent run of a source with up to the supplied
+        number of runs before it.
+
+        :return: A :class:`Trend`.
+        """
+        return Trend(type, name, self.history(type, name, runs+1),
+                     threshold)
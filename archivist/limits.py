@@ -0,0 +1,77 @@
+from logging import getLogger
+from time import time
+
+from voluptuous import Any
+
+logger = getLogger(__name__)
+
+number = Any(int, float)
+
+source_limits_schema = {
+    'timeout': number,
+    'max_files': int,
+    'max_file_size': int,
+}
+
+limits_schema = dict(source_limits_schema, run_timeout=number)
+
+
+class LimitExceeded(Exception):
+    """
+    Raised when a source goes over one of its limits.
+    """
+
+
+class Budget(object):
+    """
+    Tracks the time and files used by a source against its limits.
+
+    :param timeout: number of seconds the source may run for.
+    :param max_files: maximum number of files the source may read.
+    :param max_file_size: size in bytes above which files will be skipped.
+    :param deadline: absolute time after which the source must stop,
+                     regardless of its own timeout.
+    """
+
+    def __init__(self, timeout=None, max_files=None, max_file_size=None,
+                 deadline=None):
+        if timeout is not None:
+            timeout_deadline = time() + timeout
+            if deadline is None or timeout_deadline < deadline:
+                deadline = timeout_deadline
+        self.deadline = deadline
+        self.max_files = max_files
+        self.max_file_size = max_file_size
+        self.files = 0
+
+    def remaining(self):
+        """
+        The number of seconds left, or ``None`` if there is no time limit.
+        """
+        if self.deadline is None:
+            return None
+        return self.deadline - time()
+
+    def check(self):
+        """
+        Raise :class:`LimitExceeded` if the time available has run out.
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise LimitExceeded('ran out of time')
+
+    def file(self, path, size):
+        """
+        Account for a file that is about to be read.
+
+        :return: ``False`` if the file is too big and should be skipped.
+        """
+        self.check()
+        self.files += 1
+        if self.max_files is not None and self.files > self.max_files:
+            raise LimitExceeded('more than {} files'.format(self.max_files))
+        if self.max_file_size is not None and size > self.max_file_size:
+            logger.warning('skipping %s as it is larger than %s bytes',
+                           path, self.max_file_size)
+            return False
+        return True
@@ -0,0 +1,130 @@
+from errno import EAGAIN, EACCES
+from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+import os
+from socket import gethostname
+from time import time, sleep
+
+from voluptuous import Any, Required
+
+from archivist.limits import number
+
+lock_schema = {
+    Required('mode', default='skip'): Any('wait', 'skip'),
+    'timeout': number,
+    'stale_after': number,
+}
+
+#: The name of the lock file created in the root of each repo.
+lock_name = '.archivist-lock'
+
+
+class Locked(Exception):
+    """
+    Raised when a lock cannot be obtained.
+    """
+
+    #: ``True`` if the holder has had the lock for longer than expected.
+    stale = False
+
+
+class RepoLock(object):
+    """
+    An exclusive ``flock`` on a lock file that records the host, process id
+    and start time of the run that holds it.
+
+    :param path: the path of the lock file.
+    :param mode: what to do if another run holds the lock:
+                 ``'wait'`` for it to be released or ``'skip'`` the repo.
+    :param timeout: number of seconds to wait before giving up.
+    :param stale_after: number of seconds after which a holder is considered
+                        stale. The lock is never taken from a stale holder,
+                        as the ``flock`` is released as soon as its process
+                        exits, so a holder that is still there is alive and
+                        may still be writing; it is reported instead.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, path, mode='skip', timeout=None, stale_after=None):
+        self.path = path
+        self.mode = mode
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.fd = None
+
+    def _try_lock(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            flock(fd, LOCK_EX | LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (EAGAIN, EACCES):
+                return None
+            raise
+        return fd
+
+    def holder(self):
+        """
+        Return the ``(host, pid, started)`` recorded by the current holder
+        of the lock or ``None`` if this can't be read.
+        """
+        try:
+            with open(self.path) as lock_file:
+                host, pid, started = lock_file.read().split()
+            return host, int(pid), float(started)
+        except (IOError, ValueError):
+            return None
+
+    def stale(self, holder):
+        if holder is None or self.stale_after is None:
+            return False
+        return time() - holder[2] > self.stale_after
+
+    @staticmethod
+    def describe(holder):
+        if holder is None:
+            return 'an unknown process'
+        host, pid, started = holder
+        return 'process {} on {}, which took it {:.0f}s ago'.format(
+            pid, host, time() - started
+        )
+
+    def locked(self, message):
+        """
+        Return a :class:`Locked` describing the current holder of the lock.
+        """
+        holder = self.holder()
+        message += ' by ' + self.describe(holder)
+        if not self.stale(holder):
+            return Locked(message)
+        e = Locked(message + ', longer than the {}s after which it is stale'
+                   .format(self.stale_after))
+        e.stale = True
+        return e
+
+    def acquire(self):
+        """
+        Obtain the lock, raising :class:`Locked` if this isn't possible.
+        """
+        start = time()
+        while True:
+            self.fd = self._try_lock()
+            if self.fd is not None:
+                os.ftruncate(self.fd, 0)
+                os.write(self.fd, '{} {} {!r}\n'.format(
+                    gethostname(), os.getpid(), time()
+                ))
+                return
+            if self.mode != 'wait':
+                raise self.locked('{} is locked'.format(self.path))
+            if self.timeout is not None and time() - start >= self.timeout:
+                raise self.locked('{} is still locked after {}s'.format(
+                    self.path, self.timeout
+                ))
+            sleep(self.poll_interval)
+
+    def release(self):
+        if self.fd is not None:
+            flock(self.fd, LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -1,22 +1,87 @@
 from argparse import ArgumentParser, FileType
+from functools import partial
+from glob import glob
+from hashlib import sha1
+from inspect import getargspec
+import json
 import logging
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import os
+import sqlite3
+import sys
+from time import time
 
-from .config import Config, ConfigError, default_repo_config
-from .plugins import Plugins
+from yaml import YAMLError
+
+from .config import (
+    Config, ConfigError, FragmentCache, default_repo_config,
+    fragment_cache_path
+)
+from .ledger import Ledger, status_aborted, status_ok, status_skipped
+from .limits import Budget, LimitExceeded
+from .lock import RepoLock, Locked
+from .metrics import metrics
+from .plugins import Plugins, snapshot_path
+from .preview import preview
+from .profiling import Profiler, disabled
+from .progress import Progress, previous_count, record_count
 
 logger = logging.getLogger(__name__)
 
-def parse_command_line():
+def parse_command_line(version=None):
     parser = ArgumentParser()
+    parser.add_argument('--version', action='version',
+                        version=version or 'unknown')
     parser.add_argument('config',
                         help='Absolute path to the yaml config file',
                         default=default_repo_config['path'] + '/config.yaml',
                         type=FileType('r'),
                         nargs='?')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare the live state with what was last '
+                             'recorded, without copying anything, and '
+                             'print a Nagios-style status line.')
+    parser.add_argument('--profile', metavar='DIRECTORY',
+                        help='Profile the run, writing the results to the '
+                             'supplied directory. Other profiling options '
+                             'are taken from the config file.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Report what a run would change without '
+                             'changing anything. Exits with status 1 if '
+                             'there are changes.')
     args = parser.parse_args()
     return args
 
 
+def parse_validate_command_line(argv):
+    parser = ArgumentParser(prog='archivist validate')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='A config file to validate, or a directory '
+                             'whose *.yaml files should all be validated.')
+    parser.add_argument('--jobs', type=int, default=cpu_count(),
+                        help='The number of processes used to validate '
+                             'files, defaults to the number of CPUs.')
+    return parser.parse_args(argv)
+
+
+def parse_stats_command_line(argv):
+    parser = ArgumentParser(prog='archivist stats')
+    parser.add_argument('config',
+                        help='Absolute path to the yaml config file',
+                        default=default_repo_config['path'] + '/config.yaml',
+                        type=FileType('r'),
+                        nargs='?')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='The number of previous runs to compare the '
+                             'most recent run of each source with.')
+    parser.add_argument('--threshold', type=float, default=2.0,
+                        help='Report a source as regressed if its most '
+                             'recent run took more than this many times '
+                             'as long as is typical.')
+    return parser.parse_args(argv)
+
+
 class HandleKnownExceptions(object):
 
     def __enter__(self):
@@ -64,22 +129,563 @@ class SafeNotifications(object):
         return True
 
 
+def limits_for(source, limits):
+    """
+    Combine the run-wide limits with the supplied source's own limits.
+    """
+    source_limits = dict((key, value) for key, value in limits.items()
+                         if key != 'run_timeout')
+    source_limits.update(source.limits)
+    return source_limits
+
+
+def budget_for(source, limits, deadline):
+    """
+    Create a :class:`~archivist.limits.Budget` for the supplied source
+    from the run-wide limits, the source's own limits and the run deadline.
+    """
+    return Budget(deadline=deadline, **limits_for(source, limits))
+
+
+def settings_hash(source, limits):
+    """
+    Return a hash of the configuration and limits that decide what the
+    supplied source records, so that changing them stops the source being
+    skipped as unchanged. The timeout is left out, as a run that hits it
+    is never recorded.
+    """
+    source_limits = limits_for(source, limits)
+    source_limits.pop('timeout', None)
+    settings = json.dumps(dict(config=source.config, limits=source_limits),
+                          sort_keys=True, default=repr)
+    return sha1(settings.encode('utf-8')).hexdigest()
+
+
+def repo_path(repo, source, create=True):
+    """
+    Return the path the supplied repo uses for the supplied source.
+
+    :param create: if false, the repo is asked not to create anything.
+                   Repos whose :meth:`~archivist.plugins.Repo.path_for`
+                   predates this option are called as they always were.
+    """
+    if create:
+        return repo.path_for(source)
+    spec = getargspec(repo.path_for)
+    if 'create' in spec.args or spec.keywords is not None:
+        return repo.path_for(source, create=False)
+    return repo.path_for(source)
+
+
+def lock_repos(config):
+    """
+    Lock each repo so that overlapping runs don't write to it at once.
+
+    :return: A dict mapping the names of the repos this run may use to
+             their locks.
+    """
+    locks = {}
+    for name, repo in sorted(config.repos.items()):
+        path = repo.lock_path()
+        if path is None:
+            locks[name] = None
+            continue
+        lock = RepoLock(path, **config.lock)
+        try:
+            lock.acquire()
+        except Locked as e:
+            # another run is already doing the work, unless we gave up
+            # waiting for it or it has been doing it for far too long:
+            if e.stale:
+                level = logging.ERROR
+            elif lock.mode == 'wait':
+                level = logging.WARNING
+            else:
+                level = logging.INFO
+            logger.log(level, 'skipping repo %r: %s', name, e)
+        else:
+            locks[name] = lock
+    return locks
+
+
+def process_source(config, source, deadline, dry_run=False,
+                   profiler=disabled, fingerprints=None):
+    """
+    Process one source, logging rather than raising if it goes over its
+    limits.
+
+    :return: A list of ``(change, path)`` for the changes found when
+             doing a dry run.
+    """
+    changes = []
+    source.budget = budget_for(source, config.limits, deadline)
+    labels = dict(type=source.type, name=source.name or '')
+    start = time()
+    with metrics.context(**labels):
+        for name in ('files_copied', 'bytes_copied', 'files_deleted',
+                     'aborted'):
+            metrics.set('archivist_source_'+name, 0)
+        try:
+            source.budget.check()
+            repo = config.repo_for(source)
+            path = repo_path(repo, source, create=not dry_run)
+            fingerprint = None
+            if not dry_run:
+                fingerprint = source.fingerprint()
+            if fingerprint is not None:
+                fingerprint = settings_hash(source, config.limits), \
+                              fingerprint
+            if fingerprint is not None and \
+                    source.previous_fingerprint(path) == repr(fingerprint):
+                logger.debug('%s source %r unchanged, skipping',
+                             source.type, source.name)
+                metrics.set('archivist_source_skipped', 1)
+            else:
+                metrics.set('archivist_source_skipped', 0)
+                source.progress = Progress(source, config.notifications,
+                                           previous_count(path))
+                try:
+                    with profiler.source(source):
+                        if dry_run:
+                            previewed = preview(source, path)
+                            if previewed is None:
+                                logger.warning(
+                                    '%s source %r does not support dry runs',
+                                    source.type, source.name
+                                )
+                            else:
+                                changes.extend(previewed)
+                        else:
+                            source.process(path)
+                finally:
+                    # the final report goes out even if the source stopped:
+                    source.progress.finish()
+                if source.progress.files and not dry_run:
+                    record_count(path, source.progress.files)
+                if fingerprint is not None and fingerprints is not None:
+                    fingerprints[source] = path, fingerprint
+        except LimitExceeded as e:
+            logger.error('%s source %r aborted: %s',
+                         source.type, source.name, e)
+            metrics.set('archivist_source_aborted', 1)
+        metrics.set('archivist_source_duration_seconds', time()-start)
+        metrics.set('archivist_source_files_scanned', source.budget.files)
+    return changes
+
+
+def process_sources(config, repos=None, dry_run=False, profiler=disabled,
+                    fingerprints=None):
+    """
+    Process each source, aborting any that go over their limits
+    without stopping the others.
+
+    If the configured concurrency is more than one, sources that are
+    :attr:`~archivist.plugins.Source.concurrent` are processed by a pool
+    of that many threads while the other sources are processed in turn.
+
+    :param repos: if supplied, only sources using repos with these names
+                  are processed.
+    :param dry_run: if true, what sources would record is compared with
+                    their archives and nothing is written.
+    :param profiler: a :class:`~archivist.profiling.Profiler` used to
+                     profile selected sources.
+    :param fingerprints: if supplied, the fingerprint of each source that
+                         is processed to completion is added to this dict
+                         as ``(path, fingerprint)``, keyed by the source,
+                         so it can be recorded once its repo's actions
+                         have succeeded.
+
+    :return: A list of ``(change, path)`` for the changes found when
+             doing a dry run.
+    """
+    deadline = None
+    run_timeout = config.limits.get('run_timeout')
+    if run_timeout is not None:
+        deadline = time() + run_timeout
+
+    pool = None
+    if config.concurrency > 1:
+        pool = ThreadPool(config.concurrency)
+
+    results = []
+    try:
+        for source in config.sources:
+            if repos is not None and source.repo not in repos:
+                continue
+            args = (config, source, deadline, dry_run, profiler,
+                    fingerprints)
+            if pool is not None and source.concurrent:
+                results.append(pool.apply_async(process_source, args))
+            else:
+                results.append(process_source(*args))
+        changes = []
+        for result in results:
+            if pool is not None and not isinstance(result, list):
+                result = result.get()
+            changes.extend(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return changes
+
+
+def check_sources(config):
+    """
+    Compare the live state recorded by each source that supports checking
+    with what its repo last recorded.
+
+    :return: A tuple of the number of items checked, a list of
+             ``(change, item)`` for those that have drifted, a list of
+             descriptions of problems that stopped sources being checked
+             and a list of descriptions of the sources that couldn't be
+             checked.
+    """
+    checked = 0
+    changes = []
+    problems = []
+    unchecked = []
+    deadline = None
+    run_timeout = config.limits.get('run_timeout')
+    if run_timeout is not None:
+        deadline = time() + run_timeout
+
+    for source in config.sources:
+        source.budget = budget_for(source, config.limits, deadline)
+        try:
+            repo = config.repo_for(source)
+            path = repo_path(repo, source, create=False)
+            committed = repo.committed(path)
+            result = None
+            if committed is not None:
+                result = source.check(path, committed,
+                                      partial(repo.read_committed, path))
+        except LimitExceeded as e:
+            problems.append('{} source {!r} aborted: {}'.format(
+                source.type, source.name, e
+            ))
+            continue
+        if result is None:
+            unchecked.append('{} source {!r}'.format(source.type,
+                                                     source.name))
+        else:
+            source_checked, source_changes = result
+            checked += source_checked
+            changes.extend(source_changes)
+    return checked, changes, problems, unchecked
+
+
+def report_check(checked, changes, problems, unchecked, duration):
+    """
+    Print the results of a check in the format used by Nagios plugins and
+    exit with the matching status.
+    Sources that couldn't be checked are a warning rather than OK, as
+    their drift is unknown.
+    """
+    perfdata = 'checked={} drifted={} unchecked={} time={:.3f}s'.format(
+        checked, len(changes), len(unchecked), duration
+    )
+    if problems:
+        status, code, summary = 'UNKNOWN', 3, problems[0]
+    elif changes:
+        status, code = 'CRITICAL', 2
+        summary = '{} of {} drifted'.format(len(changes), checked)
+    elif unchecked:
+        status, code = 'WARNING', 1
+        summary = '{} checked, no drift, {} sources unchecked'.format(
+            checked, len(unchecked)
+        )
+    else:
+        status, code = 'OK', 0
+        summary = '{} checked, no drift'.format(checked)
+    print('ARCHIVIST {} - {} | {}'.format(status, summary, perfdata))
+    for problem in problems[1:]:
+        print(problem)
+    for source in unchecked:
+        print('unchecked: {}'.format(source))
+    for change, item in changes:
+        print('{}: {}'.format(change, item))
+    raise SystemExit(code)
+
+
+def source_record(source):
+    """
+    :return: A dict of what the last run recorded in the metrics for the
+             supplied source, as stored in a :class:`~archivist.ledger.Ledger`.
+    """
+    labels = dict(type=source.type, name=source.name or '')
+
+    def value(name):
+        return metrics.get('archivist_source_'+name, **labels) or 0
+
+    if value('aborted'):
+        status = status_aborted
+    elif value('skipped'):
+        status = status_skipped
+    else:
+        status = status_ok
+    return dict(labels,
+                duration=value('duration_seconds'),
+                files=value('files_scanned'),
+                bytes=value('bytes_copied'),
+                changes=value('files_copied') + value('files_deleted'),
+                skipped=value('skipped'),
+                status=status)
+
+
+def record_run(config, repos, started, duration):
+    """
+    Record the run in the ledger of each of the supplied repos that keeps
+    one, logging rather than raising if this goes wrong as the run itself
+    has already succeeded.
+    """
+    for name in sorted(repos):
+        repo = config.repos[name]
+        path = repo.ledger_path()
+        if path is None:
+            continue
+        sources = [source_record(source) for source in config.sources
+                   if source.repo == name]
+        try:
+            ledger = Ledger(path)
+            try:
+                ledger.record(started, duration, sources)
+            finally:
+                ledger.close()
+        except sqlite3.Error as e:
+            logger.warning('could not record run in %r: %s', path, e)
+
+
+def process(config, profiler=disabled):
+    """
+    Process the sources for each repo that can be locked, perform the
+    repo's actions and then record the run in the repo's ledger.
+
+    :return: ``True`` if every source was processed to completion, or
+             ``False`` if any were aborted or skipped because their repo
+             was locked.
+    """
+    start = time()
+    locks = lock_repos(config)
+    fingerprints = {}
+    try:
+        process_sources(config, locks, profiler=profiler,
+                        fingerprints=fingerprints)
+
+        for name, repo in config.repos.items():
+            if name in locks:
+                repo.actions()
+                # only now is what the sources recorded safely kept:
+                for source, (path, fingerprint) in fingerprints.items():
+                    if source.repo == name:
+                        source.record_fingerprint(path, fingerprint)
+
+        record_run(config, locks, start, time()-start)
+    finally:
+        for lock in locks.values():
+            if lock is not None:
+                lock.release()
+
+    for source in config.sources:
+        if source.repo not in locks or metrics.get(
+            'archivist_source_aborted',
+            type=source.type, name=source.name or ''
+        ):
+            return False
+    return True
+
+
+def write_textfile(path, duration):
+    """
+    Write the metrics for a run to the supplied textfile, logging rather
+    than raising if this isn't possible so that a successful run isn't
+    reported as a failure.
+    """
+    metrics.set('archivist_run_duration_seconds', duration)
+    try:
+        metrics.write(path)
+    except (IOError, OSError):
+        logger.exception('could not write metrics to %s', path)
+
+
+def report_changes(changes):
+    """
+    Print the changes found by a dry run, exiting with a non-zero status
+    if there were any.
+    """
+    for change, path in changes:
+        print('{}: {}'.format(change, path))
+    if changes:
+        raise SystemExit(1)
+
+
+def config_paths(paths):
+    """
+    Expand the supplied paths into a list of config files, replacing
+    directories with the ``*.yaml`` files they contain.
+    """
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded.extend(sorted(glob(os.path.join(path, '*.yaml'))))
+        else:
+            expanded.append(path)
+    return expanded
+
+
+#: The plugins used by :func:`validate_file` in worker processes.
+worker_plugins = None
+
+
+def set_worker_plugins(plugins):
+    global worker_plugins
+    worker_plugins = plugins
+
+
+def validate_file(path):
+    """
+    Load the config file at the supplied path using :data:`worker_plugins`.
+
+    :return: A tuple of the path and a description of what is wrong with
+             it, or ``None`` if it is valid.
+    """
+    try:
+        with open(path) as source:
+            Config.load(source, worker_plugins)
+    except (ConfigError, YAMLError, IOError) as e:
+        return path, '{}: {}'.format(type(e).__name__, e)
+    return path, None
+
+
+def validate(paths, plugins, jobs=1):
+    """
+    Validate many config files, using a pool of processes if more than one
+    job is requested.
+    Every plugin is imported before the pool is started so that each
+    process doesn't have to import them again.
+
+    :return: A list of the results of :func:`validate_file`, in the order
+             the paths were supplied.
+    """
+    for type, found in plugins.plugins.items():
+        for name in found:
+            plugins.get(type, name)
+    if jobs < 2 or len(paths) < 2:
+        set_worker_plugins(plugins)
+        return [validate_file(path) for path in paths]
+    pool = Pool(min(jobs, len(paths)), set_worker_plugins, (plugins, ))
+    try:
+        return pool.map(validate_file, paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def validate_main(argv, plugins):
+    """
+    Validate the config files named on the command line, exiting with
+    a non-zero status if any are invalid.
+    """
+    args = parse_validate_command_line(argv)
+    results = validate(config_paths(args.paths), plugins, args.jobs)
+    invalid = 0
+    for path, error in results:
+        if error is not None:
+            invalid += 1
+            print('{}: {}'.format(path, error))
+    print('{} files checked, {} invalid'.format(len(results), invalid))
+    if invalid:
+        raise SystemExit(1)
+
+
+def stats(config, runs=10, threshold=2.0):
+    """
+    :return: A list of :class:`~archivist.ledger.Trend` instances, one
+             for each source whose repo has a ledger.
+    """
+    trends = []
+    for name, repo in sorted(config.repos.items()):
+        path = repo.ledger_path()
+        if path is None or not os.path.exists(path):
+            continue
+        ledger = Ledger(path)
+        try:
+            for source in config.sources:
+                if source.repo == name:
+                    trends.append(ledger.trend(
+                        source.type, source.name or '', runs, threshold
+                    ))
+        finally:
+            ledger.close()
+    return trends
+
+
+def stats_main(argv, plugins):
+    """
+    Print how the most recent run of each source compares with the runs
+    before it, exiting with a non-zero status if any have regressed.
+    """
+    args = parse_stats_command_line(argv)
+    with HandleKnownExceptions():
+        config = Config.load(args.config, plugins,
+                             FragmentCache(fragment_cache_path(),
+                                           plugins.version))
+    trends = stats(config, args.runs, args.threshold)
+    for trend in trends:
+        print(trend)
+    regressed = sum(1 for trend in trends if trend.regressed)
+    print('{} sources, {} regressed'.format(len(trends), regressed))
+    if regressed:
+        raise SystemExit(1)
+
+
 def main():
 
-    plugins = Plugins.load()
+    plugins = Plugins.load(snapshot_path())
+
+    if sys.argv[1:2] == ['validate']:
+        validate_main(sys.argv[2:], plugins)
+        return
+    if sys.argv[1:2] == ['stats']:
+        stats_main(sys.argv[2:], plugins)
+        return
 
-    args = parse_command_line()
+    args = parse_command_line(plugins.version)
 
     with HandleKnownExceptions():
 
-        config = Config.load(args.config, plugins)
+        config = Config.load(args.config, plugins,
+                             FragmentCache(fragment_cache_path(),
+                                           plugins.version))
 
-        with SafeNotifications(config.notifications):
+        changes = []
+        # what to report if checking goes wrong:
+        check = 0, [], ['error while checking'], [], 0
+        profile = dict(config.profile)
+        if args.profile:
+            profile['directory'] = args.profile
+        profiler = Profiler(**profile)
 
-            for source in config.sources:
-                repo = config.repo_for(source)
-                path = repo.path_for(source)
-                source.process(path)
+        start = time()
+        textfile = config.metrics.get('textfile')
+        with SafeNotifications(config.notifications), profiler.run():
 
-            for repo in config.repos.values():
-                repo.actions()
+            if args.check:
+                check = check_sources(config) + (time()-start, )
+            elif args.dry_run:
+                changes = process_sources(config, dry_run=True,
+                                          profiler=profiler)
+            else:
+                try:
+                    if process(config, profiler):
+                        metrics.set(
+                            'archivist_last_success_timestamp_seconds', time()
+                        )
+                finally:
+                    if textfile:
+                        write_textfile(textfile, time()-start)
+
+        if args.check:
+            report_check(*check)
+        elif args.dry_run:
+            report_changes(changes)
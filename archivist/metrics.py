@@ -0,0 +1,168 @@
+from contextlib import contextmanager
+import os
+from tempfile import mkstemp
+from threading import Lock, local
+
+#: The type and help text of each metric that may be recorded.
+definitions = {
+    'archivist_run_duration_seconds': (
+        'gauge', 'Time taken by the last run.'
+    ),
+    'archivist_last_success_timestamp_seconds': (
+        'gauge', 'Time at which a run last processed every source to '
+                 'completion.'
+    ),
+    'archivist_source_duration_seconds': (
+        'gauge', 'Time taken by each source in the last run.'
+    ),
+    'archivist_source_files_scanned': (
+        'gauge', 'Files examined by each source in the last run.'
+    ),
+    'archivist_source_files_copied': (
+        'gauge', 'Files written into the archive by each source '
+                 'in the last run.'
+    ),
+    'archivist_source_bytes_copied': (
+        'gauge', 'Bytes written into the archive by each source '
+                 'in the last run.'
+    ),
+    'archivist_source_files_deleted': (
+        'gauge', 'Files removed from the archive by each source '
+                 'in the last run.'
+    ),
+    'archivist_source_skipped': (
+        'gauge', '1 if the source was skipped in the last run as its inputs '
+                 'had not changed, 0 otherwise.'
+    ),
+    'archivist_source_aborted': (
+        'gauge', '1 if the source was aborted in the last run as it went '
+                 'over its limits, 0 otherwise.'
+    ),
+    'archivist_git_command_seconds': (
+        'gauge', 'Time spent running each git command in the last run.'
+    ),
+    'archivist_git_commands': (
+        'gauge', 'Number of times each git command was run in the last run.'
+    ),
+    'archivist_repo_commit_made': (
+        'gauge', 'Whether the last run made a commit to each git repo.'
+    ),
+}
+
+#: Metrics whose last value is kept when a run doesn't set them.
+persistent = ('archivist_last_success_timestamp_seconds', )
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"'
+    )
+
+
+class Metrics(object):
+    """
+    A thread safe sink for metrics recorded during a run, which can be
+    written out in the text format read by the Prometheus node_exporter's
+    textfile collector.
+
+    Labels set using :meth:`context` are added to every metric recorded by
+    the same thread within that context.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = Lock()
+        self.local = local()
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    @contextmanager
+    def context(self, **labels):
+        previous = getattr(self.local, 'labels', {})
+        self.local.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    def key(self, metric, labels):
+        if metric not in definitions:
+            raise KeyError('unknown metric: {}'.format(metric))
+        labels = dict(getattr(self.local, 'labels', {}), **labels)
+        return metric, tuple(sorted(labels.items()))
+
+    def set(self, metric, value, **labels):
+        key = self.key(metric, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, metric, amount=1, **labels):
+        key = self.key(metric, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, metric, **labels):
+        return self.values.get(self.key(metric, labels))
+
+    def render(self, previous=''):
+        """
+        Return the metrics in the Prometheus text format.
+
+        :param previous: text previously returned by this method, from which
+                         the values of :data:`persistent` metrics not set
+                         during this run will be taken.
+        """
+        with self.lock:
+            by_name = {}
+            for (name, labels), value in self.values.items():
+                by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(set(by_name) | set(persistent)):
+            if name in by_name:
+                samples = []
+                for labels, value in sorted(by_name[name]):
+                    if labels:
+                        name_and_labels = '{}{{{}}}'.format(name, ','.join(
+                            '{}="{}"'.format(label, escape(label_value))
+                            for label, label_value in labels
+                        ))
+                    else:
+                        name_and_labels = name
+                    samples.append('{} {!r}'.format(name_and_labels,
+                                                    float(value)))
+            else:
+                samples = [line for line in previous.splitlines()
+                           if line.split('{')[0].split(' ')[0] == name]
+                if not samples:
+                    continue
+            type_, help = definitions[name]
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, type_))
+            lines.extend(samples)
+        return ''.join(line+'\n' for line in lines)
+
+    def write(self, path):
+        """
+        Atomically replace the textfile at the supplied path, as required
+        by the textfile collector.
+        """
+        previous = ''
+        if os.path.exists(path):
+            with open(path) as source:
+                previous = source.read()
+        fd, temp_path = mkstemp(prefix='.archivist-metrics-',
+                                dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as target:
+                target.write(self.render(previous))
+            os.chmod(temp_path, 0644)
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+
+
+#: The sink used throughout archivist.
+metrics = Metrics()
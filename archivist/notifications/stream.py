@@ -14,8 +14,23 @@ class Plugin(Notifier):
         'level': log_level,
         'fmt': str,
         'datefmt': str,
+        'progress': bool,
     })
 
-    def __init__(self, type, name, level=logging.INFO, fmt=None, datefmt=None):
+    def __init__(self, type, name, level=logging.INFO, fmt=None, datefmt=None,
+                 progress=False):
         super(Plugin, self).__init__(type, name, level, fmt, datefmt)
         self.handler = logging.StreamHandler(getattr(sys, name))
+        self.show_progress = progress
+
+    def progress(self, report):
+        if not self.show_progress:
+            return
+        # hold the handler's lock so reports from sources being processed
+        # at the same time don't interleave with each other or log records:
+        self.handler.acquire()
+        try:
+            self.handler.stream.write(str(report) + '\n')
+            self.handler.flush()
+        finally:
+            self.handler.release()
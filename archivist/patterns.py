@@ -0,0 +1,98 @@
+import re
+from stat import S_IFMT, S_IFREG, S_IFLNK, S_IFIFO, S_IFSOCK, S_IFCHR, S_IFBLK
+
+file_types = {
+    S_IFREG: 'file',
+    S_IFLNK: 'symlink',
+    S_IFIFO: 'fifo',
+    S_IFSOCK: 'socket',
+    S_IFCHR: 'char',
+    S_IFBLK: 'block',
+}
+
+
+def file_type(mode):
+    """
+    Return the name used in configuration for the type of file with
+    the supplied ``st_mode``.
+    """
+    return file_types.get(S_IFMT(mode))
+
+
+def translate(pattern):
+    """
+    Translate a gitignore-style pattern into a regular expression that
+    matches relative paths using ``/`` as a separator.
+
+    :return: A tuple of the regular expression source and a boolean
+             indicating whether the pattern should only match directories.
+    """
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern[i:] == '**':
+            regex += '.*'
+            break
+        char = pattern[i]
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i+2)
+            chars = pattern[i+1:end]
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            regex += '[' + chars.replace('\\', '\\\\') + ']'
+            i = end
+        else:
+            regex += re.escape(char)
+        i += 1
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return regex, directory_only
+
+
+class Matcher(object):
+    """
+    A set of gitignore-style patterns compiled into two regular expressions,
+    one for files and one for directories, so that each path is checked
+    with a single match rather than a loop over the patterns.
+
+    :param patterns: a sequence of pattern strings.
+    :param contents: if ``True``, a pattern that matches a directory also
+                     matches every path beneath it.
+    """
+
+    def __init__(self, patterns, contents=False):
+        file_regexes = []
+        directory_regexes = []
+        for pattern in patterns:
+            regex, directory_only = translate(pattern)
+            if contents:
+                file_regexes.append(
+                    regex + ('/.*' if directory_only else '(?:/.*)?')
+                )
+            elif not directory_only:
+                file_regexes.append(regex)
+            directory_regexes.append(regex)
+        self.file_regex = self.compile(file_regexes)
+        self.directory_regex = self.compile(directory_regexes)
+
+    @staticmethod
+    def compile(regexes):
+        return re.compile('(?:' + '|'.join(regexes) + r')\Z', re.DOTALL)
+
+    def match_file(self, path):
+        return self.file_regex.match(path) is not None
+
+    def match_directory(self, path):
+        return self.directory_regex.match(path) is not None
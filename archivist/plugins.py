@@ -1,28 +1,180 @@
 from abc import ABCMeta, abstractmethod, abstractproperty
 from collections import defaultdict
+from functools import partial
+import json
 import logging
-from pkg_resources import iter_entry_points
+import os
+import sys
+from tempfile import mkstemp
 from voluptuous import Invalid
 
+from archivist.limits import Budget
+from archivist.progress import Progress
+from archivist.validation import compile_schema
+from archivist.writer import AtomicWriter
+
+types = 'notification', 'repo', 'source'
+
+
+def cache_path(name):
+    """
+    The path of a file, with the supplied name, in which archivist caches
+    something between runs.
+    """
+    cache = os.environ.get('XDG_CACHE_HOME',
+                           os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache, 'archivist', name)
+
+
+def snapshot_path():
+    """
+    The default path at which a snapshot of the installed plugins is kept.
+    """
+    return cache_path('plugins.json')
+
+
+def metadata_stamps():
+    """
+    Return a list of the path and modification time of the metadata of
+    every distribution on :data:`sys.path`, which changes whenever a
+    distribution is installed, upgraded or removed.
+    """
+    stamps = []
+    for entry in sys.path:
+        entry = entry or os.curdir
+        try:
+            names = os.listdir(entry)
+        except OSError:
+            continue
+        stamps.append([entry, os.stat(entry).st_mtime])
+        for name in sorted(names):
+            if not name.endswith(('.egg-info', '.dist-info', '.egg-link')):
+                continue
+            path = os.path.join(entry, name)
+            entry_points = os.path.join(path, 'entry_points.txt')
+            if os.path.exists(entry_points):
+                path = entry_points
+            stamps.append([path, os.stat(path).st_mtime])
+    return stamps
+
+
+def import_target(target):
+    """
+    Import and return the object named by an entry point target such as
+    ``archivist.sources.paths:Plugin``.
+    """
+    module_name, attrs = target.split(':')
+    obj = __import__(module_name, fromlist=['__name__'])
+    for attr in attrs.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+class LazyPlugin(object):
+    """
+    A plugin that has been found but won't be imported until it is used.
+    """
+
+    def __init__(self, load):
+        self.load = load
+
 
 class Plugins(object):
     "Registry for Plugin classes"
 
+    #: The version of archivist that is installed, if known.
+    version = None
+
     def __init__(self):
         self.plugins = defaultdict(dict)
 
     @classmethod
-    def load(cls):
+    def load(cls, snapshot_path=None):
         """
-        Load plugins from entrypoints specified in packages and register them
+        Find plugins from entrypoints specified in packages and register
+        them. Plugins aren't imported until they are used.
+
+        If a snapshot path is supplied, the plugins found are stored there
+        and used instead of searching the installed distributions until
+        any of those distributions change.
         """
         plugins = Plugins()
-        for type in 'notification', 'repo', 'source':
-            for entrypoint in iter_entry_points(group='archivist.'+type):
-                plugin = entrypoint.load()
-                plugins.register(type, entrypoint.name, plugin)
+        stamps = snapshot = None
+        if snapshot_path is not None:
+            stamps = metadata_stamps()
+            snapshot = cls.read_snapshot(snapshot_path, stamps)
+        if snapshot is None:
+            snapshot = cls.scan(stamps)
+            if snapshot_path is not None:
+                cls.write_snapshot(snapshot_path, snapshot)
+        plugins.version = snapshot.get('version')
+        for type, found in snapshot['plugins'].items():
+            for name, target in found.items():
+                if not callable(target):
+                    target = partial(import_target, target)
+                plugins.register(type, name, LazyPlugin(target))
         return plugins
 
+    @staticmethod
+    def scan(stamps=None):
+        """
+        Search the installed distributions for plugins, returning a
+        snapshot of what was found.
+        If stamps are supplied, the snapshot will only contain plugins
+        that can be stored and will include the stamps and the installed
+        version of archivist.
+        """
+        # import here as it is slow to import and only needed when the
+        # installed distributions have changed:
+        from pkg_resources import iter_entry_points, get_distribution
+        found = defaultdict(dict)
+        for type in types:
+            for entrypoint in iter_entry_points(group='archivist.'+type):
+                if stamps is None:
+                    target = entrypoint.load
+                else:
+                    target = '{}:{}'.format(entrypoint.module_name,
+                                            '.'.join(entrypoint.attrs))
+                found[type][entrypoint.name] = target
+        snapshot = dict(plugins=found)
+        if stamps is not None:
+            snapshot['stamps'] = stamps
+            snapshot['version'] = get_distribution('archivist').version
+        return snapshot
+
+    @staticmethod
+    def read_snapshot(path, stamps):
+        """
+        Return the snapshot stored at the supplied path, or ``None`` if
+        there isn't one or it doesn't match the supplied stamps.
+        """
+        try:
+            with open(path) as source:
+                snapshot = json.load(source)
+        except (IOError, ValueError):
+            return None
+        if snapshot.get('stamps') != stamps:
+            return None
+        return snapshot
+
+    @staticmethod
+    def write_snapshot(path, snapshot):
+        """
+        Store a snapshot at the supplied path, ignoring any problems doing
+        so as the snapshot only saves time.
+        """
+        directory = os.path.dirname(path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temp_path = mkstemp(dir=directory, prefix='.plugins-')
+            with os.fdopen(fd, 'w') as target:
+                json.dump(snapshot, target)
+            os.rename(temp_path, path)
+        except (IOError, OSError) as e:
+            logger.debug('could not write plugin snapshot to %s: %s',
+                         path, e)
+
     def register(self, type, name, plugin):
         "Register an individual plugin"
         self.plugins[type][name] = plugin
@@ -31,8 +183,12 @@ class Plugins(object):
         """
         Get a plugin from the registry, raising :class:`KeyError` if a
         plugin of the supplied name has not been registered.
+        Plugins that haven't been used before are imported now.
         """
-        return self.plugins[type][name]
+        plugin = self.plugins[type][name]
+        if isinstance(plugin, LazyPlugin):
+            plugin = self.plugins[type][name] = plugin.load()
+        return plugin
 
 
 class Plugin(object):
@@ -47,6 +203,19 @@ class Plugin(object):
         to the plugin's constructor.
         """
 
+    @classmethod
+    def validator(cls):
+        """
+        Return a function compiled from :attr:`schema` that validates
+        configuration without building up detailed errors, or ``None`` if
+        the schema can't be compiled.
+        It is compiled the first time it is needed and kept on the class,
+        so each subclass gets its own.
+        """
+        if '_validator' not in cls.__dict__:
+            cls._validator = staticmethod(compile_schema(cls.schema))
+        return cls._validator
+
     @abstractmethod
     def __init__(self, type, name=None, **config):
         """
@@ -62,9 +231,14 @@ class Plugin(object):
 class Repo(Plugin):
 
     @abstractmethod
-    def path_for(self, source):
+    def path_for(self, source, create=True):
         """
         :param source: a :class:`Source` instance.
+        :param create: if false, nothing should be created and the path
+                       returned need not exist. This is used when nothing
+                       will be written, such as for dry runs and checks,
+                       and is only passed then, so repos that don't
+                       accept it keep working.
 
         :return: An absolute path to a directory where sources can write.
                  This does not need to be empty and may be temporary.
@@ -80,9 +254,86 @@ class Repo(Plugin):
         framework.
         """
 
+    def lock_path(self):
+        """
+        :return: The path of a file that can be locked to stop more than
+                 one run using this repo at once, or ``None`` if the repo
+                 needs no locking.
+        """
+
+    def ledger_path(self):
+        """
+        :return: The path of the :class:`~archivist.ledger.Ledger` in which
+                 runs using this repo are recorded, or ``None`` if the repo
+                 keeps no history of runs.
+        """
+
+    def check_sources(self, sources):
+        """
+        :param sources: the :class:`Source` instances configured to use
+                        this repo.
+
+        :return: A description of why this repo can't hold the supplied
+                 sources, or ``None`` if it can.
+        """
+
+    def committed(self, path):
+        """
+        :param path: a path returned by :meth:`path_for`.
+
+        :return: A dict mapping paths relative to the supplied path to the
+                 :func:`~archivist.helpers.content_hash` of their last
+                 recorded content, or ``None`` if the repo can't provide
+                 this.
+        """
+
+    def read_committed(self, path, name):
+        """
+        :param path: a path returned by :meth:`path_for`.
+        :param name: a path relative to the supplied path.
+
+        :return: The last recorded content of the named file, or ``None``
+                 if there isn't any or the repo can't provide it.
+        """
+
 
 class Source(Plugin):
 
+    config = {}
+    """
+    The validated configuration this source was created from, not
+    including its :attr:`limits`.
+    """
+
+    limits = {}
+    """
+    The limits configured for this source, which will be used to create its
+    :attr:`budget`.
+    """
+
+    budget = Budget()
+    """
+    A :class:`~archivist.limits.Budget` that :meth:`process` should consult
+    while running commands and reading files.
+    It is replaced with a fresh one before each run.
+    """
+
+    progress = Progress()
+    """
+    A :class:`~archivist.progress.Progress` that :meth:`process` should
+    tell about the directories it walks, the files it examines and the
+    bytes it copies.
+    It is replaced with a fresh one before each run.
+    """
+
+    concurrent = False
+    """
+    Sources that spend most of their time waiting for commands, remote
+    hosts or slow filesystems should set this to ``True`` if
+    :meth:`process` only touches the path it is given, so that they can be
+    processed alongside other sources when concurrency is configured.
+    """
+
     def __init__(self, type, name=None, repo='config',
                  **config):
         """
@@ -103,6 +354,77 @@ class Source(Plugin):
                      should be recorded.
         """
 
+    #: The name of the file, within the path a source records to, in which
+    #: the fingerprint of its last successful run is kept.
+    fingerprint_name = '.archivist-fingerprint'
+
+    def fingerprint(self):
+        """
+        Return a cheap summary of everything this source's recording depends
+        on, such as the modification times and sizes of the files it reads.
+        If this is the same as it was after the last successful run, the
+        source is skipped. The :func:`repr` of the value returned is
+        stored, so it should be made of strings, numbers and tuples.
+
+        :return: The fingerprint, or ``None`` if the source's inputs can't
+                 be summarised and it should always be processed.
+        """
+
+    def previous_fingerprint(self, path):
+        """
+        :param path: An absolute path to a directory in which information
+                     was recorded.
+
+        :return: The stored fingerprint of the last successful run or
+                 ``None`` if there isn't one.
+        """
+        fingerprint_path = os.path.join(path, self.fingerprint_name)
+        if os.path.exists(fingerprint_path):
+            with open(fingerprint_path) as source:
+                return source.read()
+
+    def record_fingerprint(self, path, fingerprint):
+        """
+        Store the fingerprint of a successful run in the supplied path.
+        """
+        with AtomicWriter() as writer:
+            writer.write(os.path.join(path, self.fingerprint_name),
+                         repr(fingerprint))
+
+    def expected(self, path):
+        """
+        Work out what :meth:`process` would leave in the supplied path,
+        without writing anything.
+
+        :param path: An absolute path to a directory in which information
+                     was recorded, which may not exist.
+
+        :return: A dict mapping absolute paths that :meth:`process` would
+                 write or remove to the
+                 :func:`~archivist.helpers.content_hash` of what they
+                 would contain or ``None`` if they would be removed.
+                 Paths that would be left alone may be omitted.
+                 ``None`` is returned if this source can't work this out.
+        """
+
+    def check(self, path, committed, read_committed):
+        """
+        Compare what this source would record with what was last recorded
+        at the supplied path, without copying or writing anything.
+
+        :param path: An absolute path to a directory in which information
+                     was recorded, which may not exist.
+        :param committed: A dict as returned by :meth:`Repo.committed`.
+        :param read_committed: A callable that takes a path relative to
+                               the supplied path and returns its last
+                               recorded content as
+                               :meth:`Repo.read_committed` does.
+
+        :return: A tuple of the number of items checked and a list of
+                 ``(change, item)`` for those that have drifted, or ``None``
+                 if this source doesn't support checking.
+        """
+
 
 logger = logging.getLogger()
 
@@ -134,6 +456,14 @@ class Notifier(Plugin):
         self.fmt = fmt
         self.datefmt = datefmt
 
+    def progress(self, report):
+        """
+        Called periodically while a source is being processed, and once
+        when it finishes.
+
+        :param report: a :class:`~archivist.progress.Report`.
+        """
+
     def start(self):
         """
         Install necessary log handlers.
@@ -0,0 +1,33 @@
+import os
+from stat import S_ISDIR
+
+from archivist.helpers import content_hash
+
+
+def preview(source, path):
+    """
+    Compare what the supplied source would record with what is in the
+    archive at the supplied path, without writing anything.
+
+    :return: A list of ``(change, path)`` for the files that a real
+             run would have added, modified or deleted, where ``change``
+             is one of ``'added'``, ``'modified'`` or ``'deleted'``, or
+             ``None`` if the source can't be previewed.
+    """
+    expected = source.expected(path)
+    if expected is None:
+        return None
+    changes = []
+    for target_path, hash in sorted(expected.items()):
+        try:
+            stat = os.lstat(target_path)
+        except OSError:
+            if hash is not None:
+                changes.append(('added', target_path))
+            continue
+        if hash is None:
+            changes.append(('deleted', target_path))
+        elif S_ISDIR(stat.st_mode) or \
+                content_hash(target_path, stat) != hash:
+            changes.append(('modified', target_path))
+    return changes
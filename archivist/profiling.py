@@ -0,0 +1,185 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import cProfile
+from logging import getLogger
+import os
+import signal
+
+from voluptuous import Any, Required
+
+from archivist.helpers import ensure_dir_exists
+from archivist.limits import number
+
+try:
+    import tracemalloc
+except ImportError:
+    # only available on Python 3
+    tracemalloc = None
+
+logger = getLogger(__name__)
+
+profile_schema = {
+    Required('directory'): str,
+    Required('profilers', default=['cprofile']): [
+        Any('cprofile', 'tracemalloc', 'sampler')
+    ],
+    'sources': [str],
+    'interval': number,
+}
+
+
+class CProfileCollector(object):
+
+    def __init__(self, interval):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+        return True
+
+    def stop(self, prefix):
+        self.profile.disable()
+        self.profile.dump_stats(prefix+'.pstats')
+
+
+class TracemallocCollector(object):
+
+    #: The number of allocation sites to report.
+    top = 50
+
+    def __init__(self, interval):
+        pass
+
+    def start(self):
+        if tracemalloc is None:
+            logger.warning('tracemalloc is not available')
+            return False
+        tracemalloc.start(25)
+        return True
+
+    def stop(self, prefix):
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        with open(prefix+'.tracemalloc.txt', 'w') as report:
+            for stat in snapshot.statistics('lineno')[:self.top]:
+                report.write(str(stat)+'\n')
+
+
+class SamplerCollector(object):
+    """
+    Records the stack of the main thread each time the process has used
+    another ``interval`` seconds of CPU, writing the results in the folded
+    format used by flame graph tools.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.counts = defaultdict(int)
+        self.previous = None
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno
+            ))
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        try:
+            self.previous = signal.signal(signal.SIGPROF, self.sample)
+        except ValueError:
+            logger.warning('the sampler can only be used in the main thread')
+            return False
+        # don't let samples interrupt system calls:
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return True
+
+    def stop(self, prefix):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+        with open(prefix+'.samples.txt', 'w') as report:
+            for stack, count in sorted(self.counts.items()):
+                report.write('{} {}\n'.format(stack, count))
+
+
+collectors = dict(
+    cprofile=CProfileCollector,
+    tracemalloc=TracemallocCollector,
+    sampler=SamplerCollector,
+)
+
+
+class Profiler(object):
+    """
+    Profiles either the whole run or selected sources, writing the results
+    to a directory.
+
+    :param directory: where results are written. Nothing is profiled if
+                      this is ``None``.
+    :param profilers: names of the :data:`collectors` to use.
+    :param sources: if supplied, only these sources are profiled, each
+                    separately. Each entry may be the type of a source or
+                    its type and name separated by a colon.
+    :param interval: seconds of CPU time between samples taken by the
+                     sampler.
+    """
+
+    def __init__(self, directory=None, profilers=('cprofile', ),
+                 sources=None, interval=0.005):
+        self.directory = directory
+        self.profilers = profilers
+        self.sources = sources
+        self.interval = interval
+
+    @contextmanager
+    def profile(self, label):
+        ensure_dir_exists(self.directory)
+        started = []
+        for name in self.profilers:
+            collector = collectors[name](self.interval)
+            if collector.start():
+                started.append(collector)
+        try:
+            yield
+        finally:
+            prefix = os.path.join(self.directory, label)
+            for collector in reversed(started):
+                collector.stop(prefix)
+            logger.info('profile of %s written to %s', label, self.directory)
+
+    @contextmanager
+    def nothing(self):
+        yield
+
+    def run(self):
+        """
+        A context manager that profiles what it wraps if the whole run
+        is being profiled.
+        """
+        if self.directory is None or self.sources is not None:
+            return self.nothing()
+        return self.profile('run')
+
+    def source(self, source):
+        """
+        A context manager that profiles what it wraps if the supplied
+        source is one of those selected for profiling.
+        """
+        if self.directory is None or self.sources is None:
+            return self.nothing()
+        if source.name is None:
+            label = source.type
+        else:
+            label = '{}:{}'.format(source.type, source.name)
+        if source.type not in self.sources and label not in self.sources:
+            return self.nothing()
+        return self.profile('source-'+label.replace(':', '-'))
+
+
+#: A profiler that profiles nothing.
+disabled = Profiler()
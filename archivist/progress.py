@@ -0,0 +1,158 @@
+import os
+from time import time
+
+from archivist.writer import AtomicWriter
+
+#: The name of the file, within the path a source records to, in which the
+#: number of files it examined in its last run is kept.
+count_name = '.archivist-progress'
+
+
+def previous_count(path):
+    """
+    :return: The number of files examined by the last run of the source
+             recording into the supplied path, or ``None`` if unknown.
+    """
+    count_path = os.path.join(path, count_name)
+    if os.path.exists(count_path):
+        with open(count_path) as source:
+            try:
+                return int(source.read())
+            except ValueError:
+                return None
+
+
+def record_count(path, files):
+    """
+    Store the number of files examined by a source for use as the expected
+    count of its next run.
+    """
+    with AtomicWriter() as writer:
+        writer.write(os.path.join(path, count_name), str(files))
+
+
+class Report(object):
+    """
+    The progress made by a source at one point in time, as passed to
+    :meth:`~archivist.plugins.Notifier.progress`.
+    """
+
+    def __init__(self, source, files, bytes, directory, elapsed,
+                 expected=None, done=False):
+        #: The source making progress.
+        self.source = source
+        #: Files examined so far.
+        self.files = files
+        #: Bytes copied so far.
+        self.bytes = bytes
+        #: The directory currently being examined, if known.
+        self.directory = directory
+        #: Seconds since the source started.
+        self.elapsed = elapsed
+        #: Files examined by the source's previous run, if known.
+        self.expected = expected
+        #: ``True`` for the report made when the source has finished.
+        self.done = done
+
+    @property
+    def files_per_second(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds until the source finishes, or ``None`` if this
+        can't be estimated.
+        """
+        if self.done:
+            return 0.0
+        if self.expected is None or not self.files:
+            return None
+        return max(self.expected - self.files, 0) / self.files_per_second
+
+    def __str__(self):
+        parts = ['{} source {!r}: {} files ({:.1f}/s), '
+                 '{:.1f} MB ({:.1f} MB/s)'.format(
+                     self.source.type, self.source.name, self.files,
+                     self.files_per_second, self.bytes / 1e6,
+                     self.bytes_per_second / 1e6
+                 )]
+        if self.done:
+            parts.append('done in {:.1f}s'.format(self.elapsed))
+        else:
+            eta = self.eta
+            if eta is not None:
+                parts.append('ETA {:.0f}s'.format(eta))
+            if self.directory is not None:
+                parts.append('in ' + self.directory)
+        return ', '.join(parts)
+
+
+class Progress(object):
+    """
+    Collects progress events from a source and passes them on to notifiers
+    as :class:`Report` instances, at most once every :attr:`interval`
+    seconds.
+
+    :param source: the :class:`~archivist.plugins.Source` making progress.
+    :param notifiers: the :class:`~archivist.plugins.Notifier` instances
+                      to report to.
+    :param expected: the number of files the source is expected to examine.
+    """
+
+    #: The minimum number of seconds between reports.
+    interval = 0.25
+
+    def __init__(self, source=None, notifiers=(), expected=None):
+        self.source = source
+        self.notifiers = notifiers
+        self.expected = expected
+        self.files = 0
+        self.bytes = 0
+        self.directory = None
+        self.start = self.last = time()
+
+    def report(self, now, done=False):
+        self.last = now
+        report = Report(self.source, self.files, self.bytes, self.directory,
+                        now - self.start, self.expected, done)
+        for notifier in self.notifiers:
+            notifier.progress(report)
+
+    def maybe_report(self):
+        if self.notifiers:
+            now = time()
+            if now - self.last >= self.interval:
+                self.report(now)
+
+    def walking(self, directory):
+        """
+        Note that the source has started examining a directory.
+        """
+        self.directory = directory
+        self.maybe_report()
+
+    def file(self, path):
+        """
+        Note that the source has examined a file.
+        """
+        self.files += 1
+        self.maybe_report()
+
+    def copied(self, size):
+        """
+        Note that the source has copied the supplied number of bytes.
+        """
+        self.bytes += size
+        self.maybe_report()
+
+    def finish(self):
+        """
+        Make a final report, regardless of when the last one was made.
+        """
+        if self.notifiers:
+            self.report(time(), done=True)
@@ -1,13 +1,28 @@
 from logging import getLogger
+from multiprocessing.pool import ThreadPool
 import os
 from datetime import datetime
-from voluptuous import Schema, Required
-from archivist.helpers import run, ensure_dir_exists
+from time import time
+from voluptuous import Schema, Required, Any, All, Range
+from archivist.helpers import run, ensure_dir_exists, CalledProcessError
+from archivist.ledger import ledger_name
+from archivist.lock import lock_name
+from archivist.metrics import metrics
 from archivist.plugins import Repo
+from archivist.writer import AtomicWriter
 
 
 logger = getLogger(__name__)
 
+maintenance_schema = {
+    Required('loose_objects', default=1000): int,
+    Required('packs', default=20): int,
+    Required('commit_graph', default=True): bool,
+    Required('many_files', default=False): bool,
+    Required('interval', default=7*24*60*60): int,
+}
+
+
 class Plugin(Repo):
 
     schema = Schema({
@@ -17,18 +32,38 @@ class Plugin(Repo):
         Required('git', default='git'): str,
         Required('commit', default=True): bool,
         Required('push', default=False): bool,
+        'maintenance': maintenance_schema,
+        'shard': Any('type', 'source'),
+        'workers': All(int, Range(min=1)),
     })
 
-    def __init__(self, type, name, path, git, commit, push):
+    manifest_name = 'shards.txt'
+
+    #: The name of the file, within a repo's ``.git`` directory, recording
+    #: when maintenance was last performed.
+    maintained_name = 'archivist-maintained'
+
+    #: Files with names matching this pattern are working files that
+    #: archivist creates in the repo and should never be committed.
+    exclude_pattern = '.archivist-*'
+
+    def __init__(self, type, name, path, git, commit, push, maintenance=None,
+                 shard=None, workers=4):
         super(Plugin, self).__init__(type, name)
         self.path = path
         self.git = git
         self.commit = commit
         self.push = push
+        self.maintenance = maintenance
+        self.shard = shard
+        self.workers = workers
+        self.shards = set()
 
-    def path_for(self, source):
+    def path_for(self, source, create=True):
         """
         :param source: a :class:`Source` instance.
+        :param create: if false, the directory isn't created and the
+                       source's shard, if any, won't be committed.
 
         :return: An absolute path to a directory where sources can write.
                  This does not need to be empty and may be temporary.
@@ -37,36 +72,272 @@ class Plugin(Repo):
         if source.name:
             parts.append(source.name)
         full_path = os.path.join(*parts)
+        if not create:
+            return full_path
         ensure_dir_exists(full_path)
+        shard_path = self.shard_for(source)
+        if shard_path is not None:
+            self.shards.add(shard_path)
         return full_path
 
-    def run_git(self, *args):
-        return run((self.git, )+args, cwd=self.path)
+    def lock_path(self):
+        ensure_dir_exists(self.path)
+        return os.path.join(self.path, lock_name)
 
-    def actions(self):
+    def ledger_path(self):
+        return os.path.join(self.path, ledger_name)
+
+    def check_sources(self, sources):
+        """
+        Sharding by source puts the shard of a source with no name around
+        the shards of named sources of the same type, which git can't
+        handle.
+        """
+        if self.shard != 'source':
+            return None
+        unnamed = set(source.type for source in sources if not source.name)
+        for source in sources:
+            if source.name and source.type in unnamed:
+                return (
+                    'sources of type {!r} with and without names cannot be '
+                    'sharded by source as their repos would be nested'
+                ).format(source.type)
+
+    def shard_for(self, source):
+        """
+        :param source: a :class:`Source` instance.
+
+        :return: The path of the separate git repo that will hold the
+                 source's files or ``None`` if sharding is not configured.
+        """
+        if self.shard is None:
+            return None
+        parts = [self.path, source.type]
+        if self.shard == 'source' and source.name:
+            parts.append(source.name)
+        return os.path.join(*parts)
+
+    def run_git(self, *args, **kw):
+        start = time()
+        try:
+            return run((self.git, )+args, cwd=kw.get('path') or self.path)
+        finally:
+            metrics.inc('archivist_git_command_seconds', time()-start,
+                        command=args[0])
+            metrics.inc('archivist_git_commands', command=args[0])
+
+    def committed(self, path):
+        if not os.path.isdir(path):
+            return {}
+        try:
+            output = self.run_git('ls-tree', '-r', '-z', 'HEAD', path=path)
+        except CalledProcessError:
+            # no commits yet
+            return {}
+        hashes = {}
+        for entry in output.split('\0'):
+            if entry:
+                meta, name = entry.split('\t', 1)
+                hashes[name] = meta.split()[2]
+        return hashes
+
+    def read_committed(self, path, name):
+        if not os.path.isdir(path):
+            return None
+        try:
+            return self.run_git('show', 'HEAD:./'+name, path=path)
+        except CalledProcessError:
+            # no commits yet or never committed
+            return None
+
+    def object_counts(self, path=None):
+        """
+        Return the output of ``git count-objects -v`` as a dict of ints.
+        """
+        counts = {}
+        for line in self.run_git('count-objects', '-v',
+                                 path=path).splitlines():
+            key, value = line.split(':', 1)
+            counts[key] = int(value)
+        return counts
+
+    def exclude(self, path):
+        """
+        Make sure git ignores archivist's working files, such as those left
+        behind if a run is killed part way through writing a file.
+        """
+        info_path = os.path.join(path, '.git', 'info')
+        exclude_path = os.path.join(info_path, 'exclude')
+        if os.path.exists(exclude_path):
+            with open(exclude_path) as exclude:
+                if self.exclude_pattern in exclude.read().splitlines():
+                    return
+        ensure_dir_exists(info_path)
+        with open(exclude_path, 'a') as exclude:
+            exclude.write(self.exclude_pattern+'\n')
+
+    def configure(self, path):
+        """
+        Apply settings that keep ``git status`` and ``git add`` fast on
+        repos with very large numbers of files, only changing those that
+        aren't already set.
+        """
+        if self.maintenance is None or not self.maintenance['many_files']:
+            return
+        # git lower cases section and key names when listing them:
+        current = set(self.run_git('config', '--local', '--list',
+                                   path=path).splitlines())
+        for name in 'feature.manyFiles', 'core.untrackedCache':
+            if name.lower()+'=true' not in current:
+                self.run_git('config', name, 'true', path=path)
+
+    def maintenance_due(self, path):
+        """
+        Check whether more than the configured interval has passed since
+        the repo at the supplied path was last maintained, so that repos
+        that rarely change are still maintained.
+        A repo that has never been maintained starts its interval now.
+        """
+        stamp_path = os.path.join(path, '.git', self.maintained_name)
+        try:
+            with open(stamp_path) as stamp:
+                last = float(stamp.read())
+        except (IOError, ValueError):
+            self.record_maintained(path)
+            return False
+        return time() - last > self.maintenance['interval']
+
+    def record_maintained(self, path):
+        with open(os.path.join(path, '.git', self.maintained_name),
+                  'w') as stamp:
+            stamp.write(repr(time()))
+
+    def maintain(self, path):
+        """
+        Keep the object store in shape so that the cost of a run doesn't
+        grow with the length of the repo's history.
+        """
+        settings = self.maintenance
+        start = time()
+        counts = self.object_counts(path)
+        if counts['packs'] > settings['packs']:
+            self.run_git('repack', '-a', '-d', '-q', path=path)
+        elif counts['count'] > settings['loose_objects']:
+            self.run_git('repack', '-d', '-q', path=path)
+        else:
+            self.run_git('gc', '--auto', '--quiet', path=path)
+        if settings['commit_graph']:
+            self.run_git('commit-graph', 'write',
+                         '--reachable', '--split', '--no-progress',
+                         path=path)
+        logger.info('maintenance of %s took %.2fs', path, time()-start)
+        self.record_maintained(path)
+
+    def record(self, path):
+        """
+        Log, commit and push any changes in the git repo at the supplied
+        path, creating the repo if it doesn't exist.
+        """
         # git init if required
-        ensure_dir_exists(self.path)
-        if not os.path.exists(os.path.join(self.path, '.git')):
-            logger.info('creating git repo at %s', self.path)
-            self.run_git('init')
+        ensure_dir_exists(path)
+        if not os.path.exists(os.path.join(path, '.git')):
+            logger.info('creating git repo at %s', path)
+            self.run_git('init', path=path)
+
+        self.exclude(path)
+        self.configure(path)
+        metrics.set('archivist_repo_commit_made', 0, repo=self.name, path=path)
 
         # log status
-        status = self.run_git('status', '--porcelain')
+        status = self.run_git('status', '--porcelain', path=path)
+        committed = False
         if status:
             logger.info('changes found in git repo at %s:\n%s',
-                        self.path, status)
+                        path, status)
 
             # commit if specified
             if self.commit:
-                self.run_git('add', '--all', '.')
+                self.run_git('add', '--all', '.', path=path)
                 self.run_git('commit', '-m',
                              datetime.now().strftime(
                                  "Recorded by archivist at %Y-%m-%d %H:%M"
-                             ))
+                             ),
+                             path=path)
                 logger.info('changes committed')
+                metrics.set('archivist_repo_commit_made', 1,
+                            repo=self.name, path=path)
+                committed = True
+
+        if self.maintenance is not None and \
+                (committed or self.maintenance_due(path)):
+            self.maintain(path)
+
+        # push if specified
+        if status and self.push:
+            self.run_git('push', '-q', path=path)
+            logger.info('changes pushed')
+
+    def head(self, path):
+        try:
+            return self.run_git('rev-parse', '--verify', '-q', 'HEAD',
+                                path=path).strip()
+        except CalledProcessError:
+            return None
+
+    def existing_shards(self):
+        """
+        Return the paths of every shard repo within :attr:`path`, including
+        those of sources that are no longer configured.
+        """
+        shards = []
+        if not os.path.isdir(self.path):
+            return shards
+        for type_name in sorted(os.listdir(self.path)):
+            type_path = os.path.join(self.path, type_name)
+            if type_name.startswith('.') or not os.path.isdir(type_path):
+                continue
+            if os.path.isdir(os.path.join(type_path, '.git')):
+                shards.append(type_path)
+            elif self.shard == 'source':
+                for name in sorted(os.listdir(type_path)):
+                    source_path = os.path.join(type_path, name)
+                    if os.path.isdir(os.path.join(source_path, '.git')):
+                        shards.append(source_path)
+        return shards
+
+    def write_manifest(self, shards):
+        """
+        Record the current commit of each shard in the top-level repo and
+        make sure the top-level repo doesn't track the shards' contents.
+        """
+        ensure_dir_exists(self.path)
+        relative = [os.path.relpath(shard, self.path) for shard in shards]
+        with AtomicWriter() as writer:
+            writer.write(os.path.join(self.path, '.gitignore'),
+                         ''.join('/{}/\n'.format(name) for name in relative))
+            manifest = []
+            for shard, name in zip(shards, relative):
+                head = self.head(shard)
+                if head is not None:
+                    manifest.append('{} {}\n'.format(head, name))
+            writer.write(os.path.join(self.path, self.manifest_name),
+                         ''.join(manifest))
+
+    def actions(self):
+        if self.shard is None:
+            self.record(self.path)
+            return
 
-            # push if specified
-            if self.push:
-                self.run_git('push', '-q')
-                logger.info('changes pushed')
+        shards = sorted(self.shards)
+        if shards:
+            pool = ThreadPool(min(self.workers, len(shards)))
+            try:
+                pool.map(self.record, shards)
+            finally:
+                pool.close()
+                pool.join()
+        # shards not used by this run must still be kept out of the
+        # top-level repo:
+        self.write_manifest(self.existing_shards())
+        self.record(self.path)
 
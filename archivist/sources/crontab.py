@@ -1,14 +1,185 @@
+import os
 from os.path import join
-from voluptuous import Schema
-from archivist.helpers import run
+from voluptuous import Schema, Any
+from archivist.helpers import run_all, blob_hash, content_hash
+from archivist.metrics import metrics
 from archivist.plugins import Source
+from archivist.writer import AtomicWriter
 
 
 class Plugin(Source):
 
-    schema = Schema(dict(type='packages', name=str))
+    schema = Schema({
+        'type': 'crontab',
+        'name': Any(None, str),
+        'repo': str,
+        'spool': str,
+        'system': [str],
+        'users': [str],
+    })
+
+    concurrent = True
+
+    #: The name of the file, within the path crontabs are mirrored into,
+    #: that lists the crontabs that were mirrored.
+    manifest_name = 'crontabs.txt'
+
+    def __init__(self, type, name=None, repo='config',
+                 spool='/var/spool/cron/crontabs',
+                 system=('/etc/crontab', '/etc/cron.d'), users=None):
+        super(Plugin, self).__init__(type, name, repo)
+        self.spool = spool
+        self.system = system
+        self.users = users
+
+    def crontab_paths(self):
+        """
+        Yield the path of every user and system crontab that exists.
+        """
+        for path in [self.spool] + list(self.system):
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    file_path = join(path, name)
+                    if os.path.isfile(file_path):
+                        yield file_path
+            elif os.path.isfile(path):
+                yield path
+
+    def fingerprint(self):
+        """
+        When mirroring, the directories searched and the crontabs found.
+        When recording users' crontabs, their crontabs in :attr:`spool`.
+        """
+        users = self.recorded_users()
+        if users:
+            paths = [join(self.spool, user) for user in users]
+            if not all(os.path.isfile(path) for path in paths):
+                return None
+        else:
+            # a directory's mtime changes when crontabs are added or removed
+            paths = [path for path in [self.spool] + list(self.system)
+                     if os.path.isdir(path)]
+            paths.extend(self.crontab_paths())
+        fingerprint = []
+        for path in paths:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_ino, stat.st_size,
+                                stat.st_mtime))
+        return tuple(fingerprint)
+
+    @classmethod
+    def read_manifest(cls, path):
+        """
+        Return the set of crontabs listed as mirrored into the supplied
+        path.
+        """
+        manifest_path = join(path, cls.manifest_name)
+        if not os.path.exists(manifest_path):
+            return set()
+        with open(manifest_path) as manifest:
+            return set(line.rstrip('\n') for line in manifest if line.strip())
+
+    @staticmethod
+    def remove_mirrored(path, source_path):
+        """
+        Remove the mirrored copy of a crontab from the supplied path along
+        with any directories that are left empty.
+        """
+        target_path = join(path, source_path[1:])
+        if not os.path.lexists(target_path):
+            return
+        os.remove(target_path)
+        metrics.inc('archivist_source_files_deleted')
+        directory = os.path.dirname(target_path)
+        while directory != path and not os.listdir(directory):
+            os.rmdir(directory)
+            directory = os.path.dirname(directory)
+
+    def mirrored_paths(self):
+        """
+        Yield the path and stat result of every crontab that should be
+        mirrored.
+        """
+        for source_path in self.crontab_paths():
+            stat = os.stat(source_path)
+            if not self.budget.file(source_path, stat.st_size):
+                continue
+            self.progress.file(source_path)
+            yield source_path, stat
+
+    @staticmethod
+    def format_manifest(mirrored):
+        return ''.join(path+'\n' for path in sorted(mirrored))
+
+    def process_all(self, path):
+        """
+        Mirror every crontab found under :attr:`spool` and :attr:`system`
+        into the supplied path, only copying files that have changed
+        since they were last mirrored.
+
+        Only crontabs listed in the manifest as mirrored by the last run
+        are ever removed, as other sources, shard repos and working files
+        may live below the supplied path.
+        """
+        previous = self.read_manifest(path)
+        mirrored = set()
+        with AtomicWriter() as writer:
+            for source_path, stat in self.mirrored_paths():
+                mirrored.add(source_path)
+                target_path = join(path, source_path[1:])
+                if writer.copy(source_path, target_path, stat):
+                    self.progress.copied(stat.st_size)
+
+        for source_path in sorted(previous - mirrored):
+            self.remove_mirrored(path, source_path)
+
+        with AtomicWriter() as writer:
+            writer.write(join(path, self.manifest_name),
+                         self.format_manifest(mirrored))
+
+    def recorded_users(self):
+        """
+        The users whose crontabs are recorded using ``crontab -l``, which is
+        :attr:`users` if supplied, otherwise the source's name, if any.
+        """
+        if self.users:
+            return self.users
+        if self.name is not None:
+            return [self.name]
+        return []
+
+    def user_crontabs(self, users):
+        """
+        Return the output of ``crontab -l`` for each of the supplied users.
+        """
+        # the commands are independent, so run them all at once:
+        return run_all([['crontab', '-l', '-u', user] for user in users],
+                       timeout=self.budget.remaining())
 
     def process(self, path):
-        output = run(['crontab', '-l', '-u', self.name])
-        with open(join(path, self.name), 'w') as stream:
-            stream.write(output)
+        users = self.recorded_users()
+        if not users:
+            self.process_all(path)
+            return
+        outputs = self.user_crontabs(users)
+        with AtomicWriter() as writer:
+            for user, output in zip(users, outputs):
+                writer.write(join(path, user), output)
+
+    def expected(self, path):
+        users = self.recorded_users()
+        if users:
+            return dict((join(path, user), blob_hash(output)) for user, output
+                        in zip(users, self.user_crontabs(users)))
+        expected = {}
+        mirrored = set()
+        for source_path, stat in self.mirrored_paths():
+            mirrored.add(source_path)
+            expected[join(path, source_path[1:])] = content_hash(source_path,
+                                                                 stat)
+        for source_path in self.read_manifest(path) - mirrored:
+            expected[join(path, source_path[1:])] = None
+        expected[join(path, self.manifest_name)] = blob_hash(
+            self.format_manifest(mirrored)
+        )
+        return expected
@@ -4,7 +4,8 @@ from glob import glob
 from os.path import join
 from voluptuous import Schema, Required, All
 from .paths import Plugin as Paths
-from archivist.helpers import absolute_path
+from archivist.helpers import absolute_path, blob_hash
+from archivist.writer import AtomicWriter
 
 
 class Plugin(Paths):
@@ -39,12 +40,16 @@ class Plugin(Paths):
         self.source_paths = [p for
                              p in self._paths(jenkins_root, *self.patterns)]
 
-    def write_plugin_versions(self, jenkins_root, target_path):
+    def plugin_versions(self, jenkins_root):
+        """
+        Return a listing of the version of each installed plugin.
+        """
         plugins = {}
         for manifest_path in self._paths(
             jenkins_root,
             ['plugins', '*', 'META-INF', 'MANIFEST.MF']
         ):
+            self.budget.check()
             data = {}
             with open(manifest_path) as manifest:
                 for line in manifest: # pragma: no branch
@@ -76,13 +81,37 @@ class Plugin(Paths):
                     ))
             plugins[name]= data['plugin-version'], filename
 
-        with open(join(target_path, 'plugin-versions.txt'), 'w') as output:
-            for name, info in sorted(plugins.items()):
-                version, _ = info
-                output.write('%s: %s\n' % (name, version))
+        return ''.join('%s: %s\n' % (name, version)
+                       for name, (version, _) in sorted(plugins.items()))
+
+    def write_plugin_versions(self, jenkins_root, target_path):
+        with AtomicWriter() as writer:
+            writer.write(join(target_path, 'plugin-versions.txt'),
+                         self.plugin_versions(jenkins_root))
 
     def process(self, target_path):
         jenkins_root = self.source_paths
         self.expand_source_paths(jenkins_root)
         super(Plugin, self).process(target_path)
         self.write_plugin_versions(jenkins_root, target_path)
+
+    def expected(self, target_path):
+        jenkins_root = self.source_paths
+        self.expand_source_paths(jenkins_root)
+        try:
+            expected = super(Plugin, self).expected(target_path)
+        finally:
+            self.source_paths = jenkins_root
+        expected[join(target_path, 'plugin-versions.txt')] = blob_hash(
+            self.plugin_versions(jenkins_root)
+        )
+        return expected
+
+    def check(self, target_path, committed, read_committed):
+        jenkins_root = self.source_paths
+        self.expand_source_paths(jenkins_root)
+        try:
+            return super(Plugin, self).check(target_path, committed,
+                                             read_committed)
+        finally:
+            self.source_paths = jenkins_root
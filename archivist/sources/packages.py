@@ -1,7 +1,9 @@
-from voluptuous import Any
+import os
+from voluptuous import Any, Required
 from voluptuous import Schema
-from archivist.helpers import run
+from archivist.helpers import run, iter_lines, mtime_matches, blob_hash
 from archivist.plugins import Source
+from archivist.writer import AtomicWriter
 from os.path import join
 
 package_managers = dict(
@@ -9,11 +11,122 @@ package_managers = dict(
     rpm='-qa',
 )
 
+databases = dict(
+    dpkg=['/var/lib/dpkg/status'],
+    rpm=['/var/lib/rpm/rpmdb.sqlite', '/var/lib/rpm/Packages'],
+)
+
+rpm_query_format = (
+    '%{NAME} %|EPOCH?{%{EPOCH}:}:{}|%{VERSION}-%{RELEASE} %{ARCH}\\n'
+)
+
+
+def dpkg_inventory(database, timeout=None):
+    """
+    Parse a dpkg status file, yielding ``(name, version, arch)`` for each
+    installed package.
+    """
+    with open(database) as status_file:
+        paragraphs = status_file.read().split('\n\n')
+    for paragraph in paragraphs:
+        fields = {}
+        for line in paragraph.splitlines():
+            if line and not line[0].isspace():
+                name, _, value = line.partition(':')
+                fields[name.lower()] = value.strip()
+        if fields.get('status', '').endswith(' installed'):
+            yield (fields['package'], fields['version'],
+                   fields['architecture'])
+
+
+def rpm_inventory(database, timeout=None):
+    for line in iter_lines(['rpm', '-qa', '--queryformat', rpm_query_format],
+                           timeout=timeout):
+        yield tuple(line.rstrip('\n').split(' '))
+
+
+inventories = dict(
+    dpkg=dpkg_inventory,
+    rpm=rpm_inventory,
+)
+
+
 class Plugin(Source):
 
-    schema = Schema(dict(type='packages', name=Any(*package_managers)))
+    schema = Schema({
+        'type': 'packages',
+        Required('name'): Any(*package_managers),
+        'repo': str,
+        'format': Any('raw', 'inventory'),
+        'database': str,
+    })
+
+    concurrent = True
+
+    def __init__(self, type, name, repo='config', format='raw',
+                 database=None):
+        super(Plugin, self).__init__(type, name, repo)
+        self.format = format
+        if database is None:
+            for database in databases[name]:
+                if os.path.exists(database):
+                    break
+        self.database = database
+
+    def fingerprint(self):
+        """
+        The package database, which changes whenever packages do.
+        """
+        if not os.path.exists(self.database):
+            return None
+        stat = os.stat(self.database)
+        return (self.format, self.database, stat.st_ino, stat.st_size,
+                stat.st_mtime)
+
+    def database_mtime(self):
+        if os.path.exists(self.database):
+            return os.stat(self.database).st_mtime
+
+    def inventory(self):
+        """
+        Return a sorted ``name version arch`` listing of installed packages.
+        """
+        packages = sorted(inventories[self.name](
+            self.database, self.budget.remaining()
+        ))
+        return ''.join('%s %s %s\n' % package for package in packages)
+
+    def write_inventory(self, output_path):
+        """
+        Write a sorted ``name version arch`` listing of installed packages,
+        skipping all work if the package database hasn't changed since the
+        listing was last written.
+        """
+        mtime = self.database_mtime()
+        if mtime is not None and mtime_matches(output_path, mtime):
+            return
+        with AtomicWriter() as writer:
+            writer.write(output_path, self.inventory())
+        if mtime is not None:
+            os.utime(output_path, (mtime, mtime))
+
+    def listing(self):
+        return run([self.name, package_managers[self.name]],
+                   timeout=self.budget.remaining())
 
     def process(self, path):
-        output = run([self.name, package_managers[self.name]])
-        with open(join(path, self.name), 'w') as stream:
-            stream.write(output)
+        output_path = join(path, self.name)
+        if self.format == 'inventory':
+            self.write_inventory(output_path)
+            return
+        with AtomicWriter() as writer:
+            writer.write(output_path, self.listing())
+
+    def expected(self, path):
+        output_path = join(path, self.name)
+        if self.format != 'inventory':
+            return {output_path: blob_hash(self.listing())}
+        mtime = self.database_mtime()
+        if mtime is not None and mtime_matches(output_path, mtime):
+            return {}
+        return {output_path: blob_hash(self.inventory())}
@@ -1,38 +1,86 @@
 import os
 from grp import getgrgid
+from multiprocessing.pool import ThreadPool
 from pwd import getpwuid
 from stat import (
-    S_IRUSR, S_IXUSR, S_IRGRP, S_IWGRP, S_IXGRP, S_IROTH, S_IWOTH, S_IXOTH
+    S_IRUSR, S_IXUSR, S_IRGRP, S_IWGRP, S_IXGRP, S_IROTH, S_IWOTH, S_IXOTH,
+    S_IFMT, S_IFIFO, S_IFSOCK, S_IFCHR, S_IFBLK, S_IFLNK, S_ISLNK, S_ISREG,
+    S_ISUID, S_ISGID, S_ISVTX
 )
 from stat import S_IWUSR
 
-from voluptuous import Schema, All, Length
+from voluptuous import Schema, All, Length, Any
 
-from archivist.helpers import ensure_dir_exists, absolute_path
+from archivist.helpers import absolute_path, blob_hash, content_hash
+from archivist.metrics import metrics
+from archivist.patterns import Matcher, file_type, file_types
 from archivist.plugins import Source
+from archivist.writer import AtomicWriter
+from archivist.xattrs import read_xattrs, encode_value
+
+type_chars = {
+    S_IFLNK: 'l',
+    S_IFIFO: 'p',
+    S_IFSOCK: 's',
+    S_IFCHR: 'c',
+    S_IFBLK: 'b',
+}
+
+# execute bits that ls shows differently when these bits are set:
+special_bits = {
+    S_IXUSR: (S_ISUID, 's'),
+    S_IXGRP: (S_ISGID, 's'),
+    S_IXOTH: (S_ISVTX, 't'),
+}
 
 
 class Plugin(Source):
 
-    schema = Schema(dict(type='paths', name=None, repo=str,
+    #: The number of threads used to hash files when checking for drift.
+    hash_workers = 4
+    #: The number of changed files written before they are committed.
+    write_batch = 1000
+
+    schema = Schema(dict(type='paths', name=Any(None, str), repo=str,
                          values=All([All(str, absolute_path)],
-                                    Length(min=1))))
+                                    Length(min=1)),
+                         include=[str],
+                         exclude=[str],
+                         types=[Any(*file_types.values())],
+                         follow_links=bool))
 
-    def __init__(self, type, name, repo, values):
+    concurrent = True
+
+    def __init__(self, type, name, repo, values,
+                 include=None, exclude=None, types=None,
+                 follow_links=False):
         super(Plugin, self).__init__(type, name, repo)
         self.source_paths = values
+        self.include = Matcher(include, contents=True) if include else None
+        self.exclude = Matcher(exclude) if exclude else None
+        self.types = types
+        self.follow_links = follow_links
+        self.copies = {}
+        self.xattrs = {}
 
     @staticmethod
-    def path_attributes(source_path):
-        stat = os.stat(source_path)
-        perms = ''
+    def path_attributes(source_path, stat=None):
+        if stat is None:
+            stat = os.stat(source_path)
+        perms = type_chars.get(S_IFMT(stat.st_mode), '')
         for bit, char in zip((
             S_IRUSR, S_IWUSR, S_IXUSR,
             S_IRGRP, S_IWGRP, S_IXGRP,
             S_IROTH, S_IWOTH, S_IXOTH,
         ),
             'rwx'*3):
-            perms += (char if stat.st_mode & bit else '-')
+            set_ = stat.st_mode & bit
+            if bit in special_bits:
+                special_bit, special_char = special_bits[bit]
+                if stat.st_mode & special_bit:
+                    char = special_char if set_ else special_char.upper()
+                    set_ = True
+            perms += (char if set_ else '-')
         return (
             perms,
             getpwuid(stat.st_uid).pw_name,
@@ -40,75 +88,260 @@ class Plugin(Source):
         )
 
     @staticmethod
-    def read_contents_file(contents_path):
+    def parse_contents(lines):
         contents = {}
-        if os.path.exists(contents_path):
-            with open(contents_path) as contents_file:
-                for line in contents_file:
-                    perms, owner, group, path = line.split()
-                    contents[path] = perms, owner, group
+        for line in lines:
+            perms, owner, group, path = line.rstrip('\n').split(None, 3)
+            if ' -> ' in path:
+                path, link = path.split(' -> ', 1)
+                contents[path] = perms, owner, group, link
+            else:
+                contents[path] = perms, owner, group
         return contents
 
+    @classmethod
+    def read_contents_file(cls, contents_path):
+        if not os.path.exists(contents_path):
+            return {}
+        with open(contents_path) as contents_file:
+            return cls.parse_contents(contents_file)
+
+    @staticmethod
+    def format_contents(contents):
+        owner_width = 0
+        group_width = 0
+        for meta in contents.values():
+            perms, owner, group = meta[:3]
+            owner_width = max(owner_width, len(owner))
+            group_width = max(group_width, len(group))
+
+        lines = []
+        for absolute_path, meta in sorted(contents.items()):
+            perms, owner, group = meta[:3]
+            if len(meta) > 3:
+                absolute_path += ' -> ' + meta[3]
+            # perms aren't padded, so that adding a file with a type
+            # character doesn't change every other line:
+            lines.append(
+                '{perms} {owner:{owner_width}} '
+                '{group:{group_width}} {path}\n'.format(
+                perms = perms,
+                owner = owner,
+                owner_width = owner_width,
+                group = group,
+                group_width = group_width,
+                path = absolute_path,
+                ))
+        return ''.join(lines)
+
+    @classmethod
+    def write_contents_file(cls, contents, contents_path):
+        with AtomicWriter() as writer:
+            writer.write(contents_path, cls.format_contents(contents))
+
     @staticmethod
-    def write_contents_file(contents, contents_path):
-        ensure_dir_exists(os.path.split(contents_path)[0])
-        with open(contents_path, 'w') as contents_file:
-            owner_width = 0
-            group_width = 0
-            for perms, owner, group in contents.values():
-                owner_width = max(owner_width, len(owner))
-                group_width = max(group_width, len(group))
-
-            for absolute_path, meta in sorted(contents.items()):
-                perms, owner, group = meta
-                contents_file.write(
-                    '{perms} {owner:{owner_width}} {group:{group_width}} '
-                    '{path}\n'.format(
-                    perms = perms,
-                    owner = owner,
-                    owner_width = owner_width,
-                    group = group,
-                    group_width = group_width,
-                    path = absolute_path,
-                    ))
+    def format_xattrs(xattrs):
+        """
+        Format extended attributes as ``getfattr --dump`` does.
+        """
+        lines = []
+        for absolute_path, attributes in sorted(xattrs.items()):
+            lines.append('# file: {}\n'.format(absolute_path))
+            for name, value in attributes:
+                lines.append('{}={}\n'.format(name, encode_value(value)))
+            lines.append('\n')
+        return ''.join(lines)
+
+    @staticmethod
+    def parse_xattrs(text):
+        """
+        Parse text written by :meth:`format_xattrs` into a dict mapping
+        each path to the lines recording its extended attributes.
+        """
+        xattrs = {}
+        lines = None
+        for line in text.splitlines():
+            if line.startswith('# file: '):
+                lines = xattrs[line[len('# file: '):]] = []
+            elif line and lines is not None:
+                lines.append(line)
+        return xattrs
+
+    @classmethod
+    def write_xattrs_file(cls, xattrs, xattrs_path):
+        """
+        Write extended attributes in the format used by ``getfattr --dump``,
+        removing the file if there are none to record.
+        """
+        with AtomicWriter() as writer:
+            if xattrs:
+                writer.write(xattrs_path, cls.format_xattrs(xattrs))
+            else:
+                writer.remove(xattrs_path)
 
     def relative_path(self, source_path, target_path):
         split_path = (target_path.split(os.sep) + source_path.split(os.sep)[1:])
         full_target = os.sep.join(split_path)
         return full_target, split_path
 
+    def walk(self, source_path):
+        """
+        Yield the paths of all files below the supplied directory that
+        are selected by the include and exclude patterns.
+        Excluded directories are pruned without being descended into.
+
+        If links are not being followed, links to directories are yielded
+        as if they were files. If they are being followed, a link to one of
+        the directories that contains it isn't descended into, so links
+        that form loops are harmless. A directory that can be reached by
+        more than one path is walked along each of them.
+        """
+        prefix_length = len(source_path.rstrip(os.sep)) + 1
+        stat = os.stat(source_path)
+        # the directories leading to each directory still to be walked:
+        ancestors = {source_path: frozenset([(stat.st_dev, stat.st_ino)])}
+        for root, dirs, filenames in os.walk(source_path,
+                                             followlinks=self.follow_links):
+            self.budget.check()
+            self.progress.walking(root)
+            relative_root = root[prefix_length:]
+            if self.exclude is not None:
+                dirs[:] = [d for d in dirs if not self.exclude.match_directory(
+                    os.path.join(relative_root, d)
+                )]
+            if self.follow_links:
+                above = ancestors.pop(root)
+                below = []
+                for d in dirs:
+                    path = os.path.join(root, d)
+                    stat = os.stat(path)
+                    key = stat.st_dev, stat.st_ino
+                    if key not in above:
+                        ancestors[path] = above | set([key])
+                        below.append(d)
+                dirs[:] = below
+            else:
+                filenames = filenames + [
+                    d for d in dirs if os.path.islink(os.path.join(root, d))
+                ]
+            for filename in filenames:
+                relative_path = os.path.join(relative_root, filename)
+                if self.exclude is not None and \
+                        self.exclude.match_file(relative_path):
+                    continue
+                if self.include is not None and \
+                        not self.include.match_file(relative_path):
+                    continue
+                yield os.path.join(root, filename)
+
+    def selected_paths(self):
+        """
+        Yield every path that should be recorded before type and size
+        filtering.
+        """
+        for source_path in self.source_paths:
+            if os.path.isfile(source_path):
+                yield source_path
+            else:
+                for path in self.walk(source_path):
+                    yield path
+
+    def examine(self, source_path):
+        """
+        Return the stat result, the attributes to record in the contents
+        file and the path to read extended attributes from for the supplied
+        path, or ``None`` if it should not be recorded.
+        """
+        stat = os.lstat(source_path)
+        if self.types is not None and \
+                file_type(stat.st_mode) not in self.types:
+            return None
+        xattrs_path = source_path
+        if S_ISLNK(stat.st_mode) and self.follow_links:
+            try:
+                stat = os.stat(source_path)
+            except OSError:
+                # dangling link, so record it as a link
+                pass
+            else:
+                xattrs_path = os.path.realpath(source_path)
+        if not self.budget.file(source_path, stat.st_size):
+            return None
+        self.progress.file(source_path)
+        attributes = self.path_attributes(source_path, stat)
+        if S_ISLNK(stat.st_mode):
+            attributes += (os.readlink(source_path), )
+        return stat, attributes, xattrs_path
+
+    def record_one(self, source_path, contents):
+        """
+        Record the attributes of the supplied path in the contents and its
+        extended attributes in :attr:`xattrs`.
+
+        :return: The stat result and attributes of the path if it should be
+                 copied, otherwise ``None``.
+        """
+        examined = self.examine(source_path)
+        if examined is None:
+            return None
+        stat, attributes, xattrs_path = examined
+
+        contents[source_path] = attributes
+        xattrs = read_xattrs(xattrs_path)
+        if xattrs:
+            self.xattrs[source_path] = xattrs
+
+        if not (S_ISREG(stat.st_mode) or S_ISLNK(stat.st_mode)):
+            # fifos, sockets and devices are only recorded in the contents,
+            # opening them could block forever or read without end.
+            return None
+        return stat, attributes
+
     def handle_one(self, source_path, target_path, contents):
-        contents[source_path] = self.path_attributes(source_path)
+        recorded = self.record_one(source_path, contents)
+        if recorded is None:
+            return
+        stat, attributes = recorded
 
         full_target, split_path = self.relative_path(source_path, target_path)
-        directory = os.sep.join(split_path[:-1])
 
-        ensure_dir_exists(directory)
+        # everything is written to a new file that replaces the target
+        # when the writer is committed, so we never write through a link
+        # or into a file that may be hard linked to another copy.
+        if S_ISLNK(stat.st_mode):
+            self.writer.symlink(attributes[3], full_target)
+            return
 
-        with open(source_path, 'rb') as source:
-            with open(full_target, 'wb') as target:
-                target.write(source.read())
+        key = stat.st_dev, stat.st_ino
+        if key in self.copies:
+            # already copied once during this run, so don't read it again
+            self.writer.link(self.copies[key], full_target)
+        else:
+            self.copies[key] = full_target
+            if self.writer.copy(source_path, full_target, stat):
+                self.progress.copied(stat.st_size)
 
     def process(self, target_path):
 
         contents_path = os.path.join(target_path, 'contents.txt')
         old_contents = self.read_contents_file(contents_path)
         new_contents = {}
+        self.copies = {}
+        self.xattrs = {}
+        self.writer = AtomicWriter(batch_size=self.write_batch)
 
-        for source_path in self.source_paths:
-            if os.path.isfile(source_path):
+        with self.writer:
+            for source_path in self.selected_paths():
                 self.handle_one(source_path, target_path, new_contents)
-            else:
-                for root, dirs, filenames in os.walk(source_path):
-                    for filename in filenames:
-                        self.handle_one(os.path.join(root, filename),
-                                        target_path,
-                                        new_contents)
 
         to_delete = set(old_contents) - set(new_contents)
         for path in to_delete:
             full_target, split_path = self.relative_path(path, target_path)
+            if not os.path.lexists(full_target):
+                # special files have no copy
+                continue
             os.remove(full_target)
+            metrics.inc('archivist_source_files_deleted')
             while True:
                 split_path.pop()
                 directory = os.sep.join(split_path)
@@ -117,3 +350,90 @@ class Plugin(Source):
                 os.rmdir(directory)
 
         self.write_contents_file(new_contents, contents_path)
+        self.write_xattrs_file(self.xattrs,
+                               os.path.join(target_path, 'xattrs.txt'))
+
+    def expected(self, target_path):
+        contents_path = os.path.join(target_path, 'contents.txt')
+        old_contents = self.read_contents_file(contents_path)
+        new_contents = {}
+        self.xattrs = {}
+        expected = {}
+        hashes = {}
+        for source_path in self.selected_paths():
+            recorded = self.record_one(source_path, new_contents)
+            if recorded is None:
+                continue
+            stat, attributes = recorded
+            full_target, _ = self.relative_path(source_path, target_path)
+            key = stat.st_dev, stat.st_ino
+            if S_ISLNK(stat.st_mode):
+                expected[full_target] = content_hash(source_path, stat)
+            else:
+                if key not in hashes:
+                    hashes[key] = content_hash(source_path, stat)
+                expected[full_target] = hashes[key]
+
+        for path in set(old_contents) - set(new_contents):
+            full_target, _ = self.relative_path(path, target_path)
+            expected[full_target] = None
+
+        expected[contents_path] = blob_hash(
+            self.format_contents(new_contents)
+        )
+        xattrs_path = os.path.join(target_path, 'xattrs.txt')
+        if self.xattrs:
+            expected[xattrs_path] = blob_hash(self.format_xattrs(self.xattrs))
+        else:
+            expected[xattrs_path] = None
+        return expected
+
+    def check(self, target_path, committed, read_committed):
+        # the work tree may hold changes that were never committed:
+        contents = self.parse_contents(
+            (read_committed('contents.txt') or '').splitlines()
+        )
+        recorded_xattrs = self.parse_xattrs(read_committed('xattrs.txt') or '')
+        live = {}
+        live_xattrs = {}
+        stats = {}
+        for source_path in self.selected_paths():
+            examined = self.examine(source_path)
+            if examined is not None:
+                stat, live[source_path], xattrs_path = examined
+                xattrs = read_xattrs(xattrs_path)
+                if xattrs:
+                    live_xattrs[source_path] = xattrs
+                if S_ISREG(stat.st_mode) or S_ISLNK(stat.st_mode):
+                    stats[source_path] = stat
+        live_xattrs = self.parse_xattrs(self.format_xattrs(live_xattrs))
+
+        # hashlib releases the GIL while hashing, so large files are
+        # hashed in parallel:
+        pool = ThreadPool(self.hash_workers)
+        try:
+            hashes = dict(zip(stats, pool.map(
+                lambda item: content_hash(*item), stats.items()
+            )))
+        finally:
+            pool.close()
+            pool.join()
+
+        changes = []
+        prefix_length = len(target_path.rstrip(os.sep)) + 1
+        for source_path in sorted(set(live) | set(contents)):
+            if source_path not in contents:
+                changes.append(('added', source_path))
+            elif source_path not in live:
+                changes.append(('deleted', source_path))
+            elif live[source_path] != contents[source_path]:
+                changes.append(('modified', source_path))
+            elif live_xattrs.get(source_path) != \
+                    recorded_xattrs.get(source_path):
+                changes.append(('modified', source_path))
+            elif source_path in hashes:
+                full_target, _ = self.relative_path(source_path, target_path)
+                committed_hash = committed.get(full_target[prefix_length:])
+                if committed_hash != hashes[source_path]:
+                    changes.append(('modified', source_path))
+        return len(live), changes
@@ -0,0 +1,103 @@
+from glob import glob
+from itertools import product
+import os
+from string import Formatter
+
+from voluptuous import Schema, Required, Extra, Any
+
+template_schema = {
+    Required('source'): {Required('type'): str, Extra: object},
+    'matrix': {str: [Any(str, int)]},
+    'glob': {str: str},
+}
+
+formatter = Formatter()
+
+
+def parameter_sets(template):
+    """
+    Return a list of dicts, one for each source the supplied template
+    expands into, mapping parameter names to their values.
+
+    ``matrix`` parameters take each of the values listed for them.
+    ``glob`` parameters take the path of each match for the pattern given
+    for them, with a ``<parameter>_name`` parameter also set to the last
+    part of that path. Every combination of values is used.
+    """
+    names = []
+    choices = []
+    for name, values in sorted(template.get('matrix', {}).items()):
+        names.append((name, ))
+        choices.append([(value, ) for value in values])
+    for name, pattern in sorted(template.get('glob', {}).items()):
+        names.append((name, name+'_name'))
+        choices.append([(path, os.path.basename(path.rstrip(os.sep)))
+                        for path in sorted(glob(pattern))])
+    sets = []
+    for combination in product(*choices):
+        parameters = {}
+        for group, values in zip(names, combination):
+            parameters.update(zip(group, values))
+        sets.append(parameters)
+    return sets
+
+
+def substitute(value, parameters):
+    """
+    Return a copy of the supplied value with the parameters substituted
+    into all the strings it contains using :meth:`str.format`.
+    A string that is just a single parameter is replaced by the value of
+    that parameter, so that its type is kept.
+    """
+    if isinstance(value, dict):
+        return dict((key, substitute(item, parameters))
+                    for key, item in value.items())
+    if isinstance(value, list):
+        return [substitute(item, parameters) for item in value]
+    if isinstance(value, str):
+        parsed = list(formatter.parse(value))
+        if len(parsed) == 1:
+            literal, field, spec, conversion = parsed[0]
+            if not literal and field in parameters and \
+                    not (spec or conversion):
+                return parameters[field]
+        return value.format(**parameters)
+    return value
+
+
+def parameterised(value):
+    if isinstance(value, dict):
+        return any(parameterised(item) for item in value.values())
+    if isinstance(value, list):
+        return any(parameterised(item) for item in value)
+    if isinstance(value, str):
+        return any(field is not None
+                   for _, field, _, _ in formatter.parse(value))
+    return False
+
+
+def parameterised_keys(source):
+    """
+    Return the keys of the supplied template source whose values change
+    from one expansion to the next.
+    """
+    return sorted(key for key, value in source.items() if parameterised(value))
+
+
+def key_validators(schema, keys):
+    """
+    Return a dict mapping each of the supplied keys to a :class:`Schema`
+    that validates just the value for that key, or ``None`` if this can't
+    be done for the supplied schema.
+    """
+    if not isinstance(schema.schema, dict):
+        return None
+    validators = {}
+    for key in keys:
+        for marker, validator in schema.schema.items():
+            if marker == key:
+                validators[key] = Schema(validator)
+                break
+        else:
+            return None
+    return validators
@@ -0,0 +1,182 @@
+from voluptuous import (
+    Schema, Invalid, Required, Optional, Extra, Any, All,
+    ALLOW_EXTRA, REMOVE_EXTRA, UNDEFINED
+)
+
+
+class Mismatch(Exception):
+    """
+    Raised by a compiled validator when data doesn't match its schema.
+    It carries no detail; the full schema should be used to find out
+    what is wrong.
+    """
+
+
+class Unsupported(Exception):
+    """
+    Raised when a schema contains something that can't be compiled.
+    """
+
+
+mismatch = Mismatch()
+
+
+def compile_validator(validator, required=False, extra=None):
+    """
+    Return a function that validates a value against the supplied part of a
+    voluptuous schema in the same way as :class:`~voluptuous.Schema`,
+    raising :class:`Mismatch` instead of building up detailed errors.
+    """
+    if isinstance(validator, Schema):
+        return compile_validator(validator.schema,
+                                 validator.required, validator.extra)
+    if isinstance(validator, dict):
+        return compile_mapping(validator, required, extra)
+    if isinstance(validator, list):
+        return compile_sequence(validator, required, extra)
+    if type(validator) in (Any, All):
+        validators = [compile_validator(v, required, extra)
+                      for v in validator.validators]
+        if isinstance(validator, Any):
+            return compile_any(validators)
+        return compile_all(validators)
+    if isinstance(validator, type):
+        def check_type(value):
+            if isinstance(value, validator):
+                return value
+            raise mismatch
+        return check_type
+    if validator is Extra or hasattr(validator, '__voluptuous_compile__'):
+        raise Unsupported(validator)
+    if callable(validator):
+        def check_callable(value):
+            try:
+                return validator(value)
+            except (Invalid, ValueError):
+                raise mismatch
+        return check_callable
+    if isinstance(validator, (tuple, set, frozenset)):
+        raise Unsupported(validator)
+
+    def check_literal(value):
+        if value == validator:
+            return value
+        raise mismatch
+    return check_literal
+
+
+def compile_any(validators):
+    def check_any(value):
+        for validator in validators:
+            try:
+                return validator(value)
+            except Mismatch:
+                pass
+        raise mismatch
+    return check_any
+
+
+def compile_all(validators):
+    def check_all(value):
+        for validator in validators:
+            value = validator(value)
+        return value
+    return check_all
+
+
+def compile_sequence(schema, required, extra):
+    if not schema:
+        raise Unsupported(schema)
+    check_item = compile_any([compile_validator(v, required, extra)
+                              for v in schema])
+
+    def check_sequence(value):
+        if not isinstance(value, list):
+            raise mismatch
+        return [check_item(item) for item in value]
+    return check_sequence
+
+
+def compile_mapping(schema, required, extra):
+    keys = {}
+    required_keys = set()
+    defaults = {}
+    wildcards = []
+    for key, value in schema.items():
+        validator = compile_validator(value, required, extra)
+        if key is Extra:
+            wildcards.append((object, validator))
+            continue
+        if isinstance(key, type):
+            wildcards.append((key, validator))
+            continue
+        if type(key) in (Required, Optional):
+            if key.default is not UNDEFINED:
+                defaults[key.schema] = key.default
+            if isinstance(key, Required):
+                required_keys.add(key.schema)
+            key = key.schema
+        elif required:
+            required_keys.add(key)
+        if isinstance(key, (str, unicode, int, bool)) or key is None:
+            keys[key] = validator
+        else:
+            raise Unsupported(key)
+    if len(wildcards) > 1:
+        # voluptuous orders these in ways that aren't worth reproducing
+        raise Unsupported(schema)
+    wildcard = wildcards[0] if wildcards else None
+    # keys that must be present once defaults have been inserted:
+    must_have = required_keys - set(defaults)
+
+    def check_mapping(value):
+        if not isinstance(value, dict):
+            raise mismatch
+        for key in must_have:
+            if key not in value:
+                raise mismatch
+        out = {}
+        for key, item in value.items():
+            validator = keys.get(key)
+            if validator is None:
+                if wildcard is not None and isinstance(key, wildcard[0]):
+                    validator = wildcard[1]
+                elif extra == ALLOW_EXTRA:
+                    out[key] = item
+                    continue
+                elif extra == REMOVE_EXTRA:
+                    continue
+                else:
+                    raise mismatch
+            out[key] = validator(item)
+        for key, default in defaults.items():
+            if key not in value:
+                out[key] = keys[key](default())
+        return out
+    return check_mapping
+
+
+def compile_schema(schema):
+    """
+    Return a function that validates data against the supplied
+    :class:`~voluptuous.Schema`, returning the validated data or raising
+    :class:`Mismatch`, or ``None`` if the schema can't be compiled.
+    """
+    try:
+        return compile_validator(schema)
+    except Unsupported:
+        return None
+
+
+compiled = {}
+
+
+def validator_for(schema):
+    """
+    Return the compiled validator for the supplied schema, compiling it
+    the first time it is needed.
+    """
+    entry = compiled.get(id(schema))
+    if entry is None or entry[0] is not schema:
+        entry = compiled[id(schema)] = schema, compile_schema(schema)
+    return entry[1]
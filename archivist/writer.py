@@ -0,0 +1,255 @@
+import os
+from stat import S_ISREG
+from tempfile import mkstemp
+from threading import Lock
+
+from archivist.helpers import (
+    ensure_dir_exists, copy_file, chunk_size, mtime_matches
+)
+from archivist.metrics import metrics
+
+temp_prefix = '.archivist-tmp-'
+
+_umask = None
+_umask_lock = Lock()
+
+
+def umask():
+    """
+    Return the process's umask, which is read the first time it is needed.
+    """
+    global _umask
+    with _umask_lock:
+        if _umask is None:
+            try:
+                with open('/proc/self/status') as status:
+                    for line in status:
+                        if line.startswith('Umask:'):
+                            _umask = int(line.split()[1], 8)
+            except IOError:
+                pass
+        if _umask is None:
+            # the only other way to read it is to set it:
+            _umask = os.umask(0)
+            os.umask(_umask)
+        return _umask
+
+
+def same_bytes(path1, path2):
+    with open(path1, 'rb') as file1:
+        with open(path2, 'rb') as file2:
+            while True:
+                data = file1.read(chunk_size)
+                if data != file2.read(chunk_size):
+                    return False
+                if not data:
+                    return True
+
+
+def same_content(path1, path2):
+    """
+    Check whether two paths have the same content, comparing link targets
+    for symlinks and bytes for files.
+    """
+    try:
+        stat1 = os.lstat(path1)
+        stat2 = os.lstat(path2)
+    except OSError:
+        return False
+    if (stat1.st_dev, stat1.st_ino) == (stat2.st_dev, stat2.st_ino):
+        return True
+    if stat1.st_mode != stat2.st_mode or stat1.st_size != stat2.st_size:
+        return False
+    if os.path.islink(path1):
+        return os.readlink(path1) == os.readlink(path2)
+    return same_bytes(path1, path2)
+
+
+def up_to_date(source_path, path, stat):
+    """
+    Check whether the file at ``path`` already holds a copy of the source
+    file, writing nothing but the copy's modification time.
+    A copy of a different size is out of date without either file being
+    read. Otherwise the bytes are compared, as a file can be edited
+    without changing its size or modification time. If they are the same,
+    the copy is given the source's modification time if it doesn't
+    already have it.
+    """
+    try:
+        target = os.lstat(path)
+    except OSError:
+        return False
+    if not S_ISREG(target.st_mode) or target.st_size != stat.st_size:
+        return False
+    if not same_bytes(source_path, path):
+        return False
+    if not mtime_matches(path, stat.st_mtime):
+        os.utime(path, (target.st_atime, stat.st_mtime))
+    return True
+
+
+class AtomicWriter(object):
+    """
+    Writes files into the archive by way of temporary files in the same
+    directory as their target. Nothing replaces a target until
+    :meth:`commit` is called, at which point all the temporary files are
+    synced to disk and then renamed over their targets. Targets whose
+    content is unchanged are left alone.
+
+    Used as a context manager, changes are committed if the block succeeds
+    and discarded if it raises an exception.
+
+    :param batch_size: if supplied, changes are committed whenever this
+                       many are pending, so that a large number of changes
+                       doesn't need space for all their temporary files at
+                       once. Files returned by :meth:`open` must be closed
+                       before anything else is written when this is used.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        self.pending = []
+        self.removals = []
+        # the temporary file that will replace each target:
+        self.temps = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def temp_path(self, path):
+        directory = os.path.dirname(path)
+        ensure_dir_exists(directory)
+        fd, temp_path = mkstemp(prefix=temp_prefix, dir=directory)
+        os.fchmod(fd, 0666 & ~umask())
+        self.pending.append((temp_path, path))
+        self.temps[path] = temp_path
+        return fd, temp_path
+
+    def added(self):
+        if self.batch_size is not None and \
+                len(self.pending) >= self.batch_size:
+            self.commit()
+
+    def open(self, path):
+        """
+        Return a file opened for writing in binary mode, the contents of
+        which will replace the supplied path.
+        """
+        fd, temp_path = self.temp_path(path)
+        return os.fdopen(fd, 'wb')
+
+    def write(self, path, content):
+        with self.open(path) as target:
+            target.write(content)
+        self.added()
+
+    def copy(self, source_path, path, stat=None):
+        """
+        Arrange for the supplied path to be replaced with a copy of the
+        source path, unless it is already :func:`up_to_date`.
+        The copy is given the source's modification time.
+        Once this has been called, the path may be passed to :meth:`link`.
+
+        :return: ``True`` if a copy was made, ``False`` if the path was
+                 already up to date.
+        """
+        if stat is None:
+            stat = os.stat(source_path)
+        if up_to_date(source_path, path, stat):
+            return False
+        fd, temp_path = self.temp_path(path)
+        os.close(fd)
+        copy_file(source_path, temp_path, stat)
+        os.utime(temp_path, (stat.st_atime, stat.st_mtime))
+        self.added()
+        return True
+
+    def link(self, existing_path, path):
+        """
+        Arrange for the supplied path to be replaced with a hard link to
+        an existing path, which may be a path passed to :meth:`copy`.
+        """
+        existing_path = self.temps.get(existing_path, existing_path)
+        try:
+            if os.path.samefile(existing_path, path):
+                return
+        except OSError:
+            pass
+        fd, temp_path = self.temp_path(path)
+        os.close(fd)
+        os.remove(temp_path)
+        os.link(existing_path, temp_path)
+        self.added()
+
+    def symlink(self, link, path):
+        """
+        Arrange for the supplied path to be replaced with a symlink, unless
+        it already is one to the same place.
+        """
+        if os.path.islink(path) and os.readlink(path) == link:
+            return
+        fd, temp_path = self.temp_path(path)
+        os.close(fd)
+        os.remove(temp_path)
+        os.symlink(link, temp_path)
+        self.added()
+
+    def remove(self, path):
+        """
+        Arrange for the supplied path, if it exists, to be removed when the
+        writer is committed.
+        """
+        self.removals.append(path)
+
+    def commit(self):
+        changed = []
+        for temp_path, path in self.pending:
+            if same_content(temp_path, path):
+                os.remove(temp_path)
+            else:
+                changed.append((temp_path, path))
+        self.pending = []
+        self.temps = {}
+
+        for temp_path, path in changed:
+            metrics.inc('archivist_source_files_copied')
+            metrics.inc('archivist_source_bytes_copied',
+                        os.lstat(temp_path).st_size)
+            if not os.path.islink(temp_path):
+                fd = os.open(temp_path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+        directories = set()
+        for temp_path, path in changed:
+            os.rename(temp_path, path)
+            directories.add(os.path.dirname(path))
+
+        for path in self.removals:
+            if os.path.lexists(path):
+                os.remove(path)
+                directories.add(os.path.dirname(path))
+        self.removals = []
+
+        for directory in directories:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def abort(self):
+        for temp_path, path in self.pending:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+        self.pending = []
+        self.temps = {}
+        self.removals = []
@@ -0,0 +1,89 @@
+from base64 import b64encode
+import ctypes
+import ctypes.util
+from errno import ENOTSUP, ENODATA, EPERM, EACCES, ERANGE
+import os
+
+unsupported = (ENOTSUP, ENODATA, EPERM, EACCES)
+
+
+def _libc_call(function, *args):
+    result = function(*args)
+    if result < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return result
+
+
+#: The size of the buffer names and values are first read into, which is
+#: big enough for nearly all of them.
+buffer_size = 4096
+
+
+def _read(function, *args):
+    # read into a buffer that is nearly always big enough, only asking for
+    # the size needed when it isn't and retrying if it grows in the meantime
+    size = buffer_size
+    while True:
+        buffer = ctypes.create_string_buffer(size)
+        try:
+            length = _libc_call(function, *(args + (buffer, size)))
+        except OSError as e:
+            if e.errno != ERANGE:
+                raise
+            size = _libc_call(function, *(args + (None, 0)))
+            continue
+        return buffer.raw[:length]
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.llistxattr.restype = ctypes.c_ssize_t
+_libc.llistxattr.argtypes = [ctypes.c_char_p, ctypes.c_void_p,
+                             ctypes.c_size_t]
+_libc.lgetxattr.restype = ctypes.c_ssize_t
+_libc.lgetxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p,
+                            ctypes.c_void_p, ctypes.c_size_t]
+
+
+def list_xattrs(path):
+    names = _read(_libc.llistxattr, path)
+    return [name for name in names.split(b'\0') if name]
+
+
+def get_xattr(path, name):
+    return _read(_libc.lgetxattr, path, name)
+
+
+def read_xattrs(path):
+    """
+    Return a sorted list of ``(name, value)`` tuples for the extended
+    attributes of the supplied path, without following symlinks.
+    ACLs, file capabilities and SELinux labels are all stored as extended
+    attributes, so are included.
+    Filesystems that don't support extended attributes give an empty list.
+    """
+    try:
+        names = list_xattrs(path)
+    except OSError as e:
+        if e.errno in unsupported:
+            return []
+        raise
+    xattrs = []
+    for name in sorted(names):
+        try:
+            xattrs.append((name, get_xattr(path, name)))
+        except OSError as e:
+            if e.errno not in unsupported:
+                raise
+    return xattrs
+
+
+def encode_value(value):
+    """
+    Encode an attribute value in the way ``getfattr --dump`` does, as quoted
+    text if it is printable and base64 with a ``0s`` prefix otherwise.
+    """
+    text = value.rstrip(b'\0')
+    if all(32 <= ord(char) < 127 and char not in b'"\\' for char in text):
+        return '"' + text + '"'
+    return '0s' + b64encode(value)
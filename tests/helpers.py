@@ -1,3 +1,7 @@
+import ctypes
+import ctypes.util
+import os
+
 from testfixtures import ShouldRaise, compare, TempDirectory, Replacer
 from testfixtures.popen import MockPopen
 from voluptuous import MultipleInvalid
@@ -24,3 +28,12 @@ class SingleCommandMixin:
         r = Replacer()
         r.replace('archivist.helpers.Popen', self.Popen)
         self.addCleanup(r.restore)
+
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+
+def set_xattr(path, name, value):
+    if _libc.setxattr(path, name, value, len(value), 0):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
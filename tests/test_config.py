@@ -1,13 +1,20 @@
+import marshal
+import os
 from unittest import TestCase
-from testfixtures import TempDirectory, compare, ShouldRaise, Comparison as C
+from mock import Mock
+from testfixtures import (
+    TempDirectory, compare, ShouldRaise, Comparison as C, Replacer,
+    LogCapture
+)
 from voluptuous import Required, Schema, ALLOW_EXTRA
 from archivist.config import (
-    Config, ConfigError, default_repo_config,
+    Config, ConfigError, FragmentCache, default_repo_config,
     default_notifications_config
 )
 from archivist.plugins import (
     Plugins, Repo, Source, Notifier
 )
+from archivist.templates import parameter_sets
 
 
 def config(item):
@@ -403,6 +410,594 @@ sources:
                 ]
             ))
 
+    def test_limits(self):
+        self.check_parses(
+            """
+limits:
+  run_timeout: 3600
+  timeout: 60.5
+  max_files: 1000
+  max_file_size: 1048576
+sources:
+- some: thing
+""",
+            dict(
+                notifications=[default_notifications_config],
+                repos=[default_repo_config],
+                sources=[
+                    dict(type='some', name='thing', repo='config')
+                ],
+                limits=dict(run_timeout=3600, timeout=60.5,
+                            max_files=1000, max_file_size=1048576),
+            ))
+
+    def test_lock(self):
+        self.check_parses(
+            """
+lock:
+  mode: wait
+  timeout: 600
+sources:
+- some: thing
+""",
+            dict(
+                notifications=[default_notifications_config],
+                repos=[default_repo_config],
+                sources=[
+                    dict(type='some', name='thing', repo='config')
+                ],
+                lock=dict(mode='wait', timeout=600),
+            ))
+
+    def test_concurrency(self):
+        self.check_parses(
+            """
+concurrency: 4
+sources:
+- some: thing
+""",
+            dict(
+                notifications=[default_notifications_config],
+                repos=[default_repo_config],
+                sources=[
+                    dict(type='some', name='thing', repo='config')
+                ],
+                concurrency=4,
+            ))
+
+    def test_invalid_concurrency(self):
+        self.check_config_error(
+            """
+concurrency: 0
+sources:
+- some: thing
+""",
+            '''\
+at ['concurrency'], value must be at least 1:
+concurrency: 0
+sources:
+- some: thing
+''')
+
+    def test_invalid_lock_mode(self):
+        self.check_config_error(
+            """
+lock:
+  mode: barge
+sources:
+- some: thing
+""",
+            '''\
+at ['lock', 'mode'], not a valid value:
+mode: barge
+''')
+
+    def test_lock_cannot_be_stolen(self):
+        self.check_config_error(
+            """
+lock:
+  mode: steal
+sources:
+- some: thing
+""",
+            '''\
+at ['lock', 'mode'], not a valid value:
+mode: steal
+''')
+
+    def test_metrics(self):
+        self.check_parses(
+            """
+metrics:
+  textfile: /var/lib/node_exporter/archivist.prom
+sources:
+- some: thing
+""",
+            dict(
+                notifications=[default_notifications_config],
+                repos=[default_repo_config],
+                sources=[
+                    dict(type='some', name='thing', repo='config')
+                ],
+                metrics=dict(textfile='/var/lib/node_exporter/archivist.prom'),
+            ))
+
+    def test_profile(self):
+        self.check_parses(
+            """
+profile:
+  directory: /tmp/profiles
+  sources: [paths]
+sources:
+- some: thing
+""",
+            dict(
+                notifications=[default_notifications_config],
+                repos=[default_repo_config],
+                sources=[
+                    dict(type='some', name='thing', repo='config')
+                ],
+                profile=dict(directory='/tmp/profiles',
+                             profilers=['cprofile'],
+                             sources=['paths']),
+            ))
+
+    def test_invalid_limits(self):
+        self.check_config_error(
+            """
+limits:
+  max_files: lots
+sources:
+- some: thing
+""",
+            '''\
+at ['limits', 'max_files'], expected int:
+max_files: lots
+''')
+
+
+class TestIncludes(WithTempDir, TestCase):
+
+    check_config_error = TestParse.__dict__['check_config_error']
+    check_parses = TestParse.__dict__['check_parses']
+
+    def test_directory_and_file(self):
+        self.dir.write('conf.d/b.yaml', """
+sources:
+- type: paths
+  repo: other
+  values: [/b]
+""")
+        self.dir.write('conf.d/a.yaml', """
+repos:
+- type: git
+  name: other
+  path: /other
+sources:
+- type: paths
+  name: a
+  repo: other
+  values: [/a]
+""")
+        self.dir.write('conf.d/ignored.txt', 'rubbish')
+        self.dir.write('extra.yaml', """
+notifications:
+- stream: stdout
+""")
+        self.check_parses("""
+include:
+- conf.d
+- extra.yaml
+limits:
+  max_files: 10
+sources:
+- type: crontab
+  name: root
+  repo: other
+""", dict(
+            repos=[dict(type='git', name='other', path='/other')],
+            sources=[
+                dict(type='crontab', name='root', repo='other'),
+                dict(type='paths', name='a', repo='other', values=['/a']),
+                dict(type='paths', name=None, repo='other', values=['/b']),
+            ],
+            notifications=[dict(type='stream', name='stdout')],
+            limits=dict(max_files=10),
+        ))
+
+    def test_only_includes(self):
+        self.dir.write('conf.d/a.yaml', """
+sources:
+- crontab: root
+""")
+        self.check_parses("""
+include: [conf.d]
+""", dict(
+            repos=[default_repo_config],
+            sources=[dict(type='crontab', name='root', repo='config')],
+            notifications=[default_notifications_config],
+        ))
+
+    def test_glob_and_nested(self):
+        self.dir.write('one/a.yaml', """
+include: [../two/*.yaml]
+sources:
+- crontab: a
+""")
+        self.dir.write('two/b.yaml', """
+sources:
+- crontab: b
+""")
+        self.check_parses("""
+include: [one/a.yaml, '*.missing']
+""", dict(
+            repos=[default_repo_config],
+            sources=[dict(type='crontab', name='a', repo='config'),
+                     dict(type='crontab', name='b', repo='config')],
+            notifications=[default_notifications_config],
+        ))
+
+    def test_no_sources(self):
+        self.dir.makedir('conf.d')
+        with ShouldRaise(ConfigError) as s:
+            Config.parse(open(self.dir.write('test.yaml',
+                                             'include: [conf.d]')))
+        self.assertTrue(str(s.raised).startswith('no sources configured'))
+
+    def test_missing(self):
+        with ShouldRaise(ConfigError) as s:
+            Config.parse(open(self.dir.write('test.yaml',
+                                             'include: [nothere.yaml]')))
+        compare(str(s.raised).splitlines()[0],
+                "included file {!r} does not exist: ".format(
+                    self.dir.getpath('nothere.yaml')
+                ))
+
+    def test_loop(self):
+        self.dir.write('a.yaml', 'include: [test.yaml]')
+        with ShouldRaise(ConfigError) as s:
+            Config.parse(open(self.dir.write('test.yaml',
+                                             'include: [a.yaml]')))
+        compare(str(s.raised).splitlines()[0],
+                "{!r} is included more than once: ".format(
+                    self.dir.getpath('test.yaml')
+                ))
+
+    def test_duplicate_names_across_fragments(self):
+        self.dir.write('conf.d/a.yaml', 'sources: [{crontab: root}]')
+        path = self.dir.write('conf.d/b.yaml', """
+sources:
+- crontab: other
+- crontab: root
+""")
+        self.check_config_error("""
+include: [conf.d]
+""", """in {}:
+at ['sources', 1], more than one source of type 'crontab' named 'root':
+name: root
+repo: config
+type: crontab
+""".format(path))
+
+    def test_plugin_error_in_fragment(self):
+        path = self.dir.write('conf.d/a.yaml', """
+sources:
+- crontab: root
+- paths: [/not/there]
+""")
+        source = open(self.dir.write('test.yaml', """
+include: [conf.d]
+sources:
+- crontab: other
+"""))
+        with ShouldRaise(ConfigError) as s:
+            Config.load(source, Plugins.load())
+        compare(str(s.raised).splitlines()[:2], [
+            'in {}:'.format(path),
+            "at ['sources', 1, 'values', 0], '/not/there' does not exist: "
+        ])
+
+    def test_invalid_fragment(self):
+        path = self.dir.write('conf.d/a.yaml', 'limits: {max_files: 1}')
+        self.check_config_error("""
+include: [conf.d]
+""", """\
+in {}:
+at ['limits'], extra keys not allowed:
+limits:
+  max_files: 1
+""".format(path))
+
+    def parse(self, path, cache):
+        # as Config.load does once the config has been realised:
+        data = Config.parse(open(path), cache)
+        cache.save()
+        return data
+
+    def test_fragments_cached(self):
+        a = self.dir.write('conf.d/a.yaml', 'sources: [{crontab: a}]')
+        b = self.dir.write('conf.d/b.yaml', 'sources: [{crontab: b}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('cache/fragments.marshal')
+        check_schema = Mock(side_effect=Config.check_schema)
+        with Replacer() as r:
+            r.replace('archivist.config.Config.check_schema', check_schema)
+            self.parse(config, FragmentCache(cache_path))
+            compare(3, check_schema.call_count)
+            self.dir.write('conf.d/b.yaml', 'sources: [{crontab: c}]')
+            os.utime(b, (0, 0))
+            # a later run, with a cache loaded from disk:
+            data = self.parse(config, FragmentCache(cache_path))
+        # only the top level and the changed fragment are checked again:
+        compare(5, check_schema.call_count)
+        compare(['a', 'c'], [source['name'] for source in data['sources']])
+        # cached data isn't changed by the checks on the merged config:
+        cache = FragmentCache(cache_path)
+        compare({'sources': [{'type': 'crontab', 'name': 'a'}]},
+                cache.get(os.path.realpath(a), os.stat(a)))
+
+    def test_fragment_touched(self):
+        a = self.dir.write('conf.d/a.yaml', 'sources: [{crontab: a}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('fragments.marshal')
+        self.parse(config, FragmentCache(cache_path))
+        os.utime(a, (0, 0))
+        check_schema = Mock(side_effect=Config.check_schema)
+        with Replacer() as r:
+            r.replace('archivist.config.Config.check_schema', check_schema)
+            data = self.parse(config, FragmentCache(cache_path))
+        # same content, so only the top level is checked:
+        compare(1, check_schema.call_count)
+        compare(['a'], [source['name'] for source in data['sources']])
+        # and the new modification time is stored:
+        compare(0, marshal.load(open(cache_path, 'rb'))['entries'][
+            os.path.realpath(a)
+        ][1])
+
+    def test_fragment_cache_other_version(self):
+        self.dir.write('conf.d/a.yaml', 'sources: [{crontab: a}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('fragments.marshal')
+        self.parse(config, FragmentCache(cache_path, '1.0'))
+        check_schema = Mock(side_effect=Config.check_schema)
+        with Replacer() as r:
+            r.replace('archivist.config.Config.check_schema', check_schema)
+            self.parse(config, FragmentCache(cache_path, '1.1'))
+        compare(2, check_schema.call_count)
+
+    def test_fragment_cache_unreadable(self):
+        self.dir.write('conf.d/a.yaml', 'sources: [{crontab: a}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.write('fragments.marshal', 'rubbish')
+        data = self.parse(config, FragmentCache(cache_path))
+        compare(['a'], [source['name'] for source in data['sources']])
+        compare(['a'], [source['name'] for source in
+                        self.parse(config, FragmentCache(cache_path))['sources']])
+
+    def test_invalid_config_not_cached(self):
+        self.dir.write('conf.d/a.yaml', 'sources: [{crontab: a}]')
+        self.dir.write('conf.d/b.yaml', 'sources: [{crontab: a}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('fragments.marshal')
+        with ShouldRaise(ConfigError):
+            self.parse(config, FragmentCache(cache_path))
+        self.assertFalse(os.path.exists(cache_path))
+
+    def test_invalid_plugin_config_not_cached(self):
+        self.dir.write('conf.d/a.yaml', 'sources: [{paths: [/not/there]}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('fragments.marshal')
+        with ShouldRaise(ConfigError):
+            Config.load(open(config), Plugins.load(),
+                        FragmentCache(cache_path))
+        self.assertFalse(os.path.exists(cache_path))
+
+    def test_valid_config_cached(self):
+        self.dir.write('conf.d/a.yaml', 'sources: [{crontab: a}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('fragments.marshal')
+        Config.load(open(config), Plugins.load(), FragmentCache(cache_path))
+        self.assertTrue(os.path.exists(cache_path))
+
+    def test_unmarshallable_fragment_not_cached(self):
+        path = self.dir.write('conf.d/a.yaml', """
+sources:
+- type: crontab
+  name: a
+  since: 2020-01-01
+""")
+        self.dir.write('conf.d/b.yaml', 'sources: [{crontab: b}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('cache/fragments.marshal')
+        for i in range(2):
+            with LogCapture() as log:
+                data = self.parse(config, FragmentCache(cache_path))
+            log.check((
+                'archivist.config', 'WARNING',
+                'not caching {} as it contains values that cannot be '
+                'stored'.format(os.path.realpath(path))
+            ))
+            compare(['a', 'b'],
+                    [source['name'] for source in data['sources']])
+        # the other fragment is cached and no temporary files are left:
+        self.dir.compare(['fragments.marshal'], path='cache')
+
+    def test_save_failure_cleaned_up(self):
+        self.dir.write('conf.d/a.yaml', 'sources: [{crontab: a}]')
+        config = self.dir.write('test.yaml', 'include: [conf.d]')
+        cache_path = self.dir.getpath('cache/fragments.marshal')
+        with Replacer() as r:
+            r.replace('archivist.config.marshal.dump',
+                      Mock(side_effect=ValueError('unmarshallable object')))
+            with LogCapture() as log:
+                self.parse(config, FragmentCache(cache_path))
+        log.check((
+            'archivist.config', 'DEBUG',
+            'could not write fragment cache to {}: '
+            'unmarshallable object'.format(cache_path)
+        ))
+        self.dir.compare([], path='cache')
+
+
+class TestTemplates(WithTempDir, TestCase):
+
+    check_config_error = TestParse.__dict__['check_config_error']
+    check_parses = TestParse.__dict__['check_parses']
+
+    def test_parse(self):
+        self.check_parses("""
+templates:
+- source:
+    type: crontab
+    name: '{user}'
+  matrix:
+    user: [alice, bob]
+""", dict(
+            repos=[default_repo_config],
+            sources=[],
+            notifications=[default_notifications_config],
+            templates=[dict(
+                source=dict(type='crontab', name='{user}', repo='config'),
+                matrix=dict(user=['alice', 'bob']),
+                parameters=[dict(user='alice'), dict(user='bob')],
+            )],
+        ))
+
+    def test_names_clash(self):
+        self.check_config_error("""
+sources:
+- crontab: alice
+templates:
+- source:
+    type: crontab
+    name: '{user}'
+  matrix:
+    user: [alice, bob]
+""", """\
+more than one source of type 'crontab' named 'alice':
+name: alice
+repo: config
+type: crontab
+""")
+
+    def test_invalid_repo(self):
+        self.check_config_error("""
+sources:
+- crontab: alice
+templates:
+- source:
+    type: crontab
+    repo: '{user}'
+  matrix:
+    user: [config, other]
+""", """\
+source specifies invalid repo 'other':
+name: null
+repo: other
+type: crontab
+""")
+
+    def test_unknown_parameter(self):
+        self.check_config_error("""
+templates:
+- source:
+    type: crontab
+    name: '{usr}'
+  matrix:
+    user: [alice]
+""", """\
+invalid template parameter: 'usr':
+matrix:
+  user:
+  - alice
+parameters:
+- user: alice
+source:
+  name: '{usr}'
+  type: crontab
+""")
+
+    def test_in_fragment(self):
+        self.dir.write('conf.d/users.yaml', """
+templates:
+- source:
+    type: crontab
+    name: '{user}'
+  matrix:
+    user: [alice]
+""")
+        data = Config.parse(open(self.dir.write('test.yaml', """
+include: [conf.d]
+""")))
+        compare([dict(user='alice')], data['templates'][0]['parameters'])
+
+
+class TestRealiseTemplates(TestCase):
+
+    def plugins(self):
+        class DummySource(Source):
+            schema = Schema({
+                'type': 'bar',
+                'name': str,
+                'repo': str,
+                Required('path', default='/default'): str,
+                'count': int,
+            })
+            def __init__(self, type, name, repo, path, count=None):
+                super(DummySource, self).__init__(type, name, repo)
+                self.path = path
+                self.count = count
+            def process(self, path):
+                pass
+        plugins = Plugins()
+        plugins.register('source', 'bar', DummySource)
+        return plugins
+
+    def realise(self, template, plugins=None):
+        template['parameters'] = parameter_sets(template)
+        return Config.realise(dict(repos=[], notifications=[], sources=[],
+                                   templates=[template]),
+                              plugins or self.plugins())
+
+    def test_expansions(self):
+        plugins = self.plugins()
+        schema = plugins.get('source', 'bar').schema
+        with Replacer() as r:
+            r.replace('archivist.config.Config.check_schema',
+                      Mock(side_effect=Config.check_schema))
+            config = self.realise(dict(
+                source=dict(type='bar', name='{n}', repo='config',
+                            limits=dict(max_files=1)),
+                matrix=dict(n=['a', 'b', 'c'])
+            ), plugins)
+            check_schema = Config.check_schema
+        compare([
+            C(plugins.get('source', 'bar'), type='bar', name=n,
+              repo='config', path='/default', count=None,
+              limits=dict(max_files=1),
+              config=dict(type='bar', name=n, repo='config',
+                          path='/default'))
+            for n in 'abc'
+        ], config.sources)
+        # the plugin's full schema is only used once:
+        compare(1, len([c for c in check_schema.call_args_list
+                        if c[0][1] is schema]))
+
+    def test_invalid_expansion(self):
+        with ShouldRaise(ConfigError) as s:
+            self.realise(dict(
+                source=dict(type='bar', name='x{n}', repo='config',
+                            count='{n}'),
+                matrix=dict(n=[1, 'x'])
+            ))
+        compare(str(s.raised), """\
+at ['templates', 0, 'source', 'count'], expected int: 
+count: x
+name: xx
+repo: config
+type: bar
+""", trailing_whitespace=False)
+
 
 class TestRealise(TestCase):
 
@@ -539,7 +1134,8 @@ type: foo
 
         compare({'po': C(DummyRepo, type='foo', name='po', x=1)},
                 config.repos)
-        compare([C(DummySource, y=2, type='bar', repo='po', name=None)],
+        compare([C(DummySource, y=2, type='bar', repo='po', name=None,
+                   config=dict(type='bar', y=2, repo='po', name=None))],
                 config.sources)
         compare([C(DummyNotifier,
                    type='baz', name=None,
@@ -548,6 +1144,82 @@ type: foo
                    )],
                 config.notifications)
 
+    def source_plugins(self):
+        class DummySource(Source):
+            schema = Schema({}, extra=ALLOW_EXTRA)
+            def __init__(self, type, name, repo):
+                super(DummySource, self).__init__(type, name, repo)
+            def process(self, path):
+                pass
+        plugins = Plugins()
+        plugins.register('source', 'bar', DummySource)
+        return plugins
+
+    def test_limits(self):
+        config = Config.realise(dict(repos=[], notifications=[],
+                                     sources=[dict(type='bar', repo='po',
+                                                   name=None)],
+                                     limits=dict(run_timeout=10)),
+                                self.source_plugins())
+        compare(dict(run_timeout=10), config.limits)
+        compare({}, config.sources[0].limits)
+
+    def test_concurrency(self):
+        config = Config.realise(dict(repos=[], notifications=[],
+                                     sources=[dict(type='bar', repo='po',
+                                                   name=None)],
+                                     concurrency=3),
+                                self.source_plugins())
+        compare(3, config.concurrency)
+
+    def test_source_limits(self):
+        source_config = dict(type='bar', repo='po', name=None,
+                             limits=dict(timeout=5))
+        config = Config.realise(dict(repos=[], notifications=[],
+                                     sources=[source_config]),
+                                self.source_plugins())
+        compare({}, config.limits)
+        compare(dict(timeout=5), config.sources[0].limits)
+        # config data is left alone:
+        compare(dict(timeout=5), source_config['limits'])
+
+    def test_invalid_source_limits(self):
+        self.check_config_error(
+            config=dict(repos=[], notifications=[],
+                        sources=[dict(type='bar', repo='po', name=None,
+                                      limits=dict(timeout='x'))]),
+            plugins=self.source_plugins(),
+            expected="""\
+at ['sources', 0, 'limits', 'timeout'], expected int:
+timeout: x
+"""
+        )
+
+    def test_repo_rejects_sources(self):
+        class DummyRepo(Repo):
+            schema = Schema({}, extra=ALLOW_EXTRA)
+            def __init__(self, type, name):
+                super(DummyRepo, self).__init__(type, name)
+            def actions(self):
+                pass
+            def path_for(self, source):
+                pass
+            def check_sources(self, sources):
+                return '{} sources is too many'.format(len(sources))
+        plugins = self.source_plugins()
+        plugins.register('repo', 'foo', DummyRepo)
+        self.check_config_error(
+            config=dict(repos=[dict(type='foo', name='po')], notifications=[],
+                        sources=[dict(type='bar', repo='po', name=None),
+                                 dict(type='bar', repo='other', name='x')]),
+            plugins=plugins,
+            expected="""\
+1 sources is too many:
+name: po
+type: foo
+"""
+        )
+
     def test_custom_error_message(self):
         # XXX
         pass
@@ -604,12 +1276,16 @@ notifications:
             C(Config,
               repos=dict(config=C(DummyGit, type='git', name='config')),
               sources=[C(DummyPath,
-                         type='path', repo='config', name='/some/path')],
+                         type='path', repo='config', name='/some/path',
+                         config=dict(type='path', repo='config',
+                                     name='/some/path'))],
               notifications=[
                   C(DummyEmail,
                     type='email', name='test@example.com',
                     level=0, fmt='f', datefmt='d')
-              ]),
+              ],
+              limits={}, lock={}, metrics={},
+              profile={}, concurrency=1),
             config
         )
 
@@ -631,12 +1307,44 @@ sources:
             C(Config,
               repos=dict(config=C(git, strict=False, **default_repo_config)),
               sources=[C(paths, type='paths', repo='config', name=None,
-                         source_paths=[file_path])],
+                         source_paths=[file_path], include=None,
+                         exclude=None, types=None,
+                         follow_links=False, copies={}, xattrs={},
+                         config=dict(type='paths', repo='config', name=None,
+                                     values=[file_path]))],
               notifications=[
                   C(stream, strict=False, **default_notifications_config)
-              ]),
+              ],
+              limits={}, lock={}, metrics={},
+              profile={}, concurrency=1),
             config
         )
 
 
 
+
+    def test_paths_template(self):
+        for host in 'a', 'b':
+            self.dir.write('hosts/{}/file'.format(host), host)
+        source = open(self.dir.write('test.yaml', """
+repos:
+- type: git
+  name: config
+  path: {archive}
+templates:
+- source:
+    type: paths
+    name: '{{host}}'
+    values: ['{hosts}/{{host}}']
+  matrix:
+    host: [a, b]
+""".format(archive=self.dir.getpath('archive'),
+           hosts=self.dir.getpath('hosts'))))
+        config = Config.load(source, Plugins.load())
+        compare(['a', 'b'], [s.name for s in config.sources])
+        for s in config.sources:
+            s.process(config.repo_for(s).path_for(s))
+        for host in 'a', 'b':
+            compare(host, self.dir.read('archive/paths/{}{}/file'.format(
+                host, self.dir.getpath('hosts/' + host)
+            )))
@@ -1,9 +1,19 @@
+from errno import EINVAL, EBADF
 import os
 from unittest import TestCase
 import sys
 
-from testfixtures import TempDirectory, compare, ShouldRaise, OutputCapture
-from archivist.helpers import run, CalledProcessError
+from testfixtures import (
+    TempDirectory, compare, ShouldRaise, OutputCapture, Replacer
+)
+from threading import BoundedSemaphore
+from time import time
+
+from archivist.helpers import (
+    run, CalledProcessError, copy_file, data_ranges, content_hash, run_all,
+    iter_lines
+)
+from archivist.limits import LimitExceeded
 
 
 class TestRun(TestCase):
@@ -64,3 +74,191 @@ stderr:
         output.compare('')
         compare(result, 'hello out there\n')
 
+
+    def test_timeout_not_reached(self):
+        result = self.run_command("import sys; sys.stdout.write('okay')",
+                                  timeout=30)
+        compare(result, 'okay')
+
+    def test_timeout(self):
+        with ShouldRaise(LimitExceeded) as s:
+            self.run_command("import time; time.sleep(30)", timeout=0.1)
+        compare(str(s.raised), '{!r} took longer than 0.1s'.format(
+            [sys.executable, self.path]
+        ))
+
+    def test_no_time_left(self):
+        with ShouldRaise(LimitExceeded("no time left to run ['foo']")):
+            run(['foo'], timeout=0)
+
+
+class TestRunAll(TestCase):
+
+    def python(self, code):
+        return [sys.executable, '-c', code]
+
+    def test_order(self):
+        compare(['1', '2', '3'], run_all([
+            self.python("import sys, time; time.sleep(0.2); "
+                        "sys.stdout.write('1')"),
+            self.python("import sys; sys.stdout.write('2')"),
+            self.python("import sys; sys.stdout.write('3')"),
+        ]))
+
+    def test_concurrent(self):
+        start = time()
+        run_all([self.python('import time; time.sleep(0.5)')] * 4)
+        self.assertTrue(time() - start < 1.5)
+
+    def test_limited(self):
+        start = time()
+        with Replacer() as r:
+            r.replace('archivist.helpers.command_slots', BoundedSemaphore(1))
+            run_all([self.python('import time; time.sleep(0.3)')] * 3)
+        self.assertTrue(time() - start >= 0.9)
+
+    def test_first_error_raised(self):
+        with ShouldRaise(CalledProcessError) as s:
+            run_all([
+                self.python("import sys"),
+                self.python("import sys; sys.exit(2)"),
+                self.python("import sys; sys.exit(3)"),
+            ])
+        compare(2, s.raised.returncode)
+
+    def test_timeout(self):
+        with ShouldRaise(LimitExceeded):
+            run_all([self.python('import time; time.sleep(30)')] * 2,
+                    timeout=0.1)
+
+    def test_empty(self):
+        compare([], run_all([]))
+
+
+class TestIterLines(TestCase):
+
+    def python(self, code):
+        return [sys.executable, '-c', code]
+
+    def test_lines(self):
+        compare(['a\n', 'b\n', 'c'], list(iter_lines(self.python(
+            "import sys; sys.stdout.write('a\\nb\\nc')"
+        ))))
+
+    def test_streamed(self):
+        lines = iter_lines(self.python(
+            "import sys, time; print 'first'; sys.stdout.flush(); "
+            "time.sleep(30)"
+        ), timeout=5)
+        start = time()
+        compare('first\n', next(lines))
+        self.assertTrue(time() - start < 5)
+        # stopping early kills the command:
+        lines.close()
+
+    def test_error(self):
+        with ShouldRaise(CalledProcessError) as s:
+            list(iter_lines(self.python(
+                "import sys; print 'out'; sys.stderr.write('bad'); "
+                "sys.exit(1)"
+            )))
+        compare(1, s.raised.returncode)
+        compare('bad', s.raised.stderr)
+
+    def test_timeout(self):
+        with ShouldRaise(LimitExceeded):
+            list(iter_lines(self.python('import time; time.sleep(30)'),
+                            timeout=0.1))
+
+    def test_no_time_left(self):
+        with ShouldRaise(LimitExceeded("no time left to run ['foo']")):
+            list(iter_lines(['foo'], timeout=0))
+
+
+class TestCopyFile(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def make_sparse(self, *chunks):
+        path = self.dir.getpath('source')
+        with open(path, 'wb') as source:
+            for offset, data in chunks:
+                source.seek(offset)
+                source.write(data)
+        return path
+
+    def test_normal(self):
+        source = self.dir.write('source', b'content')
+        copy_file(source, self.dir.getpath('target'))
+        compare(b'content', self.dir.read('target'))
+
+    def test_overwrite_longer(self):
+        source = self.dir.write('source', b'short')
+        self.dir.write('target', b'much longer content')
+        copy_file(source, self.dir.getpath('target'))
+        compare(b'short', self.dir.read('target'))
+
+    def test_sparse(self):
+        source = self.make_sparse((0, b'start'), (8 << 20, b'end'))
+        target = self.dir.getpath('target')
+        copy_file(source, target)
+        compare(b'start' + b'\0' * ((8 << 20) - 5) + b'end',
+                self.dir.read('target'))
+        self.assertTrue(os.stat(target).st_blocks <= os.stat(source).st_blocks)
+
+    def test_sparse_trailing_hole(self):
+        source = self.make_sparse((0, b'start'))
+        with open(source, 'ab') as f:
+            f.truncate(8 << 20)
+        copy_file(source, self.dir.getpath('target'))
+        compare(8 << 20, os.path.getsize(self.dir.getpath('target')))
+
+    def test_data_ranges_no_hole_support(self):
+        path = self.dir.write('source', b'content')
+        def lseek(fd, offset, whence):
+            raise OSError(EINVAL, 'not supported')
+        fd = os.open(path, os.O_RDONLY)
+        self.addCleanup(os.close, fd)
+        with Replacer() as r:
+            r.replace('os.lseek', lseek)
+            compare([(0, 7)], list(data_ranges(fd, 7)))
+
+    def test_data_ranges_other_error(self):
+        def lseek(fd, offset, whence):
+            raise OSError(EBADF, 'bad')
+        with Replacer() as r:
+            r.replace('os.lseek', lseek)
+            with ShouldRaise(OSError(EBADF, 'bad')):
+                list(data_ranges(-1, 7))
+
+
+class TestContentHash(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def git_hash(self, path):
+        return run(['git', 'hash-object', path]).strip()
+
+    def test_file(self):
+        path = self.dir.write('file', b'some content\n')
+        compare(self.git_hash(path), content_hash(path))
+
+    def test_empty(self):
+        path = self.dir.write('file', b'')
+        compare(self.git_hash(path), content_hash(path))
+
+    def test_link(self):
+        path = self.dir.getpath('link')
+        os.symlink('/some/target', path)
+        target = self.dir.write('target', b'/some/target')
+        compare(self.git_hash(target), content_hash(path))
+
+    def test_link_followed(self):
+        target = self.dir.write('target', b'content')
+        path = self.dir.getpath('link')
+        os.symlink(target, path)
+        compare(self.git_hash(target), content_hash(path, os.stat(path)))
@@ -0,0 +1,152 @@
+import sqlite3
+from unittest import TestCase
+
+from testfixtures import compare, TempDirectory
+
+from archivist.ledger import Ledger, median
+
+
+def source(name='etc', duration=1.0, files=10, bytes=1000, changes=0,
+           skipped=0, status='ok'):
+    return dict(type='paths', name=name, duration=duration, files=files,
+                bytes=bytes, changes=changes, skipped=skipped, status=status)
+
+
+class TestMedian(TestCase):
+
+    def test_odd(self):
+        compare(2, median([3, 1, 2]))
+
+    def test_even(self):
+        compare(2.5, median([4, 1, 3, 2]))
+
+
+class TestLedger(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.ledger = self.open()
+
+    def open(self):
+        ledger = Ledger(self.dir.getpath('ledger.sqlite'))
+        self.addCleanup(ledger.close)
+        return ledger
+
+    def test_record_and_history(self):
+        compare(1, self.ledger.record(100, 5, [source(duration=1.0),
+                                               source('var', duration=2.0)]))
+        compare(2, self.ledger.record(200, 6, [source(duration=3.0)]))
+        compare([3.0, 1.0], [row['duration'] for row in
+                             self.ledger.history('paths', 'etc', 10)])
+        compare([2.0], [row['duration'] for row in
+                        self.ledger.history('paths', 'var', 10)])
+        compare([3.0], [row['duration'] for row in
+                        self.ledger.history('paths', 'etc', 1)])
+
+    def test_reopened(self):
+        self.ledger.record(100, 5, [source()])
+        self.ledger.close()
+        ledger = self.open()
+        ledger.record(200, 5, [source()])
+        compare(2, len(ledger.history('paths', 'etc', 10)))
+
+    def test_skipped_runs_ignored(self):
+        self.ledger.record(100, 5, [source(duration=1.0)])
+        self.ledger.record(200, 5, [source(duration=0.0, skipped=1,
+                                           status='skipped')])
+        compare([1.0], [row['duration'] for row in
+                        self.ledger.history('paths', 'etc', 10)])
+
+    def test_aborted_runs_ignored(self):
+        self.ledger.record(100, 5, [source(duration=1.0)])
+        self.ledger.record(200, 5, [source(duration=9.0, status='aborted')])
+        compare([1.0], [row['duration'] for row in
+                        self.ledger.history('paths', 'etc', 10)])
+        compare(['ok', 'aborted'], [row[0] for row in
+                                    self.ledger.connection.execute(
+            'SELECT status FROM sources ORDER BY run'
+        )])
+
+    def test_migrated(self):
+        self.ledger.close()
+        path = self.dir.getpath('old.sqlite')
+        connection = sqlite3.connect(path)
+        connection.executescript("""
+CREATE TABLE runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE TABLE sources (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    duration REAL NOT NULL,
+    files INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    changes INTEGER NOT NULL,
+    skipped INTEGER NOT NULL
+);
+CREATE INDEX sources_by_run ON sources (type, name, run);
+INSERT INTO runs VALUES (1, 100, 5);
+INSERT INTO sources VALUES (1, 'paths', 'etc', 1.0, 10, 1000, 0, 0);
+INSERT INTO runs VALUES (2, 200, 5);
+INSERT INTO sources VALUES (2, 'paths', 'etc', 0.0, 0, 0, 0, 1);
+""")
+        connection.close()
+        ledger = Ledger(path)
+        self.addCleanup(ledger.close)
+        ledger.record(300, 5, [source(duration=2.0)])
+        compare([2.0, 1.0], [row['duration'] for row in
+                             ledger.history('paths', 'etc', 10)])
+        compare(['sources_by_status'], [row[0] for row in
+                                        ledger.connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )])
+
+    def test_trend_steady(self):
+        for duration in 1.0, 1.2, 0.9, 1.1:
+            self.ledger.record(100, 5, [source(duration=duration)])
+        trend = self.ledger.trend('paths', 'etc')
+        compare(1.1, trend.duration)
+        compare(1.0, trend.baseline)
+        compare(3, trend.runs)
+        compare(False, trend.regressed)
+        compare("paths source 'etc': 1.10s, 10 files, 0.0 MB, "
+                "typically 1.00s over 3 runs", str(trend))
+
+    def test_trend_regressed(self):
+        for duration in 1.0, 1.0, 8.0, 1.0, 2.5:
+            self.ledger.record(100, 5, [source(duration=duration)])
+        trend = self.ledger.trend('paths', 'etc', runs=3)
+        compare(1.0, trend.baseline)
+        compare(3, trend.runs)
+        compare(True, trend.regressed)
+        compare("paths source 'etc': 2.50s, 10 files, 0.0 MB, "
+                "typically 1.00s over 3 runs, REGRESSED", str(trend))
+        compare(False, self.ledger.trend('paths', 'etc', runs=3,
+                                         threshold=3).regressed)
+
+    def test_trend_one_run(self):
+        self.ledger.record(100, 5, [source(bytes=2500000)])
+        trend = self.ledger.trend('paths', 'etc')
+        compare(None, trend.baseline)
+        compare(False, trend.regressed)
+        compare("paths source 'etc': 1.00s, 10 files, 2.5 MB", str(trend))
+
+    def test_trend_no_runs(self):
+        trend = self.ledger.trend('paths', '')
+        compare(False, trend.regressed)
+        compare("paths source None: no runs recorded", str(trend))
+
+    def test_history_uses_index(self):
+        plan = self.ledger.connection.execute(
+            'EXPLAIN QUERY PLAN SELECT * FROM sources WHERE type = ? '
+            'AND name = ? AND status = ? ORDER BY run DESC LIMIT ?',
+            ('paths', 'etc', 'ok', 10)
+        ).fetchall()
+        plan = str([tuple(r) for r in plan])
+        self.assertTrue('sources_by_status' in plan, plan)
+        # the rows come out of the index in order:
+        self.assertFalse('TEMP B-TREE' in plan, plan)
@@ -0,0 +1,57 @@
+from unittest import TestCase
+
+from testfixtures import (
+    compare, ShouldRaise, Replacer, test_time, LogCapture
+)
+
+from archivist.limits import Budget, LimitExceeded
+
+
+class TestBudget(TestCase):
+
+    def setUp(self):
+        r = Replacer()
+        self.addCleanup(r.restore)
+        # each call to time() is 1s later than the one before:
+        self.time = test_time(delta=1, delta_type='seconds')
+        r.replace('archivist.limits.time', self.time)
+
+    def test_unlimited(self):
+        budget = Budget()
+        compare(None, budget.remaining())
+        budget.check()
+        for i in range(1000):
+            compare(True, budget.file('/foo', 10**9))
+
+    def test_timeout(self):
+        budget = Budget(timeout=2)
+        compare(1, budget.remaining())
+        with ShouldRaise(LimitExceeded('ran out of time')):
+            budget.check()
+
+    def test_deadline_sooner_than_timeout(self):
+        start = self.time()
+        budget = Budget(timeout=10, deadline=start+3)
+        compare(start+3, budget.deadline)
+
+    def test_timeout_sooner_than_deadline(self):
+        start = self.time()
+        budget = Budget(timeout=3, deadline=start+10)
+        compare(start+4, budget.deadline)
+
+    def test_max_files(self):
+        budget = Budget(max_files=2)
+        budget.file('/a', 1)
+        budget.file('/b', 1)
+        with ShouldRaise(LimitExceeded('more than 2 files')):
+            budget.file('/c', 1)
+
+    def test_max_file_size(self):
+        budget = Budget(max_file_size=10)
+        with LogCapture() as log:
+            compare(True, budget.file('/a', 10))
+            compare(False, budget.file('/b', 11))
+        log.check(
+            ('archivist.limits', 'WARNING',
+             'skipping /b as it is larger than 10 bytes'),
+        )
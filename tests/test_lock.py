@@ -0,0 +1,124 @@
+import os
+from fcntl import flock, LOCK_EX, LOCK_NB
+from socket import gethostname
+from unittest import TestCase
+
+from testfixtures import (
+    TempDirectory, compare, ShouldRaise, Replacer, test_time
+)
+
+from archivist.lock import RepoLock, Locked, lock_name
+
+
+class TestRepoLock(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = self.dir.getpath(lock_name)
+
+    def hold(self, host=None, pid=None, started=1000.0):
+        """
+        Hold the lock as if another run had it.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+        self.addCleanup(self.close, fd)
+        flock(fd, LOCK_EX | LOCK_NB)
+        os.write(fd, '{} {} {!r}\n'.format(host or gethostname(),
+                                           pid or os.getpid(), started))
+        return fd
+
+    @staticmethod
+    def close(fd):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+    def test_acquire_and_release(self):
+        lock = RepoLock(self.path)
+        lock.acquire()
+        host, pid, started = lock.holder()
+        compare(gethostname(), host)
+        compare(os.getpid(), pid)
+        lock.release()
+        # can be obtained again:
+        other = RepoLock(self.path)
+        other.acquire()
+        other.release()
+
+    def test_skip(self):
+        self.hold(started=1000.0)
+        with Replacer() as r:
+            r.replace('archivist.lock.time', lambda: 1030.0)
+            with ShouldRaise(Locked(
+                '{} is locked by process {} on {}, which took it 30s ago'
+                .format(self.path, os.getpid(), gethostname())
+            )) as s:
+                RepoLock(self.path, mode='skip').acquire()
+        compare(False, s.raised.stale)
+
+    def test_wait_timeout(self):
+        self.hold()
+        lock = RepoLock(self.path, mode='wait', timeout=3)
+        with Replacer() as r:
+            r.replace('archivist.lock.time',
+                      test_time(delta=1, delta_type='seconds'))
+            r.replace('archivist.lock.sleep', lambda s: None)
+            with ShouldRaise(Locked) as s:
+                lock.acquire()
+        self.assertTrue(str(s.raised).startswith(
+            '{} is still locked after 3s by process'.format(self.path)
+        ), s.raised)
+
+    def test_wait_until_released(self):
+        fd = self.hold()
+        lock = RepoLock(self.path, mode='wait')
+
+        def sleep(seconds):
+            os.close(fd)
+
+        with Replacer() as r:
+            r.replace('archivist.lock.sleep', sleep)
+            lock.acquire()
+        compare(os.getpid(), lock.holder()[1])
+        lock.release()
+
+    def test_holder_gone(self):
+        fd = self.hold(pid=2**22+1)
+        os.close(fd)
+        # the flock went with the process, so the lock is free:
+        lock = RepoLock(self.path)
+        lock.acquire()
+        compare(os.getpid(), lock.holder()[1])
+        lock.release()
+
+    def test_stale_holder_reported_not_removed(self):
+        self.hold(host='elsewhere', pid=1234, started=1000.0)
+        lock = RepoLock(self.path, stale_after=60)
+        with Replacer() as r:
+            r.replace('archivist.lock.time', lambda: 1090.0)
+            with ShouldRaise(Locked) as s:
+                lock.acquire()
+        compare('{} is locked by process 1234 on elsewhere, which took it '
+                '90s ago, longer than the 60s after which it is stale'
+                .format(self.path), str(s.raised))
+        compare(True, s.raised.stale)
+        compare(('elsewhere', 1234, 1000.0), lock.holder())
+
+    def test_not_stale(self):
+        self.hold(started=1000.0)
+        lock = RepoLock(self.path, stale_after=60)
+        with Replacer() as r:
+            r.replace('archivist.lock.time', lambda: 1030.0)
+            with ShouldRaise(Locked) as s:
+                lock.acquire()
+        compare(False, s.raised.stale)
+
+    def test_unreadable_holder(self):
+        fd = self.hold()
+        os.ftruncate(fd, 0)
+        with ShouldRaise(Locked('{} is locked by an unknown process'.format(
+            self.path
+        ))):
+            RepoLock(self.path, stale_after=0).acquire()
@@ -1,33 +1,61 @@
 from logging import getLogger
+import os
+from threading import Event, current_thread
 from unittest import TestCase
 
 from mock import Mock, call
 from testfixtures import (
     Replacer, tempdir, compare, ShouldRaise, OutputCapture, TempDirectory,
-    LogCapture
+    LogCapture, test_time, Comparison as C
 )
 from voluptuous import Schema
 from voluptuous import ALLOW_EXTRA
 
 from archivist.config import ConfigError
+from archivist.helpers import blob_hash
+from archivist.config import Config
+from archivist.metrics import metrics
 from archivist.main import (
-    parse_command_line, HandleKnownExceptions, main, SafeNotifications
+    parse_command_line, HandleKnownExceptions, main, SafeNotifications,
+    process_sources, lock_repos, report_changes, check_sources, report_check,
+    config_paths, validate, validate_main, process, stats, stats_main,
+    write_textfile, settings_hash
 )
-from archivist.plugins import Repo, Source, Notifier
+from archivist.ledger import Ledger
+from archivist.plugins import Repo, Source, Notifier, Plugins
 
 
 class TestParseCommandLine(TestCase):
 
-    def check(self, argv):
+    def check(self, argv, version=None):
         with Replacer() as r:
             r.replace('sys.argv', ['x']+argv)
-            return parse_command_line()
+            return parse_command_line(version)
 
     @tempdir()
     def test_okay(self, dir):
         path = dir.write('test.yaml', 'foo')
         args = self.check([path])
         compare('foo', args.config.read())
+        compare(False, args.dry_run)
+
+    @tempdir()
+    def test_profile(self, dir):
+        path = dir.write('test.yaml', 'foo')
+        args = self.check(['--profile', dir.getpath('profiles'), path])
+        compare(dir.getpath('profiles'), args.profile)
+
+    @tempdir()
+    def test_dry_run(self, dir):
+        path = dir.write('test.yaml', 'foo')
+        args = self.check(['--dry-run', path])
+        compare(True, args.dry_run)
+
+    def test_version(self):
+        with ShouldRaise(SystemExit(0)):
+            with OutputCapture() as output:
+                self.check(['--version'], '1.2')
+        output.compare('1.2')
 
     @tempdir()
     def test_not_okay(self, dir):
@@ -156,6 +184,810 @@ class TestSafeNotifications(TestCase):
 
 
 
+class BudgetSource(Source):
+    schema = Schema({})
+
+    def __init__(self, name, files=0, limits=None):
+        super(BudgetSource, self).__init__('budget', name, 'repo')
+        self.files = files
+        if limits is not None:
+            self.limits = limits
+        self.processed = False
+
+    def process(self, path):
+        for i in range(self.files):
+            self.budget.file('/'+str(i), 1)
+        self.processed = True
+
+    def expected(self, path):
+        self.previewed = True
+        return {}
+
+
+class DummyRepo(object):
+
+    def __init__(self, lock_path=None, ledger_path=None):
+        self._lock_path = lock_path
+        self._ledger_path = ledger_path
+
+    def path_for(self, source):
+        return '/tmp'
+
+    def lock_path(self):
+        return self._lock_path
+
+    def ledger_path(self):
+        return self._ledger_path
+
+    def actions(self):
+        pass
+
+    def committed(self, path):
+        return None
+
+
+class TestProcessSources(TestCase):
+
+    def make_config(self, limits, *sources):
+        config = Config()
+        config.repos['repo'] = DummyRepo()
+        config.limits = limits
+        config.sources.extend(sources)
+        return config
+
+    def test_source_limit_exceeded(self):
+        s1 = BudgetSource('s1', files=3)
+        s2 = BudgetSource('s2', files=1)
+        config = self.make_config(dict(max_files=2), s1, s2)
+        with LogCapture() as log:
+            process_sources(config)
+        log.check(
+            ('archivist.main', 'ERROR',
+             "budget source 's1' aborted: more than 2 files"),
+        )
+        compare(False, s1.processed)
+        compare(True, s2.processed)
+
+    def test_source_specific_limits(self):
+        s1 = BudgetSource('s1', files=3, limits=dict(max_files=5))
+        s2 = BudgetSource('s2', files=3)
+        config = self.make_config(dict(max_files=2), s1, s2)
+        with LogCapture() as log:
+            process_sources(config)
+        log.check(
+            ('archivist.main', 'ERROR',
+             "budget source 's2' aborted: more than 2 files"),
+        )
+        compare(True, s1.processed)
+
+    def test_run_deadline(self):
+        s1 = BudgetSource('s1')
+        s2 = BudgetSource('s2')
+        # time() is also called to time each source:
+        config = self.make_config(dict(run_timeout=2.5), s1, s2)
+        with Replacer() as r:
+            time = test_time(delta=1, delta_type='seconds')
+            r.replace('archivist.main.time', time)
+            r.replace('archivist.limits.time', time)
+            with LogCapture() as log:
+                process_sources(config)
+        log.check(
+            ('archivist.main', 'ERROR',
+             "budget source 's2' aborted: ran out of time"),
+        )
+        compare(True, s1.processed)
+        compare(False, s2.processed)
+
+
+    def test_metrics(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        s1 = BudgetSource('s1', files=3)
+        config = self.make_config({}, s1)
+        with Replacer() as r:
+            r.replace('archivist.main.time',
+                      test_time(delta=2, delta_type='seconds'))
+            process_sources(config)
+        labels = dict(type='budget', name='s1')
+        compare(2, metrics.get('archivist_source_duration_seconds',
+                               **labels))
+        compare(3, metrics.get('archivist_source_files_scanned', **labels))
+        compare(0, metrics.get('archivist_source_files_copied', **labels))
+
+    def test_only_some_repos(self):
+        s1 = BudgetSource('s1')
+        s2 = BudgetSource('s2')
+        s2.repo = 'other'
+        config = self.make_config({}, s1, s2)
+        config.repos['other'] = DummyRepo()
+        process_sources(config, repos={'other': None})
+        compare(False, s1.processed)
+        compare(True, s2.processed)
+
+
+    def test_dry_run(self):
+        class WritingSource(BudgetSource):
+            def expected(self, path):
+                return {os.path.join(path, 'file'): blob_hash('new')}
+
+        with TempDirectory() as dir:
+            class Repo(DummyRepo):
+                def path_for(self, source, create=True):
+                    if create:
+                        return dir.makedir('archive')
+                    return dir.getpath('archive')
+
+            config = self.make_config({}, WritingSource('s1'))
+            config.repos['repo'] = Repo()
+            changes = process_sources(config, dry_run=True)
+            compare([('added', dir.getpath('archive/file'))], changes)
+            dir.compare([])
+
+    def test_repo_path_for_without_create(self):
+        # repos written before path_for took create still work:
+        class OldRepo(DummyRepo):
+            calls = []
+
+            def path_for(self, source):
+                self.calls.append(source.name)
+                return '/tmp'
+
+        config = self.make_config({}, BudgetSource('s1'))
+        config.repos['repo'] = OldRepo()
+        process_sources(config)
+        process_sources(config, dry_run=True)
+        check_sources(config)
+        compare(['s1', 's1', 's1'], OldRepo.calls)
+
+    def test_dry_run_not_supported(self):
+        class OpaqueSource(BudgetSource):
+            expected = Source.expected
+
+        source = OpaqueSource('s1')
+        config = self.make_config({}, source)
+        with LogCapture() as log:
+            compare([], process_sources(config, dry_run=True))
+        log.check(('archivist.main', 'WARNING',
+                   "budget source 's1' does not support dry runs"))
+        compare(False, source.processed)
+
+
+class WaitingSource(BudgetSource):
+
+    concurrent = True
+
+    def __init__(self, name, wait_for=None, files=0):
+        super(WaitingSource, self).__init__(name, files)
+        self.done = Event()
+        self.wait_for = wait_for
+
+    def process(self, path):
+        if self.wait_for is not None:
+            # only possible if the other source is processed at once:
+            if not self.wait_for.done.wait(5):
+                raise AssertionError('not processed concurrently')
+        super(WaitingSource, self).process(path)
+        self.thread = current_thread()
+        self.done.set()
+
+
+class TestConcurrency(TestCase):
+
+    def make_config(self, concurrency, *sources):
+        config = Config()
+        config.repos['repo'] = DummyRepo()
+        config.concurrency = concurrency
+        config.sources.extend(sources)
+        return config
+
+    def test_concurrent(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        s2 = WaitingSource('s2', files=2)
+        s1 = WaitingSource('s1', wait_for=s2, files=1)
+        process_sources(self.make_config(2, s1, s2))
+        compare(True, s1.processed)
+        compare(True, s2.processed)
+        compare(1, metrics.get('archivist_source_files_scanned',
+                               type='budget', name='s1'))
+        compare(2, metrics.get('archivist_source_files_scanned',
+                               type='budget', name='s2'))
+
+    def test_not_concurrent_source(self):
+        s1 = WaitingSource('s1')
+        s2 = BudgetSource('s2')
+        s3 = WaitingSource('s3', wait_for=s1)
+        process_sources(self.make_config(2, s1, s2, s3))
+        compare(True, s2.processed)
+        compare(True, s3.processed)
+        self.assertFalse(s1.thread is current_thread())
+
+    def test_not_configured(self):
+        s1 = WaitingSource('s1')
+        process_sources(self.make_config(1, s1))
+        self.assertTrue(s1.thread is current_thread())
+
+    def test_error(self):
+        class BrokenSource(WaitingSource):
+            def process(self, path):
+                raise ValueError('boom')
+        s1 = WaitingSource('s1')
+        with ShouldRaise(ValueError('boom')):
+            process_sources(self.make_config(2, BrokenSource('s0'), s1))
+        compare(True, s1.processed)
+
+    def test_dry_run_changes_in_order(self):
+        class WritingSource(WaitingSource):
+            def expected(self, path):
+                # waits for the other source, but writes nothing:
+                self.process(path)
+                return {os.path.join(path, 'file'): blob_hash('new')}
+
+        with TempDirectory() as dir:
+            class Repo(DummyRepo):
+                def path_for(self, source):
+                    return dir.makedir(source.name)
+
+            s2 = WritingSource('s2')
+            s1 = WritingSource('s1', wait_for=s2)
+            config = self.make_config(2, s1, s2)
+            config.repos['repo'] = Repo()
+            changes = process_sources(config, dry_run=True)
+            compare([('added', dir.getpath('s1/file')),
+                     ('added', dir.getpath('s2/file'))], changes)
+
+
+class FingerprintSource(BudgetSource):
+
+    fingerprint_value = ('input', 1)
+
+    def fingerprint(self):
+        return self.fingerprint_value
+
+
+class TestFingerprints(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def run_source(self, source, dry_run=False, limits=None, actions=None):
+        path = self.dir.getpath('archive')
+
+        class Repo(DummyRepo):
+            def path_for(self, source, create=True):
+                if create and not os.path.exists(path):
+                    os.mkdir(path)
+                return path
+
+        config = Config()
+        config.repos['repo'] = Repo()
+        if actions is not None:
+            config.repos['repo'].actions = actions
+        config.sources.append(source)
+        if limits is not None:
+            config.limits = limits
+        if dry_run:
+            process_sources(config, dry_run=True)
+        else:
+            process(config)
+        return metrics.get('archivist_source_skipped',
+                           type='budget', name=source.name)
+
+    def recorded(self, source, value, limits={}):
+        return repr((settings_hash(source, limits), value))
+
+    def test_recorded_then_skipped(self):
+        source = FingerprintSource('s1')
+        with LogCapture() as log:
+            compare(0, self.run_source(source))
+            compare(True, source.processed)
+            compare(self.recorded(source, ('input', 1)),
+                    self.dir.read('archive/.archivist-fingerprint'))
+
+            source = FingerprintSource('s1')
+            compare(1, self.run_source(source))
+            compare(False, source.processed)
+        log.check(
+            ('archivist.main', 'DEBUG', "budget source 's1' unchanged, "
+                                        "skipping"),
+        )
+
+    def test_changed(self):
+        self.run_source(FingerprintSource('s1'))
+        source = FingerprintSource('s1')
+        source.fingerprint_value = ('input', 2)
+        compare(0, self.run_source(source))
+        compare(True, source.processed)
+        compare(self.recorded(source, ('input', 2)),
+                self.dir.read('archive/.archivist-fingerprint'))
+
+    def test_config_changed(self):
+        self.run_source(FingerprintSource('s1'))
+        source = FingerprintSource('s1')
+        source.config = dict(values=['/other'])
+        compare(0, self.run_source(source))
+        compare(True, source.processed)
+
+    def test_limits_changed(self):
+        self.run_source(FingerprintSource('s1'))
+        source = FingerprintSource('s1', limits=dict(max_file_size=10))
+        compare(0, self.run_source(source))
+        compare(True, source.processed)
+        source = FingerprintSource('s1')
+        compare(0, self.run_source(source, limits=dict(max_file_size=20)))
+        compare(True, source.processed)
+
+    def test_timeout_changed(self):
+        self.run_source(FingerprintSource('s1'))
+        source = FingerprintSource('s1', limits=dict(timeout=60))
+        compare(1, self.run_source(source))
+        compare(False, source.processed)
+
+    def test_not_recorded_when_actions_fail(self):
+        def actions():
+            raise ValueError('boom')
+        source = FingerprintSource('s1')
+        with ShouldRaise(ValueError('boom')):
+            self.run_source(source, actions=actions)
+        compare(True, source.processed)
+        self.dir.compare(['archive/'])
+
+    def test_no_fingerprint(self):
+        source = BudgetSource('s1')
+        self.run_source(source)
+        self.run_source(source)
+        compare(True, source.processed)
+        self.dir.compare(['archive/'])
+
+    def test_not_recorded_when_aborted(self):
+        source = FingerprintSource('s1', files=3, limits=dict(max_files=2))
+        with LogCapture():
+            self.run_source(source)
+        self.dir.compare(['archive/'])
+
+    def test_dry_run_always_processes(self):
+        self.run_source(FingerprintSource('s1'))
+        source = FingerprintSource('s1')
+        self.run_source(source, dry_run=True)
+        compare(False, source.processed)
+        compare(True, source.previewed)
+
+
+class ProgressSource(BudgetSource):
+
+    def process(self, path):
+        for i in range(self.files):
+            self.progress.file('/'+str(i))
+
+
+class TestProgress(TestCase):
+
+    def test_expected_from_previous_run(self):
+        with TempDirectory() as dir:
+            class Repo(DummyRepo):
+                def path_for(self, source):
+                    return dir.path
+
+            notifier = Mock()
+            config = Config()
+            config.repos['repo'] = Repo()
+            config.notifications.append(notifier)
+            config.sources.append(ProgressSource('s1', files=3))
+            process_sources(config)
+            compare('3', dir.read('.archivist-progress'))
+            config.sources[0].files = 4
+            process_sources(config)
+            compare('4', dir.read('.archivist-progress'))
+
+        reports = [c[1][0] for c in notifier.progress.mock_calls]
+        compare([(3, None, True), (4, 3, True)],
+                [(r.files, r.expected, r.done) for r in reports])
+
+    def test_finished_when_aborted(self):
+        class LimitedSource(ProgressSource):
+            def process(self, path):
+                for i in range(self.files):
+                    self.budget.file('/'+str(i), 1)
+                    self.progress.file('/'+str(i))
+
+        with TempDirectory() as dir:
+            class Repo(DummyRepo):
+                def path_for(self, source):
+                    return dir.path
+
+            notifier = Mock()
+            config = Config()
+            config.repos['repo'] = Repo()
+            config.notifications.append(notifier)
+            config.sources.append(LimitedSource('s1', files=3,
+                                                limits=dict(max_files=2)))
+            with LogCapture():
+                process_sources(config)
+            # a partial run isn't used as the expected count:
+            dir.compare([])
+
+        reports = [c[1][0] for c in notifier.progress.mock_calls]
+        compare([(2, None, True)],
+                [(r.files, r.expected, r.done) for r in reports])
+
+
+class TestReportChanges(TestCase):
+
+    def test_changes(self):
+        with ShouldRaise(SystemExit(1)):
+            with OutputCapture() as output:
+                report_changes([('added', '/a'), ('deleted', '/b')])
+        output.compare('added: /a\ndeleted: /b')
+
+    def test_no_changes(self):
+        with OutputCapture() as output:
+            report_changes([])
+        output.compare('')
+
+
+class CheckSource(BudgetSource):
+
+    def __init__(self, name, result, files=0):
+        super(CheckSource, self).__init__(name, files)
+        self.result = result
+
+    def check(self, path, committed, read_committed):
+        for i in range(self.files):
+            self.budget.file('/'+str(i), 1)
+        self.read = read_committed('contents.txt')
+        return self.result
+
+
+class CheckRepo(DummyRepo):
+
+    def path_for(self, source, create=True):
+        if create:
+            raise AssertionError('checking must not create anything')
+        return '/archive/' + source.name
+
+    def committed(self, path):
+        return {}
+
+    def read_committed(self, path, name):
+        return 'committed {} in {}'.format(name, path)
+
+
+class TestCheckSources(TestCase):
+
+    def make_config(self, limits, *sources):
+        config = Config()
+        config.repos['repo'] = CheckRepo()
+        config.limits = limits
+        config.sources.extend(sources)
+        return config
+
+    def test_combined(self):
+        config = self.make_config(
+            {},
+            CheckSource('s1', (2, [('added', '/a')])),
+            CheckSource('s2', None),
+            CheckSource('s3', (3, [('deleted', '/b')])),
+        )
+        compare((5, [('added', '/a'), ('deleted', '/b')], [],
+                 ["budget source 's2'"]),
+                check_sources(config))
+        compare('committed contents.txt in /archive/s1',
+                config.sources[0].read)
+
+    def test_repo_cannot_check(self):
+        config = self.make_config({}, CheckSource('s1', (2, [])))
+        config.repos['repo'] = DummyRepo()
+        compare((0, [], [], ["budget source 's1'"]), check_sources(config))
+
+    def test_limit_exceeded(self):
+        config = self.make_config(
+            dict(max_files=1),
+            CheckSource('s1', (2, []), files=2),
+            CheckSource('s2', (1, [])),
+        )
+        compare((1, [], ["budget source 's1' aborted: more than 1 files"],
+                 []),
+                check_sources(config))
+
+
+class TestReportCheck(TestCase):
+
+    def check(self, expected_code, *args):
+        with ShouldRaise(SystemExit(expected_code)):
+            with OutputCapture() as output:
+                report_check(*args)
+        return output
+
+    def test_ok(self):
+        output = self.check(0, 10, [], [], [], 0.5)
+        output.compare('ARCHIVIST OK - 10 checked, no drift | '
+                       'checked=10 drifted=0 unchecked=0 time=0.500s')
+
+    def test_drift(self):
+        output = self.check(2, 10, [('added', '/a'), ('deleted', '/b')],
+                            [], ["crontab source None"], 1)
+        output.compare('\n'.join((
+            'ARCHIVIST CRITICAL - 2 of 10 drifted | '
+            'checked=10 drifted=2 unchecked=1 time=1.000s',
+            'unchecked: crontab source None',
+            'added: /a',
+            'deleted: /b',
+        )))
+
+    def test_unchecked(self):
+        output = self.check(1, 10, [], [],
+                            ["crontab source None", "packages source 'rpm'"],
+                            0.5)
+        output.compare('\n'.join((
+            'ARCHIVIST WARNING - 10 checked, no drift, 2 sources unchecked | '
+            'checked=10 drifted=0 unchecked=2 time=0.500s',
+            'unchecked: crontab source None',
+            "unchecked: packages source 'rpm'",
+        )))
+
+    def test_problems(self):
+        output = self.check(3, 0, [('added', '/a')], ['bad', 'worse'], [], 1)
+        output.compare('\n'.join((
+            'ARCHIVIST UNKNOWN - bad | '
+            'checked=0 drifted=1 unchecked=0 time=1.000s',
+            'worse',
+            'added: /a',
+        )))
+
+
+class TestLockRepos(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def make_config(self, **lock):
+        config = Config()
+        config.repos['free'] = DummyRepo(self.dir.getpath('free.lock'))
+        config.repos['none'] = DummyRepo()
+        config.lock = lock
+        return config
+
+    def test_all_available(self):
+        locks = lock_repos(self.make_config())
+        compare(['free', 'none'], sorted(locks))
+        compare(None, locks['none'])
+        locks['free'].release()
+
+    def test_locked_by_other_run(self):
+        held = lock_repos(self.make_config())
+        with LogCapture() as log:
+            locks = lock_repos(self.make_config())
+        held['free'].release()
+        compare(['none'], sorted(locks))
+        log.check(('archivist.main', 'INFO', C(str)))
+
+    def test_gave_up_waiting(self):
+        held = lock_repos(self.make_config())
+        with LogCapture() as log:
+            locks = lock_repos(self.make_config(mode='wait', timeout=0))
+        held['free'].release()
+        compare(['none'], sorted(locks))
+        log.check(('archivist.main', 'WARNING', C(str)))
+
+    def test_locked_for_too_long(self):
+        held = lock_repos(self.make_config())
+        with LogCapture() as log:
+            locks = lock_repos(self.make_config(stale_after=-1))
+        held['free'].release()
+        compare(['none'], sorted(locks))
+        log.check(('archivist.main', 'ERROR', C(str)))
+
+
+class TestLedger(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def make_config(self, *sources):
+        config = Config()
+        config.repos['repo'] = DummyRepo(
+            ledger_path=self.dir.getpath('ledger.sqlite')
+        )
+        config.repos['other'] = DummyRepo()
+        config.sources.extend(sources)
+        return config
+
+    def test_runs_recorded(self):
+        config = self.make_config(BudgetSource('s1', files=3),
+                                  BudgetSource('s2', files=5))
+        with Replacer() as r:
+            r.replace('archivist.main.time',
+                      test_time(delta=1, delta_type='seconds'))
+            process(config)
+        ledger = Ledger(self.dir.getpath('ledger.sqlite'))
+        self.addCleanup(ledger.close)
+        compare([(1, 5.0)], [tuple(row) for row in ledger.connection.execute(
+            'SELECT id, duration FROM runs'
+        )])
+        compare([dict(run=1, type='budget', name='s1', duration=1.0,
+                      files=3, bytes=0, changes=0, skipped=0, status='ok')],
+                [dict(row) for row in ledger.history('budget', 's1', 10)])
+        compare([3, 5], [ledger.history('budget', name, 10)[0]['files']
+                         for name in ('s1', 's2')])
+
+    def test_aborted_recorded(self):
+        config = self.make_config(
+            BudgetSource('s1', files=2, limits=dict(max_files=1)),
+        )
+        with LogCapture():
+            process(config)
+        ledger = Ledger(self.dir.getpath('ledger.sqlite'))
+        self.addCleanup(ledger.close)
+        compare([('s1', 'aborted')], [tuple(row) for row in
+                                      ledger.connection.execute(
+            'SELECT name, status FROM sources'
+        )])
+        compare([], ledger.history('budget', 's1', 10))
+
+    def test_not_recorded_for_locked_repo(self):
+        config = self.make_config(BudgetSource('s1'))
+        config.repos['repo']._lock_path = self.dir.getpath('lock')
+        held = lock_repos(config)
+        self.addCleanup(held['repo'].release)
+        process(config)
+        self.dir.compare(['lock'])
+
+    def test_complete(self):
+        compare(True, process(self.make_config(BudgetSource('s1'))))
+
+    def test_incomplete_when_locked(self):
+        config = self.make_config(BudgetSource('s1'))
+        config.repos['repo']._lock_path = self.dir.getpath('lock')
+        held = lock_repos(config)
+        self.addCleanup(held['repo'].release)
+        with LogCapture():
+            compare(False, process(config))
+
+    def test_incomplete_when_aborted(self):
+        config = self.make_config(
+            BudgetSource('s1'),
+            BudgetSource('s2', files=2, limits=dict(max_files=1)),
+        )
+        with LogCapture():
+            compare(False, process(config))
+
+    def test_textfile_error_logged(self):
+        with LogCapture() as log:
+            write_textfile(self.dir.getpath('missing/archivist.prom'), 1.0)
+        log.check(('archivist.main', 'ERROR', C(str)))
+        compare(1.0, metrics.get('archivist_run_duration_seconds'))
+
+    def test_ledger_error_logged(self):
+        self.dir.makedir('ledger.sqlite')
+        with LogCapture() as log:
+            process(self.make_config(BudgetSource('s1')))
+        log.check(('archivist.main', 'WARNING', C(str)))
+
+    def record(self, *durations):
+        ledger = Ledger(self.dir.getpath('ledger.sqlite'))
+        self.addCleanup(ledger.close)
+        for duration in durations:
+            ledger.record(0, duration, [dict(
+                type='budget', name='s1', duration=duration, files=1,
+                bytes=0, changes=0, skipped=0, status='ok'
+            )])
+
+    def test_stats(self):
+        self.record(1.0, 1.0, 3.0)
+        config = self.make_config(BudgetSource('s1'), BudgetSource('s2'))
+        trends = stats(config)
+        compare(['s1', 's2'], [trend.name for trend in trends])
+        compare([True, False], [trend.regressed for trend in trends])
+        compare([False, False], [trend.regressed for trend in
+                                 stats(config, threshold=4)])
+
+    def test_stats_no_ledger(self):
+        compare([], stats(self.make_config(BudgetSource('s1'))))
+        self.dir.compare([])
+
+    def check_main(self, *durations):
+        self.record(*durations)
+        config = self.make_config(BudgetSource('s1'))
+        path = self.dir.write('config.yaml', '')
+        with Replacer() as r:
+            r.replace('archivist.main.Config.load',
+                      lambda cls, source, plugins, cache: config)
+            with OutputCapture() as output:
+                stats_main([path, '--runs', '5'], Plugins())
+        return output
+
+    def test_main_ok(self):
+        output = self.check_main(1.0, 1.0, 1.5)
+        output.compare("budget source 's1': 1.50s, 1 files, 0.0 MB, "
+                       "typically 1.00s over 2 runs\n"
+                       "1 sources, 0 regressed")
+
+    def test_main_regressed(self):
+        with ShouldRaise(SystemExit(1)):
+            self.check_main(1.0, 1.0, 2.5)
+
+
+valid_config = '''
+sources:
+- crontab: root
+'''
+
+invalid_config = '''
+sources:
+- type: crontab
+  spool: 1
+'''
+
+
+class TestValidate(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_config_paths(self):
+        self.dir.write('hosts/b.yaml', '')
+        self.dir.write('hosts/a.yaml', '')
+        self.dir.write('hosts/notes.txt', '')
+        self.dir.write('hosts/conf.d/c.yaml', '')
+        compare([self.dir.getpath('other.yaml'),
+                 self.dir.getpath('hosts/a.yaml'),
+                 self.dir.getpath('hosts/b.yaml')],
+                config_paths([self.dir.getpath('other.yaml'),
+                              self.dir.getpath('hosts')]))
+
+    def check(self, jobs):
+        good = self.dir.write('good.yaml', valid_config)
+        bad = self.dir.write('bad.yaml', invalid_config)
+        broken = self.dir.write('broken.yaml', 'sources: [')
+        missing = self.dir.getpath('missing.yaml')
+        results = validate([good, bad, broken, missing], Plugins.load(), jobs)
+        compare([good, bad, broken, missing], [path for path, _ in results])
+        compare(None, results[0][1])
+        self.assertTrue(results[1][1].startswith(
+            "ConfigError: at ['sources', 0, 'spool'], expected str"
+        ), results[1][1])
+        self.assertTrue(results[2][1].startswith('ParserError: '))
+        self.assertTrue(results[3][1].startswith('IOError: '))
+
+    def test_in_process(self):
+        self.check(jobs=1)
+
+    def test_pool(self):
+        self.check(jobs=2)
+
+    def test_main_valid(self):
+        self.dir.write('hosts/a.yaml', valid_config)
+        self.dir.write('hosts/b.yaml', valid_config)
+        with OutputCapture() as output:
+            with Replacer() as r:
+                r.replace('sys.argv', ['x', 'validate', '--jobs', '2',
+                                       self.dir.getpath('hosts')])
+                r.replace('archivist.main.snapshot_path', lambda: None)
+                main()
+        output.compare('2 files checked, 0 invalid')
+
+    def test_main_invalid(self):
+        self.dir.write('a.yaml', valid_config)
+        path = self.dir.write('b.yaml', invalid_config)
+        with ShouldRaise(SystemExit(1)):
+            with OutputCapture() as output:
+                validate_main([self.dir.path], Plugins.load())
+        self.assertTrue(output.captured.startswith(
+            path + ": ConfigError: at ['sources', 0, 'spool']"
+        ), output.captured)
+        self.assertTrue(output.captured.endswith(
+            '2 files checked, 1 invalid\n'
+        ), output.captured)
+
+
 class TestMain(TestCase):
 
     def test_full_sweep(self):
@@ -187,7 +1019,7 @@ class TestMain(TestCase):
             def finish(self):
                 m.TestNotifier.finish(self.name)
 
-        def load_plugins(cls):
+        def load_plugins(cls, snapshot_path=None):
             registry = cls()
             registry.register('repo', 'test', TestRepo)
             registry.register('source', 'test1', TestS1)
@@ -0,0 +1,120 @@
+import os
+from threading import Thread
+from unittest import TestCase
+
+from testfixtures import TempDirectory, compare, ShouldRaise
+
+from archivist.metrics import Metrics, metrics
+from archivist.writer import AtomicWriter
+
+
+class TestMetrics(TestCase):
+
+    def test_render(self):
+        m = Metrics()
+        m.set('archivist_run_duration_seconds', 12.5)
+        m.set('archivist_source_duration_seconds', 2,
+              type='paths', name='etc')
+        m.set('archivist_source_duration_seconds', 1,
+              type='crontab', name='')
+        compare(m.render(), '''\
+# HELP archivist_run_duration_seconds Time taken by the last run.
+# TYPE archivist_run_duration_seconds gauge
+archivist_run_duration_seconds 12.5
+# HELP archivist_source_duration_seconds Time taken by each source in the last run.
+# TYPE archivist_source_duration_seconds gauge
+archivist_source_duration_seconds{name="",type="crontab"} 1.0
+archivist_source_duration_seconds{name="etc",type="paths"} 2.0
+''')
+
+    def test_escaping(self):
+        m = Metrics()
+        m.set('archivist_repo_commit_made', 1,
+              repo='r', path='/a "b"\\c\nd')
+        compare(m.render().splitlines()[-1],
+                r'archivist_repo_commit_made{path="/a \"b\"\\c\nd",repo="r"} '
+                r'1.0')
+
+    def test_unknown(self):
+        with ShouldRaise(KeyError('unknown metric: foo')):
+            Metrics().set('foo', 1)
+
+    def test_inc_and_context(self):
+        m = Metrics()
+        with m.context(type='paths', name='x'):
+            m.inc('archivist_source_files_copied')
+            m.inc('archivist_source_files_copied')
+            with m.context(name='y'):
+                m.inc('archivist_source_files_copied', 5)
+        m.inc('archivist_source_files_copied')
+        compare(2, m.get('archivist_source_files_copied',
+                         type='paths', name='x'))
+        compare(5, m.get('archivist_source_files_copied',
+                         type='paths', name='y'))
+        compare(1, m.get('archivist_source_files_copied'))
+
+    def test_context_is_per_thread(self):
+        m = Metrics()
+
+        def other():
+            m.inc('archivist_source_files_copied')
+
+        with m.context(type='paths', name='x'):
+            thread = Thread(target=other)
+            thread.start()
+            thread.join()
+        compare(1, m.get('archivist_source_files_copied'))
+        compare(None, m.get('archivist_source_files_copied',
+                            type='paths', name='x'))
+
+    def test_persistent_kept(self):
+        m = Metrics()
+        m.set('archivist_run_duration_seconds', 1)
+        previous = m.render()
+        m.set('archivist_last_success_timestamp_seconds', 1000)
+        previous = m.render()
+        m.reset()
+        m.set('archivist_run_duration_seconds', 2)
+        compare(m.render(previous), '''\
+# HELP archivist_last_success_timestamp_seconds Time at which a run last processed every source to completion.
+# TYPE archivist_last_success_timestamp_seconds gauge
+archivist_last_success_timestamp_seconds 1000.0
+# HELP archivist_run_duration_seconds Time taken by the last run.
+# TYPE archivist_run_duration_seconds gauge
+archivist_run_duration_seconds 2.0
+''')
+
+    def test_write(self):
+        with TempDirectory() as dir:
+            path = dir.getpath('archivist.prom')
+            m = Metrics()
+            m.set('archivist_last_success_timestamp_seconds', 1000)
+            m.write(path)
+            m.reset()
+            m.set('archivist_run_duration_seconds', 3)
+            m.write(path)
+            dir.compare(['archivist.prom'])
+            compare(0644, os.stat(path).st_mode & 0777)
+            compare(dir.read('archivist.prom').splitlines()[2::3], [
+                'archivist_last_success_timestamp_seconds 1000.0',
+                'archivist_run_duration_seconds 3.0',
+            ])
+
+
+class TestWriterMetrics(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_copied(self):
+        with TempDirectory() as dir:
+            dir.write('same', 'content')
+            with metrics.context(type='t', name='n'):
+                with AtomicWriter() as writer:
+                    writer.write(dir.getpath('same'), 'content')
+                    writer.write(dir.getpath('new'), 'new content')
+        compare(1, metrics.get('archivist_source_files_copied',
+                               type='t', name='n'))
+        compare(11, metrics.get('archivist_source_bytes_copied',
+                                type='t', name='n'))
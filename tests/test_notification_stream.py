@@ -3,6 +3,7 @@ from unittest import TestCase
 from testfixtures import LogCapture, OutputCapture, compare
 from archivist.config import default_notifications_config
 from archivist.notifications.stream import Plugin
+from archivist.progress import Report
 from tests.helpers import ShouldFailSchemaWith
 
 logger = getLogger()
@@ -76,3 +77,20 @@ class PluginTests(TestCase):
                                  datefmt='foo')
         output.compare(stdout='foo during-info\n'
                               'foo during-error\n')
+
+    def test_progress(self):
+        class Source(object):
+            type = 'paths'
+            name = None
+        with OutputCapture(separate=True) as output:
+            plugin = Plugin(**Plugin.schema(dict(type='stream', name='stderr',
+                                                 progress=True)))
+            plugin.progress(Report(Source(), 10, 0, '/etc', 2.0))
+        output.compare(stderr="paths source None: 10 files (5.0/s), "
+                              "0.0 MB (0.0 MB/s), in /etc")
+
+    def test_progress_not_shown(self):
+        with OutputCapture() as output:
+            plugin = Plugin(type='stream', name='stderr')
+            plugin.progress(Report(None, 10, 0, '/etc', 2.0))
+        output.compare('')
@@ -0,0 +1,83 @@
+from stat import S_IFREG, S_IFLNK, S_IFDIR
+from unittest import TestCase
+
+from testfixtures import compare
+
+from archivist.patterns import Matcher, file_type
+
+
+class TestMatcher(TestCase):
+
+    def check(self, patterns, path, file_=None, directory=None,
+              contents=False):
+        matcher = Matcher(patterns, contents)
+        if file_ is not None:
+            compare(file_, matcher.match_file(path))
+        if directory is not None:
+            compare(directory, matcher.match_directory(path))
+
+    def test_basename_any_depth(self):
+        self.check(['*.swp'], 'a.swp', file_=True)
+        self.check(['*.swp'], 'x/y/a.swp', file_=True)
+        self.check(['*.swp'], 'x/y/a.swpx', file_=False)
+
+    def test_star_does_not_cross_directories(self):
+        self.check(['x/*.conf'], 'x/a.conf', file_=True)
+        self.check(['x/*.conf'], 'x/y/a.conf', file_=False)
+
+    def test_anchored(self):
+        self.check(['/cache'], 'cache', directory=True)
+        self.check(['/cache'], 'x/cache', directory=False)
+        self.check(['sub/cache'], 'sub/cache', directory=True)
+        self.check(['sub/cache'], 'x/sub/cache', directory=False)
+
+    def test_double_star(self):
+        self.check(['**/logs'], 'logs', directory=True)
+        self.check(['**/logs'], 'a/b/logs', directory=True)
+        self.check(['a/**/z'], 'a/z', file_=True)
+        self.check(['a/**/z'], 'a/b/c/z', file_=True)
+        self.check(['a/**'], 'a/b/c', file_=True)
+
+    def test_directory_only(self):
+        self.check(['cache/'], 'x/cache', file_=False, directory=True)
+
+    def test_question_mark(self):
+        self.check(['a?c'], 'abc', file_=True)
+        self.check(['a?c'], 'a/c', file_=False)
+
+    def test_character_class(self):
+        self.check(['*.[ch]'], 'x.c', file_=True)
+        self.check(['*.[ch]'], 'x.o', file_=False)
+        self.check(['*.[!ch]'], 'x.o', file_=True)
+
+    def test_special_characters_escaped(self):
+        self.check(['a+b.(c)'], 'a+b.(c)', file_=True)
+        self.check(['a+b.(c)'], 'aab.(c)', file_=False)
+
+    def test_unclosed_bracket(self):
+        self.check(['a[b'], 'a[b', file_=True)
+
+    def test_several_patterns(self):
+        matcher = Matcher(['*.swp', '*~', 'cache/'])
+        compare(True, matcher.match_file('x.swp'))
+        compare(True, matcher.match_file('x~'))
+        compare(False, matcher.match_file('cache'))
+        compare(True, matcher.match_directory('cache'))
+        compare(False, matcher.match_file('x.conf'))
+
+    def test_contents(self):
+        self.check(['conf'], 'conf/a/b', file_=True, contents=True)
+        self.check(['conf'], 'conf', file_=True, contents=True)
+        self.check(['conf/'], 'conf/a', file_=True, contents=True)
+        self.check(['conf/'], 'conf', file_=False, contents=True)
+        self.check(['conf'], 'conf/a/b', file_=False)
+
+
+class TestFileType(TestCase):
+
+    def test_known(self):
+        compare('file', file_type(S_IFREG | 0644))
+        compare('symlink', file_type(S_IFLNK | 0777))
+
+    def test_unknown(self):
+        compare(None, file_type(S_IFDIR | 0755))
@@ -1,9 +1,16 @@
 from collections import defaultdict
+import json
 from unittest import TestCase
 
-from testfixtures import ShouldRaise, Replacer, compare
+from mock import Mock
+from testfixtures import (
+    ShouldRaise, Replacer, compare, TempDirectory, LogCapture
+)
 
-from archivist.plugins import Plugins
+from archivist.plugins import (
+    Plugins, LazyPlugin, metadata_stamps, import_target
+)
+from archivist.sources.paths import Plugin as PathsSource
 
 
 plugin1 = object()
@@ -29,7 +36,7 @@ class TestPluginLoading(TestCase):
 
     def load_plugins(self):
         with Replacer() as r:
-            r.replace('archivist.plugins.iter_entry_points',
+            r.replace('pkg_resources.iter_entry_points',
                       self.mock_iter_entry_points)
             plugins = Plugins.load()
         return plugins
@@ -111,3 +118,72 @@ class TestPluginLoading(TestCase):
             ('source', 'packages'),
             ('source', 'paths'),
         ],actual)
+
+
+class TestLazyLoading(TestCase):
+
+    def test_imported_on_first_use(self):
+        load = Mock(return_value=plugin1)
+        plugins = Plugins()
+        plugins.register('source', 'foo', LazyPlugin(load))
+        compare(0, load.call_count)
+        compare(plugin1, plugins.get('source', 'foo'))
+        compare(plugin1, plugins.get('source', 'foo'))
+        compare(1, load.call_count)
+
+    def test_import_target(self):
+        self.assertTrue(
+            import_target('archivist.sources.paths:Plugin') is PathsSource
+        )
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = self.dir.getpath('cache/plugins.json')
+
+    def test_written_then_used(self):
+        plugins = Plugins.load(self.path)
+        compare(PathsSource, plugins.get('source', 'paths'))
+        self.assertTrue(plugins.version)
+
+        snapshot = json.loads(self.dir.read('cache/plugins.json'))
+        compare('archivist.sources.paths:Plugin',
+                snapshot['plugins']['source']['paths'])
+        compare(metadata_stamps(), snapshot['stamps'])
+
+        with Replacer() as r:
+            r.replace('pkg_resources.iter_entry_points',
+                      Mock(side_effect=AssertionError('scanned')))
+            plugins = Plugins.load(self.path)
+        compare(PathsSource, plugins.get('source', 'paths'))
+        compare(snapshot['version'], plugins.version)
+
+    def test_stale(self):
+        self.dir.write('cache/plugins.json', json.dumps(dict(
+            stamps=[['/old', 0]], version='0.1',
+            plugins=dict(source=dict(old='old.module:Plugin'))
+        )))
+        plugins = Plugins.load(self.path)
+        with ShouldRaise(KeyError('old')):
+            plugins.get('source', 'old')
+        compare(PathsSource, plugins.get('source', 'paths'))
+
+    def test_corrupt(self):
+        self.dir.write('cache/plugins.json', '{')
+        plugins = Plugins.load(self.path)
+        compare(PathsSource, plugins.get('source', 'paths'))
+        compare(metadata_stamps(),
+                json.loads(self.dir.read('cache/plugins.json'))['stamps'])
+
+    def test_can_not_write(self):
+        self.dir.write('cache', '')
+        with LogCapture() as log:
+            plugins = Plugins.load(self.path)
+        compare(PathsSource, plugins.get('source', 'paths'))
+        compare(1, len(log.records))
+        self.assertTrue(log.records[0].getMessage().startswith(
+            'could not write plugin snapshot to '+self.path
+        ))
@@ -0,0 +1,114 @@
+import os
+from stat import S_IRUSR, S_IXUSR, S_IWUSR
+from unittest import TestCase
+
+from testfixtures import TempDirectory, compare
+
+from archivist.helpers import blob_hash
+from archivist.preview import preview
+from archivist.sources.paths import Plugin as Paths
+
+
+class ExpectedSource(object):
+
+    def __init__(self, expected):
+        self._expected = expected
+
+    def expected(self, path):
+        if self._expected is None:
+            return None
+        return dict((os.path.join(path, name), hash)
+                    for name, hash in self._expected.items())
+
+
+class TestPreview(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_changes(self):
+        archive = self.dir.makedir('archive')
+        self.dir.write('archive/same', 'x')
+        self.dir.write('archive/changed', 'x')
+        self.dir.write('archive/sub/gone', 'x')
+        self.dir.makedir('archive/now_a_file')
+        os.symlink('/somewhere', self.dir.getpath('archive/link'))
+        source = ExpectedSource({
+            'same': blob_hash('x'),
+            'changed': blob_hash('y'),
+            'sub/gone': None,
+            'never/there': None,
+            'new': blob_hash('x'),
+            'now_a_file': blob_hash('x'),
+            'link': blob_hash('/somewhere'),
+        })
+        compare([
+            ('modified', os.path.join(archive, 'changed')),
+            ('added', os.path.join(archive, 'new')),
+            ('modified', os.path.join(archive, 'now_a_file')),
+            ('deleted', os.path.join(archive, 'sub/gone')),
+        ], preview(source, archive))
+
+    def test_not_supported(self):
+        compare(None, preview(ExpectedSource(None), self.dir.path))
+
+    def test_preview(self):
+        source = self.dir.write('source/new', 'new')
+        archive = self.dir.makedir('archive/paths')
+        plugin = Paths('paths', None, 'config', [self.dir.getpath('source')])
+        plugin.process(archive)
+        self.dir.write('source/new', 'changed')
+        self.dir.write('source/another', 'another')
+        before = sorted(os.walk(self.dir.getpath('archive')))
+
+        changes = preview(plugin, archive)
+
+        compare([
+            ('modified', os.path.join(archive, 'contents.txt')),
+            ('added', os.path.join(archive, source[1:-4], 'another')),
+            ('modified', os.path.join(archive, source[1:])),
+        ], changes)
+        # nothing has changed:
+        compare(before, sorted(os.walk(self.dir.getpath('archive'))))
+        compare('new', self.dir.read(archive + '/' + source[1:]))
+
+    def test_preview_no_changes(self):
+        self.dir.write('source/file', 'content')
+        archive = self.dir.makedir('archive/paths')
+        plugin = Paths('paths', None, 'config', [self.dir.getpath('source')])
+        plugin.process(archive)
+        compare([], preview(plugin, archive))
+
+    def test_preview_deleted(self):
+        source = self.dir.write('source/file', 'content')
+        self.dir.write('source/other', 'content')
+        archive = self.dir.makedir('archive/paths')
+        plugin = Paths('paths', None, 'config', [self.dir.getpath('source')])
+        plugin.process(archive)
+        os.remove(source)
+        compare([
+            ('modified', os.path.join(archive, 'contents.txt')),
+            ('deleted', os.path.join(archive, source[1:])),
+        ], preview(plugin, archive))
+
+    def test_preview_new_archive(self):
+        source = self.dir.write('source/file', 'content')
+        archive = self.dir.getpath('archive/paths')
+        plugin = Paths('paths', None, 'config', [self.dir.getpath('source')])
+        compare([
+            ('added', os.path.join(archive, 'contents.txt')),
+            ('added', os.path.join(archive, source[1:])),
+        ], preview(plugin, archive))
+        self.dir.compare(['source/', 'source/file'])
+
+    def test_preview_read_only_archive(self):
+        source = self.dir.write('source/file', 'content')
+        archive = self.dir.makedir('archive/paths')
+        plugin = Paths('paths', None, 'config', [self.dir.getpath('source')])
+        plugin.process(archive)
+        self.dir.write('source/file', 'changed')
+        os.chmod(archive, S_IRUSR | S_IXUSR)
+        self.addCleanup(os.chmod, archive, S_IRUSR | S_IWUSR | S_IXUSR)
+        compare([('modified', os.path.join(archive, source[1:]))],
+                preview(plugin, archive))
@@ -0,0 +1,111 @@
+import pstats
+from threading import Thread
+from time import time
+from unittest import TestCase
+
+from testfixtures import TempDirectory, compare, LogCapture
+
+from archivist.profiling import Profiler, disabled, tracemalloc
+
+
+class DummySource(object):
+
+    def __init__(self, type, name=None):
+        self.type = type
+        self.name = name
+
+
+def busy(seconds=0.1):
+    end = time() + seconds
+    while time() < end:
+        pass
+
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_disabled(self):
+        with disabled.run():
+            with disabled.source(DummySource('paths')):
+                pass
+        self.dir.compare([])
+
+    def test_whole_run(self):
+        profiler = Profiler(self.dir.getpath('profiles'))
+        with LogCapture() as log:
+            with profiler.run():
+                with profiler.source(DummySource('paths')):
+                    busy(0.01)
+        self.dir.compare(['run.pstats'], path='profiles')
+        stats = pstats.Stats(self.dir.getpath('profiles/run.pstats'))
+        self.assertTrue(any(func[2] == 'busy' for func in stats.stats))
+        log.check(('archivist.profiling', 'INFO',
+                   'profile of run written to ' +
+                   self.dir.getpath('profiles')))
+
+    def test_selected_sources(self):
+        profiler = Profiler(self.dir.path,
+                            sources=['paths', 'crontab:root'])
+        with LogCapture():
+            with profiler.run():
+                for source in (DummySource('paths', 'etc'),
+                               DummySource('crontab', 'root'),
+                               DummySource('crontab', 'other'),
+                               DummySource('packages', 'dpkg')):
+                    with profiler.source(source):
+                        pass
+        self.dir.compare(['source-crontab-root.pstats',
+                          'source-paths-etc.pstats'])
+
+    def test_exception(self):
+        profiler = Profiler(self.dir.path)
+        with LogCapture():
+            try:
+                with profiler.run():
+                    raise ValueError()
+            except ValueError:
+                pass
+        self.dir.compare(['run.pstats'])
+
+    def test_sampler(self):
+        profiler = Profiler(self.dir.path, profilers=['sampler'],
+                            interval=0.001)
+        with LogCapture():
+            with profiler.run():
+                busy(0.2)
+        self.dir.compare(['run.samples.txt'])
+        lines = self.dir.read('run.samples.txt').splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertTrue('busy (test_profiling.py:' in stack, stack)
+        self.assertTrue(int(count) > 0)
+
+    def test_sampler_not_main_thread(self):
+        profiler = Profiler(self.dir.path, profilers=['sampler'])
+
+        def run():
+            with profiler.run():
+                pass
+
+        with LogCapture() as log:
+            thread = Thread(target=run)
+            thread.start()
+            thread.join()
+        self.dir.compare([])
+        compare(log.records[0].getMessage(),
+                'the sampler can only be used in the main thread')
+
+    def test_tracemalloc(self):
+        profiler = Profiler(self.dir.path, profilers=['tracemalloc'])
+        with LogCapture() as log:
+            with profiler.run():
+                ['x' * 100 for i in range(1000)]
+        if tracemalloc is None:
+            self.dir.compare([])
+            compare(log.records[0].getMessage(),
+                    'tracemalloc is not available')
+        else:
+            self.dir.compare(['run.tracemalloc.txt'])
@@ -0,0 +1,119 @@
+from unittest import TestCase
+
+from mock import Mock
+from testfixtures import (
+    compare, Replacer, TempDirectory, test_time, Comparison as C
+)
+
+from archivist.progress import (
+    Progress, Report, previous_count, record_count
+)
+from archivist.sources.paths import Plugin as PathsSource
+
+
+class DummySource(object):
+    type = 'paths'
+    name = 'etc'
+
+
+class TestReport(TestCase):
+
+    def test_rates_and_eta(self):
+        report = Report(DummySource(), 100, 5000000, '/etc', 10.0, 300)
+        compare(10.0, report.files_per_second)
+        compare(500000.0, report.bytes_per_second)
+        compare(20.0, report.eta)
+        compare("paths source 'etc': 100 files (10.0/s), 5.0 MB (0.5 MB/s), "
+                "ETA 20s, in /etc", str(report))
+
+    def test_no_expected(self):
+        report = Report(DummySource(), 100, 0, None, 10.0)
+        compare(None, report.eta)
+        compare("paths source 'etc': 100 files (10.0/s), 0.0 MB (0.0 MB/s)",
+                str(report))
+
+    def test_more_than_expected(self):
+        compare(0, Report(DummySource(), 100, 0, None, 10.0, 50).eta)
+
+    def test_nothing_yet(self):
+        report = Report(DummySource(), 0, 0, None, 0, 50)
+        compare(0.0, report.files_per_second)
+        compare(None, report.eta)
+
+    def test_done(self):
+        report = Report(DummySource(), 10, 0, '/etc', 2.0, 50, done=True)
+        compare(0.0, report.eta)
+        compare("paths source 'etc': 10 files (5.0/s), 0.0 MB (0.0 MB/s), "
+                "done in 2.0s", str(report))
+
+
+class TestProgress(TestCase):
+
+    def setUp(self):
+        self.notifier = Mock()
+        r = Replacer()
+        self.addCleanup(r.restore)
+        # each call to time() advances by 0.1s:
+        r.replace('archivist.progress.time',
+                  test_time(delta=0.1, delta_type='seconds'))
+
+    def reports(self):
+        return [c[1][0] for c in self.notifier.progress.mock_calls]
+
+    def test_throttled(self):
+        progress = Progress(DummySource(), [self.notifier], expected=10)
+        progress.walking('/etc')
+        for i in range(4):
+            progress.file('/etc/'+str(i))
+        progress.copied(1000)
+        progress.finish()
+        compare([
+            C(Report, files=2, bytes=0, directory='/etc', expected=10,
+              done=False, strict=False),
+            C(Report, files=4, bytes=1000, directory='/etc', expected=10,
+              done=False, strict=False),
+            C(Report, files=4, bytes=1000, directory='/etc', expected=10,
+              done=True, strict=False),
+        ], self.reports())
+        compare([0.3, 0.6, 0.7],
+                [round(r.elapsed, 6) for r in self.reports()])
+
+    def test_no_notifiers(self):
+        progress = Progress(DummySource())
+        progress.file('/etc/x')
+        progress.finish()
+        compare(1, progress.files)
+
+
+class TestCounts(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_round_trip(self):
+        compare(None, previous_count(self.dir.path))
+        record_count(self.dir.path, 42)
+        compare(42, previous_count(self.dir.path))
+
+    def test_corrupt(self):
+        self.dir.write('.archivist-progress', 'junk')
+        compare(None, previous_count(self.dir.path))
+
+
+class TestPathsProgress(TestCase):
+
+    def test_events(self):
+        with TempDirectory() as dir:
+            dir.write('source/a', b'aaa')
+            dir.write('source/sub/b', b'bb')
+            plugin = PathsSource('paths', None, 'config',
+                                 [dir.getpath('source')])
+            plugin.progress = progress = Progress(plugin)
+            walked = []
+            progress.walking = walked.append
+            plugin.process(dir.getpath('target'))
+            compare([dir.getpath('source'), dir.getpath('source/sub')],
+                    walked)
+            compare(2, progress.files)
+            compare(5, progress.bytes)
@@ -1,10 +1,11 @@
 import os
 from unittest import TestCase
 from testfixtures import TempDirectory, compare, LogCapture, test_datetime, \
-    Replacer
-from voluptuous import Schema
+    Replacer, test_time, ShouldRaise
+from voluptuous import Schema, MultipleInvalid
 from archivist.config import default_repo_config
 from archivist.helpers import run
+from archivist.metrics import metrics
 from archivist.plugins import Source
 from archivist.repos.git import Plugin as GitRepo
 
@@ -27,6 +28,20 @@ class PluginTests(TestCase):
                 GitRepo.schema(dict(type='git', name='config', path='/foo',
                                     git='svn', commit=False, push=True)))
 
+    def test_schema_workers_at_least_one(self):
+        with ShouldRaise(MultipleInvalid):
+            GitRepo.schema(dict(type='git', path='/foo', name='config',
+                                shard='type', workers=0))
+
+    def test_schema_maintenance_defaults(self):
+        compare(dict(type='git', name='config', path='/foo',
+                     git='git', commit=True, push=False,
+                     maintenance=dict(loose_objects=1000, packs=20,
+                                      commit_graph=True, many_files=False,
+                                      interval=604800)),
+                GitRepo.schema(dict(type='git', path='/foo', name='config',
+                                    maintenance={})))
+
 
 class PluginWithTempDirTests(TestCase):
 
@@ -39,6 +54,9 @@ class PluginWithTempDirTests(TestCase):
             plugin = make_git_repo(path=path or self.dir.path, **kw)
             with Replacer() as r:
                 r.replace('archivist.repos.git.datetime', test_datetime())
+                # every call to time() is a second later than the last:
+                r.replace('archivist.repos.git.time',
+                          test_time(delta=1, delta_type='seconds'))
                 plugin.actions()
         return log
 
@@ -92,6 +110,14 @@ class PluginWithTempDirTests(TestCase):
                 ))
         self.assertTrue(os.path.exists(self.dir.getpath('dummy')))
 
+    def test_path_for_not_created(self):
+        repo = make_git_repo(path=self.dir.path, shard='source')
+        compare(self.dir.getpath('dummy/the_name'),
+                repo.path_for(self.get_dummy_source('the_name'),
+                              create=False))
+        self.dir.compare([])
+        compare(set(), repo.shards)
+
     def test_not_there(self):
         repo_path = self.dir.getpath('var')
         log = self.run_actions(repo_path)
@@ -198,6 +224,292 @@ class PluginWithTempDirTests(TestCase):
         log = self.run_actions(commit=True, push=True)
         log.check() # no logging
 
+    def test_maintenance(self):
+        self.make_repo_with_content()
+        self.make_local_changes()
+        log = self.run_actions(maintenance={})
+        log.check(self.status_log_entry([
+            'changes found in git repo at {repo}:',
+            ' M b',
+            ' D c',
+            '?? d',
+            ]),
+            ('archivist.repos.git', 'INFO', 'changes committed'),
+            ('archivist.repos.git', 'INFO',
+             # three git commands, each timed for metrics:
+             'maintenance of {} took 7.00s'.format(self.dir.path)),
+            )
+        self.assertTrue(os.path.exists(self.dir.getpath(
+            '.git/objects/info/commit-graphs/commit-graph-chain'
+        )))
+
+    def test_maintenance_repack_loose_objects(self):
+        self.make_repo_with_content()
+        self.make_local_changes()
+        self.run_actions(maintenance=dict(loose_objects=0,
+                                          commit_graph=False))
+        counts = make_git_repo(path=self.dir.path).object_counts()
+        compare(0, counts['count'])
+        compare(1, counts['packs'])
+        self.assertFalse(os.path.exists(self.dir.getpath(
+            '.git/objects/info/commit-graphs'
+        )))
+
+    def test_maintenance_full_repack(self):
+        self.make_repo_with_content()
+        self.make_local_changes()
+        self.run_actions(maintenance=dict(loose_objects=0))
+        self.dir.write('e', 'yet more content')
+        self.run_actions(maintenance=dict(packs=0))
+        counts = make_git_repo(path=self.dir.path).object_counts()
+        compare(0, counts['count'])
+        compare(1, counts['packs'])
+
+    def test_maintenance_no_changes(self):
+        self.git('init')
+        log = self.run_actions(maintenance={})
+        log.check() # no logging, no maintenance
+
+    def test_maintenance_no_changes_but_due(self):
+        self.make_repo_with_content()
+        self.dir.write('.git/archivist-maintained', '0.0')
+        log = self.run_actions(maintenance={})
+        log.check(('archivist.repos.git', 'INFO',
+                   'maintenance of {} took 7.00s'.format(self.dir.path)))
+        last = float(self.dir.read('.git/archivist-maintained'))
+        # a second run straight after doesn't maintain again:
+        log = self.run_actions(maintenance={})
+        log.check()
+        compare(last, float(self.dir.read('.git/archivist-maintained')))
+
+    def test_maintenance_interval_starts_on_first_run(self):
+        self.make_repo_with_content()
+        log = self.run_actions(maintenance=dict(interval=0))
+        log.check()
+        self.assertTrue(os.path.exists(
+            self.dir.getpath('.git/archivist-maintained')
+        ))
+
+    def test_many_files(self):
+        self.git('init')
+        self.run_actions(maintenance=dict(many_files=True))
+        compare('true\n', self.git('config feature.manyFiles'))
+        compare('true\n', self.git('config core.untrackedCache'))
+
+    def test_many_files_only_set_once(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.git('init')
+        self.run_actions(maintenance=dict(many_files=True))
+        # listed once, then each setting changed:
+        compare(3, metrics.get('archivist_git_commands', command='config'))
+        metrics.reset()
+        self.run_actions(maintenance=dict(many_files=True))
+        compare(1, metrics.get('archivist_git_commands', command='config'))
+
+    def test_metrics(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.make_repo_with_content()
+        self.make_local_changes()
+        self.run_actions()
+        compare(1, metrics.get('archivist_repo_commit_made',
+                               repo='test', path=self.dir.path))
+        compare(1, metrics.get('archivist_git_commands', command='commit'))
+        compare(1, metrics.get('archivist_git_command_seconds',
+                               command='commit'))
+
+    def test_metrics_no_commit(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.git('init')
+        self.run_actions()
+        compare(0, metrics.get('archivist_repo_commit_made',
+                               repo='test', path=self.dir.path))
+
+    def test_temporary_files_excluded(self):
+        self.make_repo_with_content()
+        self.dir.write('.archivist-tmp-abc123', 'partial')
+        self.dir.write('sub/.archivist-tmp-def456', 'partial')
+        log = self.run_actions()
+        log.check() # no changes found
+        compare('.archivist-*',
+                self.dir.read('.git/info/exclude').splitlines()[-1])
+
+    def test_exclude_only_added_once(self):
+        self.git('init')
+        self.run_actions()
+        self.run_actions()
+        lines = self.dir.read('.git/info/exclude').splitlines()
+        compare(1, lines.count('.archivist-*'))
+
+    def test_lock_path(self):
+        repo_path = self.dir.getpath('var')
+        compare(self.dir.getpath('var/.archivist-lock'),
+                make_git_repo(path=repo_path).lock_path())
+        self.assertTrue(os.path.isdir(repo_path))
+
+    def test_ledger_path(self):
+        compare(self.dir.getpath('var/.archivist-ledger.sqlite'),
+                make_git_repo(path=self.dir.getpath('var')).ledger_path())
+
+    def test_shard_for_not_sharded(self):
+        plugin = make_git_repo(path=self.dir.path)
+        compare(None, plugin.shard_for(self.get_dummy_source('the_name')))
+
+    def test_shard_by_type(self):
+        plugin = make_git_repo(path=self.dir.path, shard='type')
+        compare(self.dir.getpath('dummy'),
+                plugin.shard_for(self.get_dummy_source('the_name')))
+
+    def test_shard_by_source(self):
+        plugin = make_git_repo(path=self.dir.path, shard='source')
+        compare(self.dir.getpath('dummy/the_name'),
+                plugin.shard_for(self.get_dummy_source('the_name')))
+        compare(self.dir.getpath('dummy'),
+                plugin.shard_for(self.get_dummy_source(None)))
+
+    def test_sharded_actions(self):
+        plugin = make_git_repo(path=self.dir.path, shard='source', workers=1)
+        for name in 'one', 'two':
+            path = plugin.path_for(self.get_dummy_source(name))
+            with open(os.path.join(path, 'file'), 'w') as output:
+                output.write(name + ' content')
+
+        with LogCapture() as log:
+            with Replacer() as r:
+                r.replace('archivist.repos.git.datetime', test_datetime())
+                plugin.actions()
+
+        one = self.dir.getpath('dummy/one')
+        two = self.dir.getpath('dummy/two')
+        log.check(
+            ('archivist.repos.git', 'INFO', 'creating git repo at '+one),
+            ('archivist.repos.git', 'INFO',
+             'changes found in git repo at {}:\n?? file\n'.format(one)),
+            ('archivist.repos.git', 'INFO', 'changes committed'),
+            ('archivist.repos.git', 'INFO', 'creating git repo at '+two),
+            ('archivist.repos.git', 'INFO',
+             'changes found in git repo at {}:\n?? file\n'.format(two)),
+            ('archivist.repos.git', 'INFO', 'changes committed'),
+            ('archivist.repos.git', 'INFO',
+             'creating git repo at '+self.dir.path),
+            self.status_log_entry([
+                'changes found in git repo at {repo}:',
+                '?? .gitignore',
+                '?? shards.txt',
+            ]),
+            ('archivist.repos.git', 'INFO', 'changes committed'),
+        )
+        compare('/dummy/one/\n/dummy/two/\n', self.dir.read('.gitignore'))
+        compare('{} dummy/one\n{} dummy/two\n'.format(
+            self.git('rev-parse HEAD', one).strip(),
+            self.git('rev-parse HEAD', two).strip(),
+        ), self.dir.read('shards.txt'))
+        compare('', self.git('status --porcelain'))
+        self.check_git_log([
+            'Recorded by archivist at 2001-01-01 00:00',
+            ' file | 1 +',
+            ' 1 file changed, 1 insertion(+)',
+        ], repo_path=one)
+
+    def test_sharded_source_removed(self):
+        plugin = make_git_repo(path=self.dir.path, shard='source')
+        for name in 'one', 'two':
+            path = plugin.path_for(self.get_dummy_source(name))
+            self.dir.write(os.path.join(path, 'file'), name)
+        with LogCapture():
+            plugin.actions()
+        # a later run with only one of the sources configured:
+        plugin = make_git_repo(path=self.dir.path, shard='source')
+        path = plugin.path_for(self.get_dummy_source('one'))
+        self.dir.write(os.path.join(path, 'file'), 'changed')
+        with LogCapture():
+            plugin.actions()
+        compare('/dummy/one/\n/dummy/two/\n', self.dir.read('.gitignore'))
+        compare(['dummy/one', 'dummy/two'],
+                [line.split()[1] for line in
+                 self.dir.read('shards.txt').splitlines()])
+        compare('', self.git('status --porcelain'))
+
+    def test_check_sources_nested_shards(self):
+        plugin = make_git_repo(path=self.dir.path, shard='source')
+        compare("sources of type 'dummy' with and without names cannot be "
+                "sharded by source as their repos would be nested",
+                plugin.check_sources([self.get_dummy_source(None),
+                                      self.get_dummy_source('one')]))
+        compare(None, plugin.check_sources([self.get_dummy_source('one'),
+                                            self.get_dummy_source('two')]))
+        plugin = make_git_repo(path=self.dir.path, shard='type')
+        compare(None, plugin.check_sources([self.get_dummy_source(None),
+                                            self.get_dummy_source('one')]))
+
+    def test_sharded_actions_in_parallel(self):
+        plugin = make_git_repo(path=self.dir.path, shard='type')
+        for type_ in 'a', 'b', 'c':
+            source = self.get_dummy_source(None)
+            source.type = type_
+            path = plugin.path_for(source)
+            with open(os.path.join(path, 'file'), 'w') as output:
+                output.write(type_)
+        with LogCapture():
+            plugin.actions()
+        for type_ in 'a', 'b', 'c':
+            compare('', self.git('status --porcelain', self.dir.getpath(type_)))
+        compare('', self.git('status --porcelain'))
+
+    def test_committed(self):
+        self.make_repo_with_content()
+        self.dir.write('sub/d', 'other content')
+        self.git('add .')
+        self.git('commit -m more')
+        self.dir.write('sub/d', 'uncommitted')
+        plugin = make_git_repo(path=self.dir.path)
+        compare(dict(d=self.git('rev-parse HEAD:sub/d').strip()),
+                plugin.committed(self.dir.getpath('sub')))
+        compare(4, len(plugin.committed(self.dir.path)))
+
+    def test_committed_path_missing(self):
+        self.make_repo_with_content()
+        plugin = make_git_repo(path=self.dir.path)
+        compare({}, plugin.committed(self.dir.getpath('missing')))
+        compare(None, plugin.read_committed(self.dir.getpath('missing'),
+                                            'contents.txt'))
+
+    def test_read_committed(self):
+        self.make_repo_with_content()
+        self.dir.write('sub/d', 'other content')
+        self.git('add .')
+        self.git('commit -m more')
+        self.dir.write('sub/d', 'uncommitted')
+        self.dir.write('sub/e', 'never committed')
+        plugin = make_git_repo(path=self.dir.path)
+        compare('other content',
+                plugin.read_committed(self.dir.getpath('sub'), 'd'))
+        compare(None, plugin.read_committed(self.dir.getpath('sub'), 'e'))
+
+    def test_read_committed_nothing_committed(self):
+        self.git('init')
+        compare(None, make_git_repo(path=self.dir.path).read_committed(
+            self.dir.path, 'contents.txt'
+        ))
+
+    def test_committed_nothing_committed(self):
+        self.git('init')
+        compare({}, make_git_repo(path=self.dir.path).committed(
+            self.dir.path
+        ))
+
+    def test_sharded_no_commit(self):
+        plugin = make_git_repo(path=self.dir.path, shard='type', commit=False)
+        path = plugin.path_for(self.get_dummy_source(None))
+        with open(os.path.join(path, 'file'), 'w') as output:
+            output.write('content')
+        with LogCapture():
+            plugin.actions()
+        compare('/dummy/\n', self.dir.read('.gitignore'))
+        compare('', self.dir.read('shards.txt'))
+
     def test_default_repo_config(self):
         # can't test actions due to default path
         GitRepo(**GitRepo.schema(default_repo_config))
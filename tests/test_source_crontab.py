@@ -1,14 +1,242 @@
+import os
+from subprocess import Popen
 from unittest import TestCase
-from testfixtures import compare
+from testfixtures import compare, LogCapture, Replacer
+from archivist.helpers import blob_hash
+from archivist.preview import preview
 from archivist.sources.crontab import Plugin
 from tests.helpers import SingleCommandMixin
+from tests.test_repo_git import make_git_repo
 
 
 class TestPackages(SingleCommandMixin, TestCase):
 
     def test_simple(self):
         self.Popen.set_command('crontab -l -u foo', stdout=b'a crontab')
-        plugin = Plugin(**Plugin.schema(dict(type='packages', name='foo')))
+        plugin = Plugin(**Plugin.schema(dict(type='crontab', name='foo')))
         plugin.process(self.dir.path)
         self.dir.compare(expected=['foo'])
         compare(b'a crontab', self.dir.read('foo'))
+
+    def test_users(self):
+        self.Popen.set_command('crontab -l -u foo', stdout=b'foo crontab')
+        self.Popen.set_command('crontab -l -u bar', stdout=b'bar crontab')
+        plugin = Plugin(**Plugin.schema(dict(type='crontab', name='users',
+                                             users=['foo', 'bar'])))
+        plugin.process(self.dir.path)
+        self.dir.compare(expected=['bar', 'foo'])
+        compare(b'foo crontab', self.dir.read('foo'))
+        compare(b'bar crontab', self.dir.read('bar'))
+
+    def test_users_expected(self):
+        self.Popen.set_command('crontab -l -u foo', stdout=b'a crontab')
+        plugin = Plugin(**Plugin.schema(dict(type='crontab', name='foo')))
+        compare({self.dir.getpath('foo'): blob_hash(b'a crontab')},
+                plugin.expected(self.dir.path))
+        self.dir.compare([])
+
+    def test_users_fingerprint(self):
+        self.dir.write('spool/foo', b'')
+        plugin = Plugin(type='crontab', name='users', users=['foo', 'bar'],
+                        spool=self.dir.getpath('spool'))
+        compare(None, plugin.fingerprint())
+        self.dir.write('spool/bar', b'')
+        compare([self.dir.getpath('spool/foo'),
+                 self.dir.getpath('spool/bar')],
+                [entry[0] for entry in plugin.fingerprint()])
+
+
+class TestAllCrontabs(SingleCommandMixin, TestCase):
+
+    def make_plugin(self):
+        return Plugin(**Plugin.schema(dict(
+            type='crontab', name=None, repo='config',
+            spool=self.dir.getpath('spool'),
+            system=[self.dir.getpath('etc/crontab'),
+                    self.dir.getpath('etc/cron.d'),
+                    self.dir.getpath('etc/missing')],
+        )))
+
+    def setUp(self):
+        super(TestAllCrontabs, self).setUp()
+        self.dir.write('spool/root', b'root crontab')
+        self.dir.write('spool/www', b'www crontab')
+        self.dir.write('etc/crontab', b'system crontab')
+        self.dir.write('etc/cron.d/backup', b'backup crontab')
+        self.target = self.dir.makedir('target')
+
+    def relative(self, path):
+        return self.dir.getpath(path)[1:]
+
+    def test_all(self):
+        self.make_plugin().process(self.target)
+        self.dir.compare(path='target', files_only=True, expected=[
+            self.relative(p) for p in
+            ('etc/cron.d/backup', 'etc/crontab', 'spool/root', 'spool/www')
+        ] + ['crontabs.txt'])
+        compare(''.join(self.dir.getpath(p)+'\n' for p in
+                        ('etc/cron.d/backup', 'etc/crontab',
+                         'spool/root', 'spool/www')),
+                self.dir.read('target/crontabs.txt'))
+        compare(b'www crontab',
+                self.dir.read('target/' + self.relative('spool/www')))
+        # no crontab commands run:
+        compare([], self.Popen.all_calls)
+
+    def test_unchanged_not_copied(self):
+        plugin = self.make_plugin()
+        plugin.process(self.target)
+        target_path = self.dir.getpath('target/' + self.relative('spool/www'))
+        inode = os.stat(target_path).st_ino
+        plugin.process(self.target)
+        compare(inode, os.stat(target_path).st_ino)
+
+    def test_same_size_and_mtime_copied(self):
+        plugin = self.make_plugin()
+        plugin.process(self.target)
+        source_path = self.dir.getpath('spool/www')
+        stat = os.stat(source_path)
+        self.dir.write('spool/www', b'new crontab')
+        os.utime(source_path, (stat.st_atime, stat.st_mtime))
+        plugin.process(self.target)
+        compare(b'new crontab',
+                self.dir.read('target/' + self.relative('spool/www')))
+
+    def test_changed_copied(self):
+        plugin = self.make_plugin()
+        plugin.process(self.target)
+        source_path = self.dir.write('spool/www', b'new crontab')
+        os.utime(source_path, (1, 1))
+        plugin.process(self.target)
+        compare(b'new crontab',
+                self.dir.read('target/' + self.relative('spool/www')))
+
+    def test_removed(self):
+        plugin = self.make_plugin()
+        plugin.process(self.target)
+        os.remove(self.dir.getpath('spool/www'))
+        plugin.process(self.target)
+        self.dir.compare(path='target', files_only=True, expected=[
+            self.relative(p) for p in
+            ('etc/cron.d/backup', 'etc/crontab', 'spool/root')
+        ] + ['crontabs.txt'])
+
+    def test_removed_empty_directories(self):
+        plugin = self.make_plugin()
+        plugin.process(self.target)
+        os.remove(self.dir.getpath('etc/cron.d/backup'))
+        plugin.process(self.target)
+        self.assertFalse(os.path.exists(
+            self.dir.getpath('target/' + self.relative('etc/cron.d'))
+        ))
+        self.assertTrue(os.path.exists(
+            self.dir.getpath('target/' + self.relative('etc/crontab'))
+        ))
+
+    def test_only_mirrored_files_removed(self):
+        # files that this source didn't mirror are left alone, such as
+        # those of a named crontab source, shard repos and the temporary
+        # files of sources being processed at the same time:
+        others = ('bob/bob', 'bob/.archivist-fingerprint', '.git/HEAD',
+                  '.git/objects/ab/cdef',
+                  self.relative('etc/.archivist-tmp-123'))
+        for path in others:
+            self.dir.write('target/' + path, b'other')
+        plugin = self.make_plugin()
+        plugin.process(self.target)
+        os.remove(self.dir.getpath('spool/www'))
+        plugin.process(self.target)
+        for path in others:
+            compare(b'other', self.dir.read('target/' + path))
+        self.assertFalse(os.path.exists(
+            self.dir.getpath('target/' + self.relative('spool/www'))
+        ))
+
+    def test_preview(self):
+        plugin = self.make_plugin()
+        plugin.process(self.target)
+        compare([], preview(plugin, self.target))
+        os.remove(self.dir.getpath('spool/www'))
+        self.dir.write('etc/crontab', b'changed')
+        self.dir.write('spool/new', b'new')
+        before = sorted(os.walk(self.target))
+        compare([
+            ('modified', self.dir.getpath('target/crontabs.txt')),
+            ('modified', self.dir.getpath('target/' +
+                                          self.relative('etc/crontab'))),
+            ('added', self.dir.getpath('target/' +
+                                       self.relative('spool/new'))),
+            ('deleted', self.dir.getpath('target/' +
+                                         self.relative('spool/www'))),
+        ], preview(plugin, self.target))
+        compare(before, sorted(os.walk(self.target)))
+
+    def test_named_and_unnamed_sources(self):
+        self.Popen.set_command('crontab -l -u bob', stdout=b'bob crontab')
+        repo = make_git_repo(path=self.dir.getpath('repo'))
+        named = Plugin(type='crontab', name='bob')
+        unnamed = self.make_plugin()
+        for _ in range(2):
+            for plugin in named, unnamed:
+                path = repo.path_for(plugin)
+                plugin.process(path)
+                plugin.record_fingerprint(path, 'x')
+        compare(b'bob crontab', self.dir.read('repo/crontab/bob/bob'))
+        compare(b"'x'",
+                self.dir.read('repo/crontab/bob/.archivist-fingerprint'))
+
+    def test_shard_by_type(self):
+        repo = make_git_repo(path=self.dir.getpath('repo'), shard='type')
+        plugin = self.make_plugin()
+        with Replacer() as r:
+            r.replace('archivist.helpers.Popen', Popen)
+            for _ in range(2):
+                plugin.process(repo.path_for(plugin))
+                with LogCapture():
+                    repo.actions()
+        self.assertTrue(os.path.exists(
+            self.dir.getpath('repo/crontab/.git/HEAD')
+        ))
+        compare(b'www crontab', self.dir.read(
+            'repo/crontab/' + self.relative('spool/www')
+        ))
+
+    def test_fingerprint_kept(self):
+        plugin = self.make_plugin()
+        fingerprint = self.dir.write('target/.archivist-fingerprint', 'x')
+        plugin.process(self.target)
+        compare(b'x', self.dir.read(fingerprint))
+
+    def test_fingerprint(self):
+        plugin = self.make_plugin()
+        fingerprint = plugin.fingerprint()
+        compare(
+            [self.dir.getpath(p) for p in
+             ('spool', 'etc/cron.d', 'spool/root', 'spool/www',
+              'etc/crontab', 'etc/cron.d/backup')],
+            [entry[0] for entry in fingerprint]
+        )
+        compare(fingerprint, plugin.fingerprint())
+        os.utime(self.dir.getpath('etc/crontab'), (1, 1))
+        self.assertNotEqual(fingerprint, plugin.fingerprint())
+
+    def test_fingerprint_removed(self):
+        plugin = self.make_plugin()
+        fingerprint = plugin.fingerprint()
+        os.remove(self.dir.getpath('spool/www'))
+        os.utime(self.dir.getpath('spool'), (1, 1))
+        self.assertNotEqual(fingerprint, plugin.fingerprint())
+
+    def test_fingerprint_user(self):
+        plugin = Plugin(type='crontab', name='root',
+                        spool=self.dir.getpath('spool'))
+        stat = os.stat(self.dir.getpath('spool/root'))
+        compare(((self.dir.getpath('spool/root'), stat.st_ino, stat.st_size,
+                  stat.st_mtime), ), plugin.fingerprint())
+        plugin.name = 'nobody'
+        compare(None, plugin.fingerprint())
+
+    def test_defaults(self):
+        plugin = Plugin(**Plugin.schema(dict(type='crontab', name=None)))
+        compare('/var/spool/cron/crontabs', plugin.spool)
+        compare(('/etc/crontab', '/etc/cron.d'), plugin.system)
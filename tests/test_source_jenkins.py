@@ -6,6 +6,7 @@ from unittest import TestCase
 from testfixtures import TempDirectory, compare, ShouldRaise
 
 from archivist.plugins import Source
+from archivist.preview import preview
 from archivist.sources.jenkins import Plugin
 from tests.helpers import ShouldFailSchemaWith
 from tests.test_source_paths import PathsHelper
@@ -109,6 +110,18 @@ class TestJenkinsSourceWithFileTree(PathsHelper, TestCase):
             "rwxrwxrwx {} {}\n".format(self.user_group, p1),
         ]))
 
+    def test_preview(self):
+        self.write_file('nodeMonitors.xml', 'nodeMonitors')
+        plugin = self.make_plugin()
+        target = self.dir.getpath('target')
+        plugin.process(target)
+        compare([], preview(self.make_plugin(), target))
+        self.write_file('jobs/new/config.xml', 'new')
+        compare([
+            ('modified', self.dir.getpath('target/contents.txt')),
+            ('added', self.dir.getpath('target/jobs/new/config.xml')),
+        ], preview(self.make_plugin(), target))
+
     def _write_jpi(self, name, manifest):
         self.dir.write('plugins/'+name+'/META-INF/MANIFEST.MF', manifest)
 
@@ -1,8 +1,10 @@
+import os
 from unittest import TestCase
 
 from testfixtures import compare
 
-from archivist.sources.packages import Plugin
+from archivist.helpers import mtime_matches, blob_hash
+from archivist.sources.packages import Plugin, rpm_query_format
 from tests.helpers import ShouldFailSchemaWith, SingleCommandMixin
 
 
@@ -22,7 +24,147 @@ class TestPackages(SingleCommandMixin, TestCase):
         self.dir.compare(expected=['dpkg'])
         compare(b'some packages', self.dir.read('dpkg'))
 
+    def test_expected(self):
+        self.Popen.set_command('rpm -qa', stdout=b'some packages')
+        plugin = Plugin(**Plugin.schema(dict(type='packages', name='rpm')))
+        compare({self.dir.getpath('rpm'): blob_hash(b'some packages')},
+                plugin.expected(self.dir.path))
+        self.dir.compare([])
+
     def test_wrong(self):
         text = "not a valid value for dictionary value @ data['name']"
         with ShouldFailSchemaWith(text):
             Plugin.schema(dict(type='packages', name='foo'))
+
+    def test_no_repo(self):
+        plugin = Plugin(**Plugin.schema(dict(type='packages', name='rpm',
+                                             repo='other')))
+        compare('other', plugin.repo)
+
+
+dpkg_status = b"""\
+Package: zlib1g
+Status: install ok installed
+Architecture: amd64
+Version: 1:1.2.13.dfsg-1
+Description: compression library - runtime
+ zlib is a library implementing the deflate compression method found
+ in gzip and PKZIP.
+
+Package: adduser
+Status: install ok installed
+Priority: important
+Architecture: all
+Version: 3.134
+Conffiles:
+ /etc/adduser.conf cc3493ecd2d09837ffdcc3e25fdfff18
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: all
+Version: 1.0
+"""
+
+
+class TestInventory(SingleCommandMixin, TestCase):
+
+    def make_plugin(self, name, database=None):
+        return Plugin(**Plugin.schema(dict(
+            type='packages', name=name, format='inventory',
+            database=database or self.dir.getpath('db')
+        )))
+
+    def test_dpkg(self):
+        self.dir.write('db', dpkg_status)
+        plugin = self.make_plugin('dpkg')
+        plugin.process(self.dir.makedir('out'))
+        compare(b'adduser 3.134 all\n'
+                b'zlib1g 1:1.2.13.dfsg-1 amd64\n',
+                self.dir.read('out/dpkg'))
+        # no commands run:
+        compare([], self.Popen.all_calls)
+
+    def test_rpm(self):
+        self.dir.write('db', b'')
+        self.Popen.set_command(
+            "rpm -qa --queryformat '%s'" % rpm_query_format,
+            stdout=b'zsh 5.8-9.el9 x86_64\nbash 5.1.8-6.el9 x86_64\n'
+        )
+        plugin = self.make_plugin('rpm')
+        plugin.process(self.dir.makedir('out'))
+        compare(b'bash 5.1.8-6.el9 x86_64\n'
+                b'zsh 5.8-9.el9 x86_64\n',
+                self.dir.read('out/rpm'))
+
+    def test_unchanged_database(self):
+        db = self.dir.write('db', dpkg_status)
+        plugin = self.make_plugin('dpkg')
+        out = self.dir.makedir('out')
+        plugin.process(out)
+        self.assertTrue(mtime_matches(out+'/dpkg', os.stat(db).st_mtime))
+        # prove the database isn't read again:
+        with open(db, 'w') as database:
+            database.write('Package: new\n')
+        os.utime(db, (os.stat(out+'/dpkg').st_mtime, ) * 2)
+        plugin.process(out)
+        compare(b'adduser 3.134 all\n'
+                b'zlib1g 1:1.2.13.dfsg-1 amd64\n',
+                self.dir.read('out/dpkg'))
+
+    def test_changed_database(self):
+        db = self.dir.write('db', dpkg_status)
+        plugin = self.make_plugin('dpkg')
+        out = self.dir.makedir('out')
+        plugin.process(out)
+        self.dir.write('db', dpkg_status.replace(b'3.134', b'3.135'))
+        os.utime(db, (1, 1))
+        plugin.process(out)
+        compare(b'adduser 3.135 all\n'
+                b'zlib1g 1:1.2.13.dfsg-1 amd64\n',
+                self.dir.read('out/dpkg'))
+
+    def test_database_missing(self):
+        self.Popen.set_command(
+            "rpm -qa --queryformat '%s'" % rpm_query_format,
+            stdout=b'zsh 5.8-9.el9 x86_64\n'
+        )
+        plugin = self.make_plugin('rpm', database=self.dir.getpath('nope'))
+        out = self.dir.makedir('out')
+        plugin.process(out)
+        plugin.process(out)
+        # rpm was run both times:
+        compare(['Popen', 'Popen'],
+                [c[0] for c in self.Popen.all_calls if c[0] == 'Popen'])
+        compare(b'zsh 5.8-9.el9 x86_64\n', self.dir.read('out/rpm'))
+
+    def test_expected(self):
+        db = self.dir.write('db', dpkg_status)
+        plugin = self.make_plugin('dpkg')
+        out = self.dir.makedir('out')
+        compare({out+'/dpkg': blob_hash(b'adduser 3.134 all\n'
+                                        b'zlib1g 1:1.2.13.dfsg-1 amd64\n')},
+                plugin.expected(out))
+        self.dir.compare(['db', 'out/'])
+        plugin.process(out)
+        compare({}, plugin.expected(out))
+        os.utime(db, (1, 1))
+        compare([out+'/dpkg'], list(plugin.expected(out)))
+
+    def test_fingerprint(self):
+        db = self.dir.write('db', dpkg_status)
+        plugin = self.make_plugin('dpkg')
+        fingerprint = plugin.fingerprint()
+        compare(('inventory', db), fingerprint[:2])
+        compare(fingerprint, plugin.fingerprint())
+        os.utime(db, (1, 1))
+        self.assertNotEqual(fingerprint, plugin.fingerprint())
+        plugin.format = 'raw'
+        compare('raw', plugin.fingerprint()[0])
+
+    def test_fingerprint_database_missing(self):
+        plugin = self.make_plugin('rpm', database=self.dir.getpath('nope'))
+        compare(None, plugin.fingerprint())
+
+    def test_default_database(self):
+        plugin = Plugin(type='packages', name='dpkg')
+        compare('/var/lib/dpkg/status', plugin.database)
@@ -1,15 +1,25 @@
 from __future__ import absolute_import
 
 from grp import getgrgid
+import socket
 import os
 from pwd import getpwuid
 from unittest import TestCase
 
-from testfixtures import compare, TempDirectory
+from mock import Mock
+from testfixtures import (
+    compare, TempDirectory, LogCapture, ShouldRaise, Replacer
+)
 
+import archivist.helpers
+import archivist.writer
+from archivist.helpers import content_hash
+
+from archivist.limits import Budget, LimitExceeded
 from archivist.plugins import Source
+from archivist.progress import Progress
 from archivist.sources.paths import Plugin
-from tests.helpers import ShouldFailSchemaWith
+from tests.helpers import ShouldFailSchemaWith, set_xattr
 
 
 class TestPathSource(TestCase):
@@ -40,9 +50,13 @@ class TestPathSource(TestCase):
             Plugin.schema(dict(type='paths', foo='bar'))
 
     def test_name_supplied(self):
+        compare(dict(type='paths', name='foo', values=['/']),
+                Plugin.schema(dict(type='paths', name='foo', values=['/'])))
+
+    def test_name_not_string(self):
         text = "not a valid value for dictionary value @ data['name']"
         with ShouldFailSchemaWith(text):
-            Plugin.schema(dict(type='paths', name='foo'))
+            Plugin.schema(dict(type='paths', name=1))
 
     def test_no_paths(self):
         text = "length of value must be at least 1 for dictionary value " \
@@ -206,3 +220,485 @@ r-x-wx--- looong group    /b
                 "rwxrwxrwx {} {}\n".format(self.user_group, a_path),
                 "rwx------ {} {}\n".format(self.user_group, b_path),
                 ]))
+
+    def test_file_too_big(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        b_path, b_rel = self.write_file('b', 'too big', 0777)
+
+        plugin = self.make_plugin('source')
+        plugin.budget = Budget(max_file_size=3)
+        with LogCapture() as log:
+            plugin.process(self.dir.getpath('target'))
+
+        log.check(
+            ('archivist.limits', 'WARNING',
+             'skipping {} as it is larger than 3 bytes'.format(b_path)),
+        )
+        self.dir.compare(path='target',
+                         expected=['contents.txt', a_rel],
+                         files_only=True)
+        compare(self.dir.read('target/contents.txt'),
+                "rwxrwxrwx {} {}\n".format(self.user_group, a_path))
+
+    def test_too_many_files(self):
+        self.write_file('a', 'foo', 0777)
+        self.write_file('b', 'bar', 0777)
+
+        plugin = self.make_plugin('source')
+        plugin.budget = Budget(max_files=1)
+        with ShouldRaise(LimitExceeded('more than 1 files')):
+            plugin.process(self.dir.getpath('target'))
+
+    def test_exclude(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        self.write_file('.a.swp', 'swap', 0777)
+        self.write_file('cache/x', 'cached', 0777)
+        d_path, d_rel = self.write_file('sub/cache', 'a file', 0777)
+        self.write_file('sub/cache.d/x', 'cached', 0777)
+
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')],
+                        exclude=['*.swp', 'cache/', 'cache.d'])
+        plugin.process(self.dir.getpath('target'))
+
+        self.dir.compare(path='target',
+                         expected=['contents.txt', a_rel, d_rel],
+                         files_only=True)
+
+    def test_excluded_directories_not_walked(self):
+        self.write_file('a', 'foo', 0777)
+        self.write_file('cache/x', 'cached', 0777)
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')],
+                        exclude=['cache'])
+        compare([self.dir.getpath('source/a')],
+                list(plugin.walk(self.dir.getpath('source'))))
+
+    def test_include(self):
+        a_path, a_rel = self.write_file('a.conf', 'foo', 0777)
+        self.write_file('b.txt', 'bar', 0777)
+        c_path, c_rel = self.write_file('conf.d/c', 'baz', 0777)
+        self.write_file('other/d', 'bob', 0777)
+
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')],
+                        include=['*.conf', 'conf.d/'])
+        plugin.process(self.dir.getpath('target'))
+
+        self.dir.compare(path='target',
+                         expected=['contents.txt', a_rel, c_rel],
+                         files_only=True)
+
+    def test_include_and_exclude(self):
+        a_path, a_rel = self.write_file('a.conf', 'foo', 0777)
+        self.write_file('old/b.conf', 'bar', 0777)
+
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')],
+                        include=['*.conf'], exclude=['old'])
+        plugin.process(self.dir.getpath('target'))
+
+        self.dir.compare(path='target',
+                         expected=['contents.txt', a_rel],
+                         files_only=True)
+
+    def test_types(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        os.symlink(a_path, self.dir.getpath('source/b'))
+
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')],
+                        types=['file'])
+        plugin.process(self.dir.getpath('target'))
+
+        self.dir.compare(path='target',
+                         expected=['contents.txt', a_rel],
+                         files_only=True)
+
+    def test_schema_filters(self):
+        path = self.dir.write('foo', b'f')
+        config = dict(type='paths', values=[path], repo='config',
+                      include=['*.conf'], exclude=['*.swp'],
+                      types=['file', 'symlink'])
+        compare(config, Plugin.schema(config))
+
+    def test_schema_bad_type(self):
+        path = self.dir.write('foo', b'f')
+        text = "not a valid value @ data['types'][0]"
+        with ShouldFailSchemaWith(text):
+            Plugin.schema(dict(type='paths', values=[path], types=['dir']))
+
+    def test_fifo(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        fifo_path = self.dir.getpath('source/fifo')
+        os.mkfifo(fifo_path, 0640)
+
+        plugin = self.make_plugin('source')
+        # would block forever if the fifo was opened:
+        plugin.process(self.dir.getpath('target'))
+
+        self.dir.compare(path='target',
+                         expected=['contents.txt', a_rel],
+                         files_only=True)
+        compare(self.dir.read('target/contents.txt'), ''.join([
+                "rwxrwxrwx {} {}\n".format(self.user_group, a_path),
+                "prw-r----- {} {}\n".format(self.user_group, fifo_path),
+                ]))
+
+    def test_special_file_added_leaves_other_lines_alone(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+        before = self.dir.read('target/contents.txt')
+        os.mkfifo(self.dir.getpath('source/fifo'), 0640)
+        plugin.process(self.dir.getpath('target'))
+        compare(before, self.dir.read('target/contents.txt').splitlines(
+            True
+        )[0])
+
+    def test_socket(self):
+        socket_path = self.dir.getpath('source/socket')
+        self.dir.makedir('source')
+        server = socket.socket(socket.AF_UNIX)
+        self.addCleanup(server.close)
+        server.bind(socket_path)
+        os.chmod(socket_path, 0700)
+
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+
+        self.dir.compare(path='target',
+                         expected=['contents.txt'],
+                         files_only=True)
+        compare(self.dir.read('target/contents.txt'),
+                "srwx------ {} {}\n".format(self.user_group, socket_path))
+
+    def test_special_file_removed(self):
+        fifo_path = self.dir.getpath('source/fifo')
+        self.dir.makedir('source')
+        os.mkfifo(fifo_path, 0640)
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+        os.remove(fifo_path)
+        plugin.process(self.dir.getpath('target'))
+        compare(self.dir.read('target/contents.txt'), '')
+
+    def test_sparse_file(self):
+        source_path = self.dir.getpath('source/sparse')
+        self.dir.makedir('source')
+        with open(source_path, 'wb') as source:
+            source.write(b'start')
+            source.seek(10 * 1024 * 1024)
+            source.write(b'end')
+
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+
+        target_path = self.dir.getpath('target' + source_path)
+        with open(target_path, 'rb') as target:
+            compare(b'start' + b'\0' * (10 * 1024 * 1024 - 5) + b'end',
+                    target.read())
+        self.assertTrue(os.stat(target_path).st_blocks <=
+                        os.stat(source_path).st_blocks)
+
+    def test_file_link(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        link_path = self.dir.getpath('source/link')
+        os.symlink('a', link_path)
+
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+
+        target_link = self.dir.getpath('target' + link_path)
+        compare('a', os.readlink(target_link))
+        compare(self.dir.read('target/contents.txt'), ''.join([
+                "rwxrwxrwx {} {}\n".format(self.user_group, a_path),
+                "lrwxrwxrwx {} {} -> a\n".format(self.user_group, link_path),
+                ]))
+
+    def test_directory_link_not_followed(self):
+        a_path, a_rel = self.write_file('dir/a', 'foo', 0777)
+        link_path = self.dir.getpath('source/link')
+        os.symlink(self.dir.getpath('source/dir'), link_path)
+
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+
+        compare(self.dir.getpath('source/dir'),
+                os.readlink(self.dir.getpath('target' + link_path)))
+        compare(self.dir.read('target/contents.txt'), ''.join([
+                "rwxrwxrwx {} {}\n".format(self.user_group, a_path),
+                "lrwxrwxrwx {} {} -> {}\n".format(
+                    self.user_group, link_path, self.dir.getpath('source/dir')
+                )]))
+
+    def test_link_replaced_with_file(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        link_path = self.dir.getpath('source/link')
+        os.symlink('a', link_path)
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+
+        os.remove(link_path)
+        self.write_file('link', 'bar', 0777)
+        plugin.process(self.dir.getpath('target'))
+
+        # the file the link pointed to in the archive is untouched:
+        compare('foo', self.dir.read('target' + a_path))
+        compare('bar', self.dir.read('target' + link_path))
+        compare(self.dir.read('target/contents.txt'), ''.join([
+                "rwxrwxrwx {} {}\n".format(self.user_group, a_path),
+                "rwxrwxrwx {} {}\n".format(self.user_group, link_path),
+                ]))
+
+    def test_link_removed(self):
+        self.write_file('a', 'foo', 0777)
+        link_path = self.dir.getpath('source/link')
+        os.symlink('/does/not/exist', link_path)
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+        os.remove(link_path)
+        plugin.process(self.dir.getpath('target'))
+        self.assertFalse(os.path.lexists(self.dir.getpath('target'+link_path)))
+
+    def test_follow_links(self):
+        a_path, a_rel = self.write_file('dir/a', 'foo', 0600)
+        os.symlink(self.dir.getpath('source/dir'),
+                   self.dir.getpath('source/link'))
+        os.symlink('a', self.dir.getpath('source/dir/b'))
+
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')], follow_links=True)
+        plugin.process(self.dir.getpath('target'))
+
+        # dir is walked along both of the ways to it:
+        walked = sorted(os.path.relpath(p, self.dir.getpath('source'))
+                        for p in plugin.walk(self.dir.getpath('source')))
+        compare(['dir/a', 'dir/b', 'link/a', 'link/b'], walked)
+
+        for name in 'dir/b', 'link/b':
+            b_path = self.dir.getpath('source/' + name)
+            compare('foo', self.dir.read('target' + b_path))
+            self.assertFalse(os.path.islink(self.dir.getpath('target' +
+                                                             b_path)))
+
+    def test_follow_links_alias_beside_target(self):
+        self.write_file('real/f', 'foo', 0600)
+        os.symlink('real', self.dir.getpath('source/alias'))
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')], follow_links=True)
+        plugin.process(self.dir.getpath('target'))
+        for name in 'alias/f', 'real/f':
+            compare('foo', self.dir.read(
+                'target' + self.dir.getpath('source/' + name)
+            ))
+
+    def test_follow_links_loop_below_alias(self):
+        self.write_file('real/f', 'foo', 0600)
+        os.symlink('..', self.dir.getpath('source/real/up'))
+        os.symlink('real', self.dir.getpath('source/alias'))
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')], follow_links=True)
+        # up leads back to source, which contains both ways in:
+        compare(['alias/f', 'real/f'],
+                sorted(os.path.relpath(p, self.dir.getpath('source'))
+                       for p in plugin.walk(self.dir.getpath('source'))))
+
+    def test_follow_links_loop(self):
+        self.write_file('dir/a', 'foo', 0600)
+        os.symlink('..', self.dir.getpath('source/dir/up'))
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')], follow_links=True)
+        compare([self.dir.getpath('source/dir/a')],
+                list(plugin.walk(self.dir.getpath('source'))))
+
+    def test_follow_dangling_link(self):
+        link_path = self.dir.getpath('source/link')
+        self.dir.makedir('source')
+        os.symlink('/does/not/exist', link_path)
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')], follow_links=True)
+        plugin.process(self.dir.getpath('target'))
+        compare('/does/not/exist',
+                os.readlink(self.dir.getpath('target' + link_path)))
+
+    def test_shared_target_read_once(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0600)
+        for name in 'b', 'c':
+            os.symlink('a', self.dir.getpath('source/' + name))
+        plugin = Plugin('source', None, 'config',
+                        [self.dir.getpath('source')], follow_links=True)
+
+        with Replacer() as r:
+            copy_file = Mock(side_effect=archivist.helpers.copy_file)
+            r.replace('archivist.writer.copy_file', copy_file)
+            plugin.process(self.dir.getpath('target'))
+
+        compare(1, copy_file.call_count)
+        for name in 'abc':
+            compare('foo', self.dir.read('target' + a_path[:-1] + name))
+
+    def test_unchanged_not_copied_again(self):
+        self.write_file('a', 'foo', 0600)
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+
+        plugin.progress = Progress()
+        with Replacer() as r:
+            mkstemp = Mock(side_effect=archivist.writer.mkstemp)
+            r.replace('archivist.writer.mkstemp', mkstemp)
+            plugin.process(self.dir.getpath('target'))
+
+        # only contents.txt gets a temporary file:
+        compare(1, mkstemp.call_count)
+        # and the unchanged file isn't counted as bytes copied:
+        compare(1, plugin.progress.files)
+        compare(0, plugin.progress.bytes)
+
+    def test_batched_writes(self):
+        for name in 'abc':
+            self.write_file(name, name, 0600)
+        os.link(self.dir.getpath('source/a'), self.dir.getpath('source/d'))
+        plugin = self.make_plugin('source')
+        plugin.write_batch = 1
+        plugin.process(self.dir.getpath('target'))
+        for name in 'abc':
+            compare(name, self.dir.read('target' + self.dir.getpath(
+                'source/' + name
+            )))
+        compare(os.stat(self.dir.getpath('target' + self.dir.getpath(
+                    'source/a'))).st_ino,
+                os.stat(self.dir.getpath('target' + self.dir.getpath(
+                    'source/d'))).st_ino)
+
+    def test_read_contents_file_with_link_and_spaces(self):
+        path = self.dir.write('contents.txt', '''\
+lrwxrwxrwx x y /foo/a link -> some target
+ rwxr-x--- a b /baz/a file
+''')
+        compare(Plugin.read_contents_file(path), {
+            '/foo/a link': ('lrwxrwxrwx', 'x', 'y', 'some target'),
+            '/baz/a file': ('rwxr-x---', 'a', 'b'),
+        })
+
+    def test_special_permission_bits(self):
+        a_path, a_rel = self.write_file('a', 'foo', 04755)
+        b_path, b_rel = self.write_file('b', 'foo', 02640)
+        c_path = self.dir.makedir('source/c')
+        os.chmod(c_path, 01777)
+        d_path, d_rel = self.write_file('c/d', 'foo', 01644)
+        compare('rwsr-xr-x', Plugin.path_attributes(a_path)[0])
+        compare('rw-r-S---', Plugin.path_attributes(b_path)[0])
+        compare('rwxrwxrwt', Plugin.path_attributes(c_path)[0])
+        compare('rw-r--r-T', Plugin.path_attributes(d_path)[0])
+
+    def test_xattrs(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        b_path, b_rel = self.write_file('b', 'bar', 0777)
+        set_xattr(a_path, 'user.checksum', b'abc123')
+        set_xattr(a_path, 'user.binary', b'\x00\x01')
+
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+
+        compare(self.dir.read('target/xattrs.txt'), '''\
+# file: {}
+user.binary=0sAAE=
+user.checksum="abc123"
+
+'''.format(a_path))
+
+    def test_xattrs_removed(self):
+        a_path, a_rel = self.write_file('a', 'foo', 0777)
+        set_xattr(a_path, 'user.checksum', b'abc123')
+        plugin = self.make_plugin('source')
+        plugin.process(self.dir.getpath('target'))
+        os.remove(a_path)
+        self.write_file('a', 'foo', 0777)
+        plugin.process(self.dir.getpath('target'))
+        self.dir.compare(path='target',
+                         expected=['contents.txt', a_rel],
+                         files_only=True)
+
+    def committed(self, target):
+        # what the repo would say if the archive had been committed:
+        committed = {}
+        content = {}
+        for root, dirs, filenames in os.walk(target):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                committed[path[len(target)+1:]] = content_hash(path)
+                with open(path) as source:
+                    content[path[len(target)+1:]] = source.read()
+        return committed, content.get
+
+    def test_check_no_drift(self):
+        self.write_file('a', 'foo', 0644)
+        self.write_file('sub/b', 'bar', 0644)
+        os.symlink('a', self.dir.getpath('source/link'))
+        plugin = self.make_plugin('source')
+        target = self.dir.getpath('target')
+        plugin.process(target)
+        compare((3, []), plugin.check(target, *self.committed(target)))
+
+    def test_check_drift(self):
+        a_path, _ = self.write_file('a', 'foo', 0644)
+        b_path, _ = self.write_file('b', 'bar', 0644)
+        c_path, _ = self.write_file('c', 'baz', 0644)
+        plugin = self.make_plugin('source')
+        target = self.dir.getpath('target')
+        plugin.process(target)
+        committed, read_committed = self.committed(target)
+
+        self.write_file('a', 'changed', 0644)
+        os.chmod(b_path, 0600)
+        os.remove(c_path)
+        d_path, _ = self.write_file('d', 'new', 0644)
+
+        compare((3, [
+            ('modified', a_path),
+            ('modified', b_path),
+            ('deleted', c_path),
+            ('added', d_path),
+        ]), plugin.check(target, committed, read_committed))
+        # nothing written:
+        compare('foo', self.dir.read('target' + a_path))
+
+    def test_check_xattrs_drift(self):
+        a_path, _ = self.write_file('a', 'foo', 0644)
+        b_path, _ = self.write_file('b', 'bar', 0644)
+        c_path, _ = self.write_file('c', 'baz', 0644)
+        set_xattr(a_path, 'user.checksum', b'abc123')
+        set_xattr(b_path, 'user.checksum', b'abc123')
+        plugin = self.make_plugin('source')
+        target = self.dir.getpath('target')
+        plugin.process(target)
+        committed, read_committed = self.committed(target)
+        compare((3, []), plugin.check(target, committed, read_committed))
+
+        set_xattr(a_path, 'user.checksum', b'def456')
+        set_xattr(c_path, 'user.checksum', b'abc123')
+        compare((3, [
+            ('modified', a_path),
+            ('modified', c_path),
+        ]), plugin.check(target, committed, read_committed))
+
+    def test_check_not_committed(self):
+        a_path, _ = self.write_file('a', 'foo', 0644)
+        plugin = self.make_plugin('source')
+        target = self.dir.getpath('target')
+        plugin.process(target)
+        compare((1, [('added', a_path)]),
+                plugin.check(target, {}, lambda name: None))
+
+    def test_check_uncommitted_contents(self):
+        a_path, _ = self.write_file('a', 'foo', 0644)
+        plugin = self.make_plugin('source')
+        target = self.dir.getpath('target')
+        plugin.process(target)
+        committed, read_committed = self.committed(target)
+        # a run that wasn't committed has recorded the new permissions:
+        os.chmod(a_path, 0600)
+        plugin.process(target)
+        compare((1, [('modified', a_path)]),
+                plugin.check(target, committed, read_committed))
@@ -0,0 +1,82 @@
+from unittest import TestCase
+
+from testfixtures import TempDirectory, compare, ShouldRaise
+from voluptuous import Schema, Required, All, MultipleInvalid
+
+from archivist.templates import (
+    parameter_sets, substitute, parameterised_keys, key_validators
+)
+
+
+class TestParameterSets(TestCase):
+
+    def test_no_parameters(self):
+        compare([{}], parameter_sets(dict(source={})))
+
+    def test_matrix(self):
+        compare([
+            dict(app='api', env='prod'),
+            dict(app='api', env='test'),
+            dict(app='web', env='prod'),
+            dict(app='web', env='test'),
+        ], parameter_sets(dict(matrix=dict(app=['api', 'web'],
+                                           env=['prod', 'test']))))
+
+    def test_glob(self):
+        with TempDirectory() as dir:
+            dir.makedir('srv/web/etc')
+            dir.makedir('srv/api/etc')
+            compare([
+                dict(app=dir.getpath('srv/api'), app_name='api', x=1),
+                dict(app=dir.getpath('srv/web'), app_name='web', x=1),
+            ], parameter_sets(dict(matrix=dict(x=[1]),
+                                   glob=dict(app=dir.getpath('srv/*')))))
+
+    def test_glob_no_matches(self):
+        compare([], parameter_sets(dict(glob=dict(app='/does/not/*'))))
+
+
+class TestSubstitute(TestCase):
+
+    def test_nested(self):
+        compare(dict(type='paths', name='web', values=['/srv/web/etc'],
+                     follow_links=True),
+                substitute(dict(type='paths', name='{app}',
+                                values=['/srv/{app}/etc'],
+                                follow_links=True),
+                           dict(app='web')))
+
+    def test_keeps_type(self):
+        compare(dict(count=3, label='3 items', literal='x{}'.format(3)),
+                substitute(dict(count='{n}', label='{n} items',
+                                literal='x{n}'),
+                           dict(n=3)))
+
+    def test_unknown(self):
+        with ShouldRaise(KeyError('foo')):
+            substitute('{foo}', {})
+
+
+class TestParameterisedKeys(TestCase):
+
+    def test_keys(self):
+        compare(['name', 'values'], parameterised_keys(dict(
+            type='paths', name='{app}', values=['/srv', '/srv/{app}'],
+            include=['{{literal}}'], types=['file']
+        )))
+
+
+class TestKeyValidators(TestCase):
+
+    def test_validators(self):
+        schema = Schema({Required('name'): str, 'values': [int]})
+        validators = key_validators(schema, ['name', 'values'])
+        compare('x', validators['name']('x'))
+        with ShouldRaise(MultipleInvalid):
+            validators['values'](['x'])
+
+    def test_unknown_key(self):
+        compare(None, key_validators(Schema({'name': str}), ['other']))
+
+    def test_not_dict(self):
+        compare(None, key_validators(Schema(All({'name': str})), ['name']))
@@ -0,0 +1,111 @@
+from unittest import TestCase
+
+from testfixtures import compare, ShouldRaise
+from voluptuous import (
+    Schema, Required, Optional, Any, All, Length, Extra, Invalid,
+    ALLOW_EXTRA, REMOVE_EXTRA, Exclusive
+)
+
+from archivist.config import schema as config_schema
+from archivist.plugins import Source
+from archivist.sources.jenkins import Plugin as JenkinsSource
+from archivist.sources.paths import Plugin as PathsSource
+from archivist.validation import compile_schema, validator_for, Mismatch
+
+
+def even(value):
+    if value % 2:
+        raise Invalid('odd')
+    return value * 10
+
+
+class TestCompileSchema(TestCase):
+
+    def check(self, schema, data):
+        # the compiled validator must give the same result as voluptuous:
+        compare(schema(data), compile_schema(schema)(data))
+
+    def check_mismatch(self, schema, data):
+        with ShouldRaise(Mismatch):
+            compile_schema(schema)(data)
+
+    def test_types_and_literals(self):
+        schema = Schema({'type': 'paths', 'name': None, 'size': int,
+                         'flag': bool})
+        self.check(schema, dict(type='paths', name=None, size=1, flag=True))
+        self.check_mismatch(schema, dict(type='other'))
+        self.check_mismatch(schema, dict(size='1'))
+        self.check_mismatch(schema, ['not', 'a', 'dict'])
+
+    def test_extra_keys(self):
+        self.check_mismatch(Schema({'x': int}), dict(y=1))
+        self.check(Schema({'x': int}, extra=ALLOW_EXTRA), dict(x=1, y=2))
+        self.check(Schema({'x': int}, extra=REMOVE_EXTRA), dict(x=1, y=2))
+        self.check(Schema({'x': int, Extra: object}), dict(x=1, y=[2]))
+
+    def test_required_and_defaults(self):
+        schema = Schema({Required('x'): int,
+                         Required('y', default=2): int,
+                         Optional('z', default=[]): [str]})
+        self.check(schema, dict(x=1))
+        self.check(schema, dict(x=1, y=3, z=['a']))
+        self.check_mismatch(schema, dict(y=1))
+
+    def test_schema_required(self):
+        schema = Schema({'x': int, Optional('y'): int}, required=True)
+        self.check(schema, dict(x=1))
+        self.check_mismatch(schema, dict(y=1))
+
+    def test_type_keys(self):
+        schema = Schema({str: [Any(str, int)]})
+        self.check(schema, dict(a=['x', 1], b=[]))
+        self.check_mismatch(schema, {1: []})
+
+    def test_any_all_and_callables(self):
+        schema = Schema({'x': All([Any(int, 'auto')], Length(min=1)),
+                         'y': even})
+        self.check(schema, dict(x=[1, 'auto'], y=2))
+        self.check_mismatch(schema, dict(x=[]))
+        self.check_mismatch(schema, dict(x=['manual']))
+        self.check_mismatch(schema, dict(y=3))
+
+    def test_nested(self):
+        schema = Schema({'outer': {Required('inner', default=1): int},
+                         'schema': Schema({'x': int}, extra=ALLOW_EXTRA)})
+        self.check(schema, dict(outer={}, schema=dict(x=1, y=2)))
+        self.check_mismatch(schema, dict(outer=dict(inner='1')))
+
+    def test_unsupported(self):
+        compare(None, compile_schema(Schema((int, str))))
+        compare(None, compile_schema(Schema({Exclusive('x', 'g'): int})))
+        compare(None, compile_schema(Schema({'x': []})))
+
+    def test_config_schema(self):
+        self.check(config_schema, dict(
+            sources=[dict(paths='/etc'), dict(type='crontab', name='root')]
+        ))
+        self.check_mismatch(config_schema, dict(sources=[]))
+
+
+class TestValidatorFor(TestCase):
+
+    def test_cached(self):
+        schema = Schema({'x': int})
+        validator = validator_for(schema)
+        self.assertTrue(validator_for(schema) is validator)
+        self.assertFalse(validator_for(Schema({'x': int})) is validator)
+
+    def test_plugin_class(self):
+        validator = PathsSource.validator()
+        self.assertTrue(PathsSource.validator() is validator)
+        self.assertTrue(PathsSource.__dict__['_validator'] is not None)
+        # subclasses have their own schema, so get their own validator:
+        self.assertFalse(JenkinsSource.validator() is validator)
+        compare(dict(type='jenkins', name='jenkins', repo='config'),
+                JenkinsSource.validator()(dict(type='jenkins',
+                                               repo='config')))
+
+    def test_plugin_can_not_be_compiled(self):
+        class Uncompilable(Source):
+            schema = Schema((int, str))
+        compare(None, Uncompilable.validator())
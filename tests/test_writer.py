@@ -0,0 +1,287 @@
+import os
+from unittest import TestCase
+
+from mock import Mock
+from testfixtures import TempDirectory, compare, ShouldRaise, Replacer
+
+from archivist.writer import AtomicWriter, same_content, umask, up_to_date
+
+
+class TestAtomicWriter(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_write(self):
+        path = self.dir.getpath('sub/file')
+        with AtomicWriter() as writer:
+            writer.write(path, 'content')
+            # nothing there until committed:
+            self.assertFalse(os.path.exists(path))
+        compare('content', self.dir.read('sub/file'))
+        self.dir.compare(['sub/', 'sub/file'])
+
+    def test_open(self):
+        with AtomicWriter() as writer:
+            with writer.open(self.dir.getpath('file')) as target:
+                target.write('foo')
+                target.write('bar')
+        compare('foobar', self.dir.read('file'))
+
+    def test_permissions(self):
+        with Replacer() as r:
+            r.replace('archivist.writer._umask', 027)
+            with AtomicWriter() as writer:
+                writer.write(self.dir.getpath('file'), 'content')
+        compare(0640, os.stat(self.dir.getpath('file')).st_mode & 0777)
+
+    def test_replace(self):
+        path = self.dir.write('file', 'old')
+        with AtomicWriter() as writer:
+            writer.write(path, 'new')
+            compare('old', self.dir.read('file'))
+        compare('new', self.dir.read('file'))
+        self.dir.compare(['file'])
+
+    def test_identical_left_alone(self):
+        path = self.dir.write('file', 'same')
+        inode = os.stat(path).st_ino
+        rename = Mock(side_effect=os.rename)
+        with Replacer() as r:
+            r.replace('archivist.writer.os.rename', rename)
+            with AtomicWriter() as writer:
+                writer.write(path, 'same')
+        compare(inode, os.stat(path).st_ino)
+        compare(0, rename.call_count)
+        self.dir.compare(['file'])
+
+    def test_exception_discards(self):
+        path = self.dir.write('file', 'old')
+        with ShouldRaise(ValueError):
+            with AtomicWriter() as writer:
+                writer.write(path, 'new')
+                writer.write(self.dir.getpath('other'), 'new')
+                raise ValueError()
+        compare('old', self.dir.read('file'))
+        self.dir.compare(['file'])
+
+    def test_never_writes_through_link(self):
+        target = self.dir.write('target', 'precious')
+        path = self.dir.getpath('link')
+        os.symlink(target, path)
+        with AtomicWriter() as writer:
+            writer.write(path, 'new')
+        compare('precious', self.dir.read('target'))
+        compare('new', self.dir.read('link'))
+        self.assertFalse(os.path.islink(path))
+
+    def test_never_writes_into_hard_link(self):
+        target = self.dir.write('target', 'precious')
+        path = self.dir.getpath('link')
+        os.link(target, path)
+        with AtomicWriter() as writer:
+            writer.write(path, 'new')
+        compare('precious', self.dir.read('target'))
+        compare('new', self.dir.read('link'))
+
+    def test_copy_and_link(self):
+        source = self.dir.write('source', 'content')
+        with AtomicWriter() as writer:
+            compare(True, writer.copy(source, self.dir.getpath('out/a')))
+            writer.link(self.dir.getpath('out/a'), self.dir.getpath('out/b'))
+        compare('content', self.dir.read('out/a'))
+        compare(os.stat(self.dir.getpath('out/a')).st_ino,
+                os.stat(self.dir.getpath('out/b')).st_ino)
+        self.dir.compare(['a', 'b'], path='out')
+
+    def test_copy_keeps_mtime(self):
+        source = self.dir.write('source', 'content')
+        os.utime(source, (1000, 2000))
+        path = self.dir.getpath('out/a')
+        with AtomicWriter() as writer:
+            writer.copy(source, path)
+        compare(2000, os.stat(path).st_mtime)
+
+    def test_copy_unchanged_makes_no_temp_file(self):
+        source = self.dir.write('source', 'content')
+        path = self.dir.write('target', 'content')
+        mtime = os.stat(source).st_mtime
+        os.utime(path, (mtime, mtime))
+        mkstemp = Mock()
+        with Replacer() as r:
+            r.replace('archivist.writer.mkstemp', mkstemp)
+            with AtomicWriter() as writer:
+                compare(False, writer.copy(source, path))
+        mkstemp.assert_not_called()
+
+    def test_copy_different_size_not_compared(self):
+        source = self.dir.write('source', 'new content')
+        path = self.dir.write('target', 'old')
+        open_ = Mock()
+        with Replacer() as r:
+            r.replace('archivist.writer.open', open_, strict=False)
+            compare(False, up_to_date(source, path, os.stat(source)))
+        open_.assert_not_called()
+
+    def test_copy_same_size_and_mtime_different_content(self):
+        source = self.dir.write('source', 'old')
+        path = self.dir.getpath('target')
+        with AtomicWriter() as writer:
+            writer.copy(source, path)
+        # edited in place, with the modification time put back:
+        stat = os.stat(source)
+        self.dir.write('source', 'new')
+        os.utime(source, (stat.st_atime, stat.st_mtime))
+        with AtomicWriter() as writer:
+            compare(True, writer.copy(source, path))
+        compare('new', self.dir.read('target'))
+
+    def test_copy_same_content_different_mtime(self):
+        source = self.dir.write('source', 'content')
+        path = self.dir.write('target', 'content')
+        os.utime(source, (1000, 2000))
+        inode = os.stat(path).st_ino
+        with AtomicWriter() as writer:
+            compare(False, writer.copy(source, path))
+        compare(inode, os.stat(path).st_ino)
+        compare(2000, os.stat(path).st_mtime)
+        self.dir.compare(['source', 'target'])
+
+    def test_copy_same_size_different_content(self):
+        source = self.dir.write('source', 'new')
+        path = self.dir.write('target', 'old')
+        with AtomicWriter() as writer:
+            compare(True, writer.copy(source, path))
+        compare('new', self.dir.read('target'))
+
+    def test_link_already_linked(self):
+        path = self.dir.write('a', 'content')
+        link = self.dir.getpath('b')
+        os.link(path, link)
+        with AtomicWriter() as writer:
+            writer.link(path, link)
+            compare([], writer.pending)
+        compare(os.stat(path).st_ino, os.stat(link).st_ino)
+
+    def test_link_to_unchanged_copy(self):
+        source = self.dir.write('source', 'content')
+        path = self.dir.write('out/a', 'content')
+        mtime = os.stat(source).st_mtime
+        os.utime(path, (mtime, mtime))
+        with AtomicWriter() as writer:
+            writer.copy(source, path)
+            writer.link(path, self.dir.getpath('out/b'))
+        compare(os.stat(path).st_ino,
+                os.stat(self.dir.getpath('out/b')).st_ino)
+
+    def test_batched(self):
+        def written():
+            return sorted(name for name in os.listdir(self.dir.path)
+                          if not name.startswith('.archivist-'))
+        writer = AtomicWriter(batch_size=2)
+        writer.write(self.dir.getpath('1'), 'x')
+        compare([], written())
+        writer.write(self.dir.getpath('2'), 'y')
+        self.dir.compare(['1', '2'])
+        writer.write(self.dir.getpath('3'), 'z')
+        compare(['1', '2'], written())
+        writer.commit()
+        self.dir.compare(['1', '2', '3'])
+
+    def test_remove(self):
+        path = self.dir.write('file', 'content')
+        with AtomicWriter() as writer:
+            writer.remove(path)
+            writer.remove(self.dir.getpath('missing'))
+            compare('content', self.dir.read('file'))
+        self.dir.compare([])
+
+    def test_remove_discarded(self):
+        path = self.dir.write('file', 'content')
+        with ShouldRaise(ValueError):
+            with AtomicWriter() as writer:
+                writer.remove(path)
+                raise ValueError()
+        self.dir.compare(['file'])
+
+    def test_symlink(self):
+        path = self.dir.write('link', 'was a file')
+        with AtomicWriter() as writer:
+            writer.symlink('/some/where', path)
+        compare('/some/where', os.readlink(path))
+
+    def test_symlink_identical(self):
+        path = self.dir.getpath('link')
+        os.symlink('/some/where', path)
+        inode = os.lstat(path).st_ino
+        with AtomicWriter() as writer:
+            writer.symlink('/some/where', path)
+        compare(inode, os.lstat(path).st_ino)
+        self.dir.compare(['link'])
+
+    def test_fsync_batched(self):
+        fsync = Mock(side_effect=os.fsync)
+        rename = Mock(side_effect=os.rename)
+        manager = Mock()
+        manager.attach_mock(fsync, 'fsync')
+        manager.attach_mock(rename, 'rename')
+        with Replacer() as r:
+            r.replace('archivist.writer.os.fsync', fsync)
+            r.replace('archivist.writer.os.rename', rename)
+            with AtomicWriter() as writer:
+                writer.write(self.dir.getpath('a/1'), 'x')
+                writer.write(self.dir.getpath('a/2'), 'y')
+                writer.write(self.dir.getpath('b/3'), 'z')
+        # a sync for each file, then the renames, then a sync for each
+        # directory:
+        compare(['fsync']*3 + ['rename']*3 + ['fsync']*2,
+                [c[0] for c in manager.mock_calls])
+
+
+class TestUmask(TestCase):
+
+    def setUp(self):
+        self.r = Replacer()
+        self.addCleanup(self.r.restore)
+        self.r.replace('archivist.writer._umask', None)
+        self.original = os.umask(022)
+        self.addCleanup(os.umask, self.original)
+
+    def test_read_when_needed(self):
+        os.umask(027)
+        compare(027, umask())
+        # the umask is only read once:
+        os.umask(022)
+        compare(027, umask())
+        compare(022, os.umask(022))
+
+    def test_no_proc(self):
+        os.umask(027)
+        self.r.replace('archivist.writer.open',
+                       Mock(side_effect=IOError()), strict=False)
+        compare(027, umask())
+        compare(027, os.umask(022))
+
+
+class TestSameContent(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_missing(self):
+        compare(False, same_content(self.dir.write('a', 'x'),
+                                    self.dir.getpath('b')))
+
+    def test_different_size(self):
+        compare(False, same_content(self.dir.write('a', 'x'),
+                                    self.dir.write('b', 'xx')))
+
+    def test_different_content(self):
+        compare(False, same_content(self.dir.write('a', 'x'),
+                                    self.dir.write('b', 'y')))
+
+    def test_same(self):
+        compare(True, same_content(self.dir.write('a', 'x'),
+                                   self.dir.write('b', 'x')))
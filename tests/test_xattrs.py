@@ -0,0 +1,78 @@
+from errno import ENOTSUP, EIO
+from unittest import TestCase
+
+from testfixtures import compare, TempDirectory, Replacer, ShouldRaise
+
+from archivist.xattrs import read_xattrs, encode_value, _libc_call
+from tests.helpers import set_xattr
+
+
+class TestReadXattrs(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_none(self):
+        path = self.dir.write('a', b'')
+        compare([], read_xattrs(path))
+
+    def test_some(self):
+        path = self.dir.write('a', b'')
+        set_xattr(path, 'user.b', b'2')
+        set_xattr(path, 'user.a', b'x' * 1000)
+        compare([('user.a', b'x' * 1000), ('user.b', b'2')],
+                read_xattrs(path))
+
+    def test_larger_than_buffer(self):
+        path = self.dir.write('a', b'')
+        set_xattr(path, 'user.a', b'x' * 1000)
+        with Replacer() as r:
+            r.replace('archivist.xattrs.buffer_size', 16)
+            compare([('user.a', b'x' * 1000)], read_xattrs(path))
+
+    def test_one_call_each(self):
+        path = self.dir.write('a', b'')
+        set_xattr(path, 'user.a', b'1')
+        calls = []
+        def libc_call(function, *args):
+            calls.append(args[-1])
+            return _libc_call(function, *args)
+        with Replacer() as r:
+            r.replace('archivist.xattrs._libc_call', libc_call)
+            compare([('user.a', b'1')], read_xattrs(path))
+        # no calls just to find out the size needed:
+        compare([4096, 4096], calls)
+
+    def test_unsupported(self):
+        def list_xattrs(path):
+            raise OSError(ENOTSUP, 'nope')
+        with Replacer() as r:
+            r.replace('archivist.xattrs.list_xattrs', list_xattrs)
+            compare([], read_xattrs('/foo'))
+
+    def test_other_error(self):
+        def list_xattrs(path):
+            raise OSError(EIO, 'bad')
+        with Replacer() as r:
+            r.replace('archivist.xattrs.list_xattrs', list_xattrs)
+            with ShouldRaise(OSError(EIO, 'bad')):
+                read_xattrs('/foo')
+
+    def test_missing_file(self):
+        with ShouldRaise(OSError):
+            read_xattrs(self.dir.getpath('nope'))
+
+
+class TestEncodeValue(TestCase):
+
+    def test_text(self):
+        compare('"system_u:object_r:etc_t:s0"',
+                encode_value(b'system_u:object_r:etc_t:s0\0'))
+
+    def test_binary(self):
+        compare('0sAQAAAgAgAAAAAAAAAAAAAAAAAAA=',
+                encode_value(b'\x01\x00\x00\x02\x00\x20' + b'\0' * 14))
+
+    def test_quote(self):
+        compare('0sYSJi', encode_value(b'a"b'))